@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Checkpoints of the enrichment, to resume it after the last raw item enriched"""
+
+import hashlib
+import json
+import logging
+import os
+from threading import Lock
+
+from grimoirelab_toolkit.datetime import datetime_utcnow
+
+from .elastic import ElasticSearch
+from .elastic_items import HEADER_JSON
+from .enriched.utils import grimoire_con, anonymize_url
+
+CHECKPOINT_INTERVAL = 10000  # raw items enriched between checkpoints
+CHECKPOINT_FIELD_DATE = "metadata__timestamp"
+CHECKPOINT_FIELD_UUID = "uuid"
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointStore:
+    """Base class of the stores of checkpoints. A checkpoint is the
+    date (`metadata__timestamp`) and uuid of the last raw item of an
+    origin enriched into an index."""
+
+    def get(self, index, origin):
+        """Get a checkpoint
+
+        :param index: name of the enriched index
+        :param origin: origin of the raw items
+        :returns: tuple (date, uuid), None if there is no checkpoint
+        """
+        raise NotImplementedError
+
+    def set(self, index, origin, date, uuid):
+        """Set a checkpoint, replacing the current one
+
+        :param index: name of the enriched index
+        :param origin: origin of the raw items
+        :param date: `metadata__timestamp` of the last raw item enriched
+        :param uuid: uuid of the last raw item enriched
+        """
+        raise NotImplementedError
+
+    def delete(self, index, origin):
+        """Delete a checkpoint, if it exists
+
+        :param index: name of the enriched index
+        :param origin: origin of the raw items
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def get_key(index, origin):
+        return index + " " + origin
+
+    @staticmethod
+    def get_doc(index, origin, date, uuid):
+        return {
+            "index": index,
+            "origin": origin,
+            "date": date,
+            "uuid": uuid,
+            "updated_on": datetime_utcnow().isoformat()
+        }
+
+
+class FileCheckpointStore(CheckpointStore):
+    """Store the checkpoints in a local JSON file. The file is written
+    to a temporary one which replaces it, so a crash while writing
+    doesn't corrupt it.
+
+    :param path: path of the JSON file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+
+    def get(self, index, origin):
+        with self.lock:
+            checkpoints = self.__read()
+
+        doc = checkpoints.get(self.get_key(index, origin), None)
+        if not doc:
+            return None
+
+        return doc['date'], doc['uuid']
+
+    def set(self, index, origin, date, uuid):
+        with self.lock:
+            checkpoints = self.__read()
+            checkpoints[self.get_key(index, origin)] = self.get_doc(index, origin, date, uuid)
+            self.__write(checkpoints)
+
+    def delete(self, index, origin):
+        with self.lock:
+            checkpoints = self.__read()
+            if checkpoints.pop(self.get_key(index, origin), None):
+                self.__write(checkpoints)
+
+    def __read(self):
+        if not os.path.exists(self.path):
+            return {}
+
+        with open(self.path) as fd:
+            return json.load(fd)
+
+    def __write(self, checkpoints):
+        path_tmp = self.path + ".tmp"
+        with open(path_tmp, "w") as fd:
+            json.dump(checkpoints, fd, indent=4, sort_keys=True)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(path_tmp, self.path)
+
+
+class ESCheckpointStore(CheckpointStore):
+    """Store the checkpoints in an ElasticSearch index, with a document
+    per enriched index and origin. The index is created by ES when the
+    first checkpoint is stored.
+
+    :param url: ElasticSearch url
+    :param index: name of the index of the checkpoints
+    :param insecure: support https with invalid certificates
+    :param major: major version of ElasticSearch, None to get it from the server
+    """
+    def __init__(self, url, index, insecure=True, major=None):
+        self.url = url
+        self.index = index
+        self.index_url = url + "/" + index
+        self.major = major if major else ElasticSearch.check_instance(url, insecure)
+        self.requests = grimoire_con(insecure)
+
+    def get(self, index, origin):
+        url = self.__get_doc_url(index, origin)
+
+        res = self.requests.get(url)
+        if res.status_code == 404:
+            return None
+        res.raise_for_status()
+
+        doc = res.json()['_source']
+        return doc['date'], doc['uuid']
+
+    def set(self, index, origin, date, uuid):
+        url = self.__get_doc_url(index, origin) + "?refresh=true"
+        doc = self.get_doc(index, origin, date, uuid)
+
+        res = self.requests.put(url, data=json.dumps(doc), headers=HEADER_JSON)
+        res.raise_for_status()
+
+    def delete(self, index, origin):
+        url = self.__get_doc_url(index, origin) + "?refresh=true"
+
+        res = self.requests.delete(url)
+        if res.status_code != 404:
+            res.raise_for_status()
+
+    def __get_doc_url(self, index, origin):
+        doc_id = hashlib.sha1(self.get_key(index, origin).encode('utf-8')).hexdigest()
+
+        if self.major == '7':
+            doc_url = self.index_url + "/_doc/" + doc_id
+        else:
+            doc_url = self.index_url + "/items/" + doc_id
+
+        return doc_url
+
+
+class Checkpoint:
+    """Checkpoint of the enrichment of the raw items of an origin into an index.
+
+    The raw items are enriched sorted by `metadata__timestamp` and `uuid`,
+    thus the enrichment can be resumed just after the last one enriched
+    (see `ElasticItems.set_search_after`). The checkpoint is advanced every
+    `interval` raw items, once the bulk writer is flushed. It is not advanced
+    anymore if any document was not inserted, so the next run enriches
+    again the raw items after the last checkpoint.
+
+    :param store: CheckpointStore of the checkpoint
+    :param index: name of the enriched index
+    :param origin: origin of the raw items
+    :param interval: raw items enriched between checkpoints
+    """
+    def __init__(self, store, index, origin, interval=CHECKPOINT_INTERVAL):
+        self.store = store
+        self.index = index
+        self.origin = origin
+        self.interval = interval
+
+        self.last_item = None  # last raw item enriched since the latest checkpoint
+        self.pending = 0  # raw items enriched since the latest checkpoint
+        self.failed = False  # some documents were not inserted
+
+    def get(self):
+        """Get the date and uuid of the last raw item enriched, None if there is no checkpoint"""
+
+        return self.store.get(self.index, self.origin)
+
+    def reset(self):
+        """Delete the checkpoint, so the next run enriches all the raw items"""
+
+        logger.debug("Deleting checkpoint of {} in {}".format(anonymize_url(self.origin), self.index))
+        self.store.delete(self.index, self.origin)
+
+    def add(self, items, writer):
+        """Add a list of raw items whose rich items were added to `writer`. The
+        checkpoint is advanced when `interval` raw items are pending.
+
+        :param items: list of raw items, sorted by date and uuid
+        :param writer: BulkWriter of the rich items
+        """
+        if not items:
+            return
+
+        self.last_item = items[-1]
+        self.pending += len(items)
+
+        if self.pending >= self.interval:
+            self.save(writer)
+
+    def save(self, writer):
+        """Flush `writer` and advance the checkpoint to the last raw item added,
+        if all the documents were inserted.
+
+        :param writer: BulkWriter of the rich items
+        """
+        if self.failed or not self.last_item:
+            return
+
+        writer.flush()
+
+        missing = writer.total_items - writer.total
+        if missing:
+            logger.warning("{} documents not inserted in {}, checkpoint of {} not advanced".format(
+                           missing, self.index, anonymize_url(self.origin)))
+            self.failed = True
+            return
+
+        date = self.last_item.get(CHECKPOINT_FIELD_DATE, None)
+        uuid = self.last_item.get(CHECKPOINT_FIELD_UUID, None)
+        if not date or not uuid:
+            logger.debug("Missing {} or {} in the raw items, checkpoint not advanced".format(
+                         CHECKPOINT_FIELD_DATE, CHECKPOINT_FIELD_UUID))
+            return
+
+        self.store.set(self.index, self.origin, date, uuid)
+        logger.debug("Checkpoint of {} in {}: {} {}".format(anonymize_url(self.origin), self.index, date, uuid))
+
+        self.last_item = None
+        self.pending = 0
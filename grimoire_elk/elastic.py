@@ -21,16 +21,21 @@
 
 import json
 import logging
-import sys
-from time import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep, time
 
 import requests
 
-from grimoirelab_toolkit.datetime import (str_to_datetime,
+from grimoirelab_toolkit.datetime import (datetime_utcnow,
+                                          str_to_datetime,
                                           unixtime_to_datetime,
                                           InvalidDateError)
 
-from grimoire_elk.errors import ELKError, ElasticError
+from grimoire_elk.errors import ElasticError
+from grimoire_elk.metrics import metrics
 from grimoire_elk.enriched.utils import (grimoire_con,
                                          get_diff_current_date,
                                          anonymize_url)
@@ -39,14 +44,43 @@ logger = logging.getLogger(__name__)
 
 HEADER_JSON = {"Content-Type": "application/json"}
 
+REFRESH_WAIT_FOR = 'wait_for'
+REFRESH_TRUE = 'true'
+
+INDEX_VERSION_SEPARATOR = '-v'
+
+BULK_LOAD_SETTINGS = {
+    "refresh_interval": "-1",
+    "number_of_replicas": 0
+}
+
+# Status of the bulk items rejected because ES is overloaded, they are sent again
+BULK_RETRY_STATUS = [429]
+
+DEAD_LETTER_LOCK = Lock()
+
+BulkResult = namedtuple('BulkResult', ['inserted', 'retried', 'dead_lettered'])
+
 
 class ElasticSearch(object):
 
     max_items_bulk = 1000
+    max_bytes_bulk = 10 * 1024 * 1024  # max size of a bulk request payload (10 MB)
+    bulk_workers = 1  # number of threads uploading bulk packs concurrently
+    max_bulk_in_flight = None  # max bulk packs pending to be uploaded (default to bulk_workers)
+    max_bulk_retries = 5  # max attempts to send again the bulk items rejected by ES
+    bulk_retry_backoff = 1  # seconds to wait before the first retry, doubled on each attempt
+    dead_letter_file = None  # NDJSON file where the bulk items not inserted are appended
+    compression_level = None  # gzip level of the bulk requests sent to ES, None to disable it
+    # Refresh of the index after write requests. If None, the index is refreshed once at
+    # the end of the run (see `refresh_index`). Set it to REFRESH_WAIT_FOR for read-after-write
+    refresh_policy = None
+    force_merge_on_bulk_load = False  # force merge the index at the end of a bulk load
+    keep_index_versions = 0  # old versions of a rebuilt index kept after swapping the aliases
     max_items_clause = 1000  # max items in search clause (refresh identities)
 
     def __init__(self, url, index, mappings=None, clean=False,
-                 insecure=True, analyzers=None, aliases=None):
+                 insecure=True, analyzers=None, aliases=None, rebuild=False):
         """Class to handle the operations with the ElasticSearch database, such as
         creating indexes, mappings, setting up aliases and uploading documents.
 
@@ -57,6 +91,9 @@ class ElasticSearch(object):
         :param insecure: support https with invalid certificates
         :param analyzers: analyzers for ElasticSearch
         :param aliases: list of aliases, defined as strings, to be added to the index
+        :param rebuild: if True, the documents are written to a new versioned index
+            (e.g., git_enriched-v20200101120000000000), which replaces `index` once
+            `swap_aliases` is called
         """
         # Get major version of Elasticsearch instance
         self.major = self.check_instance(url, insecure)
@@ -69,17 +106,25 @@ class ElasticSearch(object):
         self.index = self.safe_index(index)
         self.aliases = aliases
 
+        # In rebuild mode the index name becomes the alias of the versioned index
+        self.rebuild = rebuild
+        self.alias = None
+        if rebuild:
+            self.alias = self.index
+            self.index = self.get_versioned_index(self.alias)
+
         self.index_url = self.url + "/" + self.index
         self.wait_bulk_seconds = 2  # time to wait to complete a bulk operation
 
-        self.requests = grimoire_con(insecure)
+        self.requests = grimoire_con(insecure, compression_level=self.compression_level)
 
         self.create_index(analyzers, clean)
         if mappings:
             map_dict = mappings.get_elastic_mappings(es_major=self.major)
             self.create_mappings(map_dict)
 
-        if aliases:
+        # In rebuild mode the aliases are moved to the index in `swap_aliases`
+        if aliases and not rebuild:
             for alias in aliases:
                 if self.alias_in_use(alias):
                     logger.debug("Alias {} won't be set on {}, it already exists on {}".format(
@@ -100,6 +145,15 @@ class ElasticSearch(object):
             index = unique_id.replace("/", "_").lower()
         return index
 
+    @staticmethod
+    def get_versioned_index(index):
+        """Return the name of a new version of `index`
+
+        :param index: index name
+        """
+        version = datetime_utcnow().strftime('%Y%m%d%H%M%S%f')
+        return "{}{}{}".format(index, INDEX_VERSION_SEPARATOR, version)
+
     @staticmethod
     def check_instance(url, insecure):
         """Checks if there is an instance of Elasticsearch in url.
@@ -160,45 +214,270 @@ class ElasticSearch(object):
                 logger.info("Deleted and created index {}".format(anonymize_url(self.index_url)))
 
     def safe_put_bulk(self, url, bulk_json):
-        """Bulk items to a target index `url`. In case of UnicodeEncodeError,
-        the bulk is encoded with iso-8859-1.
+        """Bulk items to a target index `url`, see `put_bulk`.
 
         :param url: target index where to bulk the items
-        :param bulk_json: str representation of the items to upload
+        :param bulk_json: str (or encoded bytes) representation of the items to upload
+
+        :returns: number of items inserted
+        """
+        return self.put_bulk(url, bulk_json).inserted
+
+    def put_bulk(self, url, bulk_json):
+        """Bulk items to a target index `url`. The result of each item is
+        checked and only the items rejected because ES was overloaded
+        (e.g., 429, es_rejected_execution_exception) are sent again. The retries
+        wait an exponential back-off and use smaller packs on each attempt.
+        The items which fail for other reasons, or after `max_bulk_retries`
+        attempts, are appended to `dead_letter_file` (if set) as NDJSON
+        bulk actions, so they can be replayed later.
+
+        :param url: target index where to bulk the items
+        :param bulk_json: str (or encoded bytes) representation of the items to upload
+
+        :returns: a `BulkResult` with the number of items inserted, retried (i.e.,
+            sent again at least once) and dead-lettered (i.e., not inserted)
         """
+        url = self.add_refresh_param(url)
+
+        if isinstance(bulk_json, str):
+            try:
+                bulk_json = bulk_json.encode('utf-8')
+            except UnicodeEncodeError:
+                logger.warning("Encoding error ... removing not valid chars from bulk")
+                bulk_json = bulk_json.encode('utf-8', 'ignore')
+
+        result = self.__put_bulk_request(url, bulk_json)
+        if not result['errors']:
+            logger.debug("{} items uploaded to ES ({})".format(len(result['items']), anonymize_url(url)))
+            return BulkResult(len(result['items']), 0, 0)
+
+        # Each item is an action line followed by the source of the document
+        lines = bulk_json.rstrip(b"\n").split(b"\n")
+        if len(lines) != 2 * len(result['items']):
+            statuses = [self.__get_item_status(item) for item in result['items']]
+            failed = [(None, status) for status in statuses if 'error' in status]
+            self.__log_bulk_errors(url, failed)
+            return BulkResult(len(statuses) - len(failed), 0, len(failed))
+
+        sent = list(zip(lines[0::2], lines[1::2]))
+        statuses = [self.__get_item_status(item) for item in result['items']]
+        pack_size = len(sent)
+        pending = []
+        retryable = []
+        failed = []
+        inserted = 0
+        retried = set()
+        attempt = 0
+
+        while True:
+            for item, status in zip(sent, statuses):
+                if 'error' not in status:
+                    inserted += 1
+                elif status.get('status') in BULK_RETRY_STATUS:
+                    retryable.append((item, status))
+                else:
+                    failed.append((item, status))
+
+            if not pending:
+                if not retryable:
+                    break
+
+                if attempt >= self.max_bulk_retries:
+                    logger.error("Max retries reached, {} items not inserted to ES ({})".format(
+                                 len(retryable), anonymize_url(url)))
+                    failed.extend(retryable)
+                    break
+
+                attempt += 1
+                retried.update(item for item, _ in retryable)
+                pack_size = max(1, pack_size // 2)
+                wait = self.bulk_retry_backoff * (2 ** (attempt - 1))
+                logger.warning("{} items rejected by ES, retrying in {} secs in packs of {} items ({})".format(
+                               len(retryable), wait, pack_size, anonymize_url(url)))
+                sleep(wait)
+
+                pending = [item for item, _ in retryable]
+                retryable = []
+
+            sent = pending[:pack_size]
+            pending = pending[pack_size:]
+            payload = b"".join([action + b"\n" + source + b"\n" for action, source in sent])
+            result = self.__put_bulk_request(url, payload)
+            statuses = [self.__get_item_status(item) for item in result['items']]
+
+        self.__log_bulk_errors(url, failed)
+        self.__write_dead_letters(failed)
+
+        logger.debug("{} items uploaded to ES, {} retried, {} failed ({})".format(
+                     inserted, len(retried), len(failed), anonymize_url(url)))
+        return BulkResult(inserted, len(retried), len(failed))
+
+    def __put_bulk_request(self, url, payload):
         headers = {"Content-Type": "application/x-ndjson"}
 
-        try:
-            res = self.requests.put(url + '?refresh=true', data=bulk_json, headers=headers)
-            res.raise_for_status()
-        except UnicodeEncodeError:
-            # Related to body.encode('iso-8859-1'). mbox data
-            logger.warning("Encondig error ... converting bulk to iso-8859-1")
-            bulk_json = bulk_json.encode('iso-8859-1', 'ignore')
-            res = self.requests.put(url, data=bulk_json, headers=headers)
-            res.raise_for_status()
-
-        result = res.json()
-        failed_items = []
-        error = ""
-        if result['errors']:
-            # Due to multiple errors that may be thrown when inserting bulk data, only the first error is returned
-            failed_items = [item['index'] for item in result['items'] if 'error' in item['index']]
-            error = str(failed_items[0]['error'])
-
-            logger.error("Failed to insert data to ES: {}, {}".format(error, anonymize_url(url)))
-
-        inserted_items = len(result['items']) - len(failed_items)
+        with metrics.timer('es.bulk_request') as timer:
+            timer.add_bytes(len(payload))
+            res = self.requests.put(url, data=payload, headers=headers)
+        res.raise_for_status()
+
+        return res.json()
+
+    @staticmethod
+    def __get_item_status(item):
+        # The key of the result is the action of the item (e.g., index, create)
+        return list(item.values())[0]
+
+    def __log_bulk_errors(self, url, failed):
+        if not failed:
+            return
 
+        # Due to multiple errors that may be thrown when inserting bulk data, only the first error is logged
         # The exception is currently not thrown to avoid stopping ocean uploading processes
+        error = str(failed[0][1].get('error'))
+        logger.error("Failed to insert data to ES: {}, {}".format(error, anonymize_url(url)))
+
+    def __write_dead_letters(self, failed):
+        """Append the failed items to the dead-letter file. The target index
+        is added to the action of each item, thus the file can be replayed
+        against the `_bulk` endpoint of ES."""
+
+        if not self.dead_letter_file:
+            return
+
+        lines = []
+        for item, status in failed:
+            if not item:
+                continue
+            action, source = item
+            action = json.loads(action.decode('utf-8'))
+            for params in action.values():
+                params['_index'] = status.get('_index', self.index)
+            lines.append(json.dumps(action).encode('utf-8') + b"\n" + source + b"\n")
+
+        with DEAD_LETTER_LOCK:
+            with open(self.dead_letter_file, 'ab') as fd:
+                fd.write(b"".join(lines))
+
+        logger.warning("{} items written to dead-letter file {}".format(len(lines), self.dead_letter_file))
+
+    def add_refresh_param(self, url):
+        """Add to the url of a write request the refresh param defined
+        by the refresh policy. Since the by-query APIs don't support `wait_for`,
+        it is replaced by `true` for them.
+
+        :param url: url of the write request
+        """
+        if not self.refresh_policy:
+            return url
+
+        refresh = self.refresh_policy
+        if refresh == REFRESH_WAIT_FOR and '_by_query' in url:
+            refresh = REFRESH_TRUE
+
+        sep = '&' if '?' in url else '?'
+        return "{}{}refresh={}".format(url, sep, refresh)
+
+    def refresh_index(self):
+        """Refresh the index, thus making the last write operations visible to search"""
+
+        r = self.requests.post(self.index_url + "/_refresh", headers=HEADER_JSON, verify=False)
         try:
-            if failed_items:
-                raise ELKError(cause=error)
-        except ELKError:
-            pass
+            r.raise_for_status()
+        except requests.exceptions.HTTPError as ex:
+            logger.warning("Something went wrong when refreshing {}, {}".format(
+                           anonymize_url(self.index_url), ex))
+            return
+
+        logger.debug("Index {} refreshed".format(anonymize_url(self.index_url)))
+
+    def get_index_settings(self):
+        """Get the settings of the index"""
+
+        r = self.requests.get(self.index_url + "/_settings", headers=HEADER_JSON, verify=False)
+        r.raise_for_status()
+
+        # The index may be an alias, thus the settings of the first index are returned
+        settings = list(r.json().values())[0]['settings']['index']
+        return settings
+
+    def update_index_settings(self, settings):
+        """Update the dynamic settings of the index
+
+        :param settings: dict of settings, a None value resets the setting to its default
+        """
+        data = json.dumps({"index": settings})
+        r = self.requests.put(self.index_url + "/_settings", data=data, headers=HEADER_JSON, verify=False)
+        r.raise_for_status()
+
+    def force_merge(self):
+        """Force merge the segments of the index"""
+
+        r = self.requests.post(self.index_url + "/_forcemerge", headers=HEADER_JSON, verify=False)
+        try:
+            r.raise_for_status()
+        except requests.exceptions.HTTPError as ex:
+            logger.warning("Something went wrong when force merging {}, {}".format(
+                           anonymize_url(self.index_url), ex))
+            return
+
+        logger.debug("Index {} force merged".format(anonymize_url(self.index_url)))
+
+    def start_bulk_load(self):
+        """Tune the index for bulk loading: the refresh is disabled and
+        the replicas are removed.
+
+        :returns: the original values of the settings modified
+        """
+        settings = self.get_index_settings()
+        original = {setting: settings.get(setting, None) for setting in BULK_LOAD_SETTINGS}
+
+        self.update_index_settings(BULK_LOAD_SETTINGS)
+        logger.info("Bulk load started on {}, original settings {}".format(
+                    anonymize_url(self.index_url), original))
+
+        return original
+
+    def end_bulk_load(self, original, force_merge=False):
+        """Restore the settings of the index modified by `start_bulk_load`,
+        refresh it and optionally force merge it.
+
+        :param original: original values of the settings
+        :param force_merge: if True, the index is force merged
+        """
+        try:
+            self.update_index_settings(original)
+        except requests.exceptions.HTTPError as ex:
+            logger.error("Can't restore settings {} on {}, {}".format(
+                         original, anonymize_url(self.index_url), ex))
 
-        logger.debug("{} items uploaded to ES ({})".format(inserted_items, anonymize_url(url)))
-        return inserted_items
+        self.refresh_index()
+        if force_merge:
+            self.force_merge()
+
+        logger.info("Bulk load ended on {}".format(anonymize_url(self.index_url)))
+
+    @contextmanager
+    def bulk_load(self, enabled=True, force_merge=None):
+        """Context manager to tune the index for bulk loading. The original
+        settings are always restored on exit, even if an exception is raised.
+
+        :param enabled: if False, the index settings are not modified
+        :param force_merge: if True, the index is force merged on exit. If None
+            the value of `force_merge_on_bulk_load` is used
+        """
+        if not enabled:
+            yield self
+            return
+
+        if force_merge is None:
+            force_merge = self.force_merge_on_bulk_load
+
+        original = self.start_bulk_load()
+        try:
+            yield self
+        finally:
+            self.end_bulk_load(original, force_merge=force_merge)
 
     def all_es_aliases(self):
         """List all aliases used in ES"""
@@ -230,7 +509,12 @@ class ElasticSearch(object):
                            anonymize_url(self.index_url), ex))
             return
 
-        aliases = r.json()[self.index]['aliases']
+        # The index could be an alias of other index (e.g., once rebuilt), the
+        # response is keyed by the concrete indexes
+        aliases = {}
+        for index_aliases in r.json().values():
+            aliases.update(index_aliases['aliases'])
+
         return aliases
 
     def alias_in_use(self, alias):
@@ -283,6 +567,95 @@ class ElasticSearch(object):
 
         logger.info("Alias {} created on {}.".format(alias, anonymize_url(self.index_url)))
 
+    def get_index_versions(self):
+        """List the versioned indexes of the rebuilt index, sorted from the oldest
+        to the newest. The current one is included."""
+
+        return sorted(self.__get_versions_aliases().keys())
+
+    def __get_versions_aliases(self):
+        pattern = "{}{}*".format(self.alias, INDEX_VERSION_SEPARATOR)
+        r = self.requests.get(self.url + "/" + pattern + "/_alias", headers=HEADER_JSON, verify=False)
+        r.raise_for_status()
+
+        return {index: value['aliases'] for index, value in r.json().items()}
+
+    def swap_aliases(self):
+        """Move atomically, with a single `_aliases` call, the aliases of the previous
+        versions of a rebuilt index to the current one. The rebuilt index name is also
+        moved as an alias. If it still exists as a concrete index, it is
+        removed in the same call. The aliases of the index replaced which are not
+        managed by this object (e.g., set by studies or other tools) are moved too,
+        with their properties. Finally, the old versions are deleted, keeping
+        the most recent `keep_index_versions` ones.
+        """
+        if not self.rebuild:
+            logger.warning("Aliases not swapped, {} is not a rebuilt index".format(
+                           anonymize_url(self.index_url)))
+            return
+
+        aliases = [self.alias]
+        if self.aliases:
+            aliases.extend(self.aliases)
+
+        actions = []
+        versions_aliases = self.__get_versions_aliases()
+
+        # Aliases of the index replaced, with their properties (e.g., filter)
+        replaced_aliases = {}
+        r = self.requests.get(self.url + "/" + self.alias, headers=HEADER_JSON, verify=False)
+        if r.status_code == 200 and self.alias in r.json():
+            # The index to replace is not an alias yet
+            actions.append({"remove_index": {"index": self.alias}})
+            replaced_aliases.update(r.json()[self.alias].get('aliases', {}))
+        else:
+            for index, index_aliases in versions_aliases.items():
+                if index != self.index and self.alias in index_aliases:
+                    replaced_aliases.update(index_aliases)
+
+        alias_dicts = [{"alias": alias} if isinstance(alias, str) else dict(alias) for alias in aliases]
+        managed = [alias_dict['alias'] for alias_dict in alias_dicts]
+        for name, properties in sorted(replaced_aliases.items()):
+            if name not in managed:
+                alias_dict = dict(properties)
+                alias_dict['alias'] = name
+                alias_dicts.append(alias_dict)
+
+        for alias_dict in alias_dicts:
+            for index, index_aliases in versions_aliases.items():
+                if index != self.index and alias_dict['alias'] in index_aliases:
+                    actions.append({"remove": {"index": index, "alias": alias_dict['alias']}})
+            alias_dict['index'] = self.index
+            actions.append({"add": alias_dict})
+
+        r = self.requests.post(self.url + "/_aliases", headers=HEADER_JSON, verify=False,
+                               data=json.dumps({"actions": actions}))
+        r.raise_for_status()
+
+        logger.info("Aliases {} moved to {}".format(
+                    [alias_dict['alias'] for alias_dict in alias_dicts], anonymize_url(self.index_url)))
+
+        self.delete_old_versions()
+
+    def delete_old_versions(self):
+        """Delete the old versions of a rebuilt index, keeping the
+        most recent `keep_index_versions` ones"""
+
+        old_indexes = [index for index in self.get_index_versions() if index < self.index]
+        if self.keep_index_versions:
+            old_indexes = old_indexes[:-self.keep_index_versions]
+
+        for index in old_indexes:
+            r = self.requests.delete(self.url + "/" + index, headers=HEADER_JSON, verify=False)
+            try:
+                r.raise_for_status()
+            except requests.exceptions.HTTPError as ex:
+                logger.warning("Something went wrong when deleting old index version {}, {}".format(
+                               index, ex))
+                continue
+
+            logger.info("Old index version {} deleted".format(index))
+
     def get_bulk_url(self):
         """Get the bulk URL endpoint"""
 
@@ -311,39 +684,33 @@ class ElasticSearch(object):
         :param items: list of items to be uploaded
         :param field_id: unique ID attribute used to differentiate the items
         """
-        current = 0
-        new_items = 0  # total items added with bulk
-        bulk_json = ""
-
         if not items:
-            return new_items
+            return 0
 
-        url = self.get_bulk_url()
+        writer = BulkWriter(self)
+        writer.add_items(items, field_id)
+        writer.flush()
 
-        logger.debug("Adding items to {} (in {} packs)".format(anonymize_url(url), self.max_items_bulk))
-        task_init = time()
+        return writer.total
 
+    def bulk_update(self, items, field_id):
+        """Update in controlled packs some fields of documents in ES, using
+        update actions of the bulk API. Only the fields of the items are
+        sent, the rest of the fields of the documents are kept.
+
+        :param items: list of partial documents, with the unique ID attribute and the fields to update
+        :param field_id: unique ID attribute used to differentiate the items
+        """
+        if not items:
+            return 0
+
+        writer = BulkWriter(self)
         for item in items:
-            if current >= self.max_items_bulk:
-                task_init = time()
-                new_items += self.safe_put_bulk(url, bulk_json)
-                current = 0
-                json_size = sys.getsizeof(bulk_json) / (1024 * 1024)
-                logger.debug("bulk packet sent ({:.2f} sec, {} total, {:.2f} MB)".format(
-                             time() - task_init, new_items, json_size))
-                bulk_json = ""
-            data_json = json.dumps(item)
-            bulk_json += '{{"index" : {{"_id" : "{}" }} }}\n'.format(item[field_id])
-            bulk_json += data_json + "\n"  # Bulk document
-            current += 1
-
-        if current > 0:
-            new_items += self.safe_put_bulk(url, bulk_json)
-            json_size = sys.getsizeof(bulk_json) / (1024 * 1024)
-            logger.debug("bulk packet sent ({:.2f} sec prev, {} total, {:.2f} MB)".format(
-                         time() - task_init, new_items, json_size))
-
-        return new_items
+            fields = {field: value for field, value in item.items() if field != field_id}
+            writer.add(fields, item[field_id], update=True)
+        writer.flush()
+
+        return writer.total
 
     def create_mappings(self, mappings):
         """Create the mappings for a given index. It includes the index
@@ -510,8 +877,8 @@ class ElasticSearch(object):
                     }
                     ''' % (time_field, before_date_str)
 
-        r = self.requests.post(self.index_url + "/_delete_by_query?refresh",
-                               data=es_query, headers=HEADER_JSON, verify=False)
+        url = self.add_refresh_param(self.index_url + "/_delete_by_query")
+        r = self.requests.post(url, data=es_query, headers=HEADER_JSON, verify=False)
         try:
             r.raise_for_status()
             r_json = r.json()
@@ -544,3 +911,167 @@ class ElasticSearch(object):
             return
 
         return properties
+
+
+class BulkWriter:
+
+    def __init__(self, elastic, url=None, max_items=None, max_bytes=None,
+                 workers=None, max_in_flight=None):
+        """Class to build the NDJSON payloads of the bulk API and upload them to
+        ElasticSearch. The documents are encoded when added and kept as a list of
+        chunks, which are sent when either the byte budget or the max number
+        of documents is reached, whichever comes first.
+
+        When more than one worker is set, the packs are uploaded concurrently by
+        a pool of threads. At most `max_in_flight` packs can be pending, once the
+        limit is reached the caller waits for the oldest one to complete. The
+        results are collected in submission order, thus the counters are
+        the same as in the synchronous mode.
+
+        :param elastic: ElasticSearch object used to upload the documents
+        :param url: target bulk url, if None the bulk url of `elastic` is used
+        :param max_items: max number of documents in a bulk request
+        :param max_bytes: max size (in bytes) of a bulk request payload
+        :param workers: number of threads uploading the packs, 1 means synchronous uploads
+        :param max_in_flight: max number of packs pending to be uploaded
+        """
+        self.elastic = elastic
+        self.url = url if url else elastic.get_bulk_url()
+        self.max_items = max_items if max_items else elastic.max_items_bulk
+        self.max_bytes = max_bytes if max_bytes else elastic.max_bytes_bulk
+        self.workers = workers if workers else elastic.bulk_workers
+        self.max_in_flight = max_in_flight if max_in_flight else elastic.max_bulk_in_flight
+        if not self.max_in_flight:
+            self.max_in_flight = self.workers
+
+        self.chunks = []
+        self.current_items = 0
+        self.current_bytes = 0
+
+        self.executor = None
+        self.in_flight = deque()
+
+        self.total = 0  # total documents inserted
+        self.total_items = 0  # total documents sent
+        self.total_bytes = 0  # total bytes sent
+        self.total_retried = 0  # total documents sent again after being rejected
+        self.total_dead_lettered = 0  # total documents not inserted
+        self.flushes = 0
+
+        logger.debug("Adding items to {} (in packs of {} items or {:.2f} MB, {} workers)".format(
+                     anonymize_url(self.url), self.max_items, self.max_bytes / (1024 * 1024), self.workers))
+
+    def add(self, item, item_id, update=False):
+        """Add a document to the current pack. The pack is sent before adding
+        the document if it would exceed the limits of the writer.
+
+        :param item: document to upload
+        :param item_id: ID of the document in the index
+        :param update: if True, `item` has only some fields of the document
+            to update, instead of the whole document
+        """
+        with metrics.timer('bulk.encode') as timer:
+            if update:
+                chunk = '{{"update" : {{"_id" : "{}" }} }}\n'.format(item_id)
+                chunk += json.dumps({"doc": item}) + "\n"
+            else:
+                chunk = '{{"index" : {{"_id" : "{}" }} }}\n'.format(item_id)
+                chunk += json.dumps(item) + "\n"
+            chunk = chunk.encode('utf-8')
+            timer.add_bytes(len(chunk))
+
+        full_items = self.current_items >= self.max_items
+        full_bytes = self.current_bytes + len(chunk) > self.max_bytes
+        if self.current_items and (full_items or full_bytes):
+            self.__send()
+
+        self.chunks.append(chunk)
+        self.current_items += 1
+        self.current_bytes += len(chunk)
+
+    def add_items(self, items, field_id):
+        """Add a list of documents to the current pack
+
+        :param items: documents to upload
+        :param field_id: unique ID attribute used to differentiate the documents
+        """
+        for item in items:
+            self.add(item, item[field_id])
+
+    def flush(self):
+        """Upload the current pack to ElasticSearch and wait for
+        all the pending uploads to complete
+
+        :returns: number of documents inserted
+        """
+        inserted = self.__send()
+
+        try:
+            while self.in_flight:
+                inserted += self.__collect(self.in_flight.popleft())
+        finally:
+            if self.executor:
+                self.executor.shutdown()
+                self.executor = None
+
+        return inserted
+
+    def __send(self):
+        """Upload the current pack, or submit it to the pool of workers.
+
+        :returns: number of documents inserted by the uploads completed
+        """
+        if not self.current_items:
+            return 0
+
+        pack = (b"".join(self.chunks), self.current_items, self.current_bytes)
+
+        self.chunks = []
+        self.current_items = 0
+        self.current_bytes = 0
+
+        if self.workers <= 1:
+            return self.__collect_result(self.__put_bulk(*pack))
+
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        # Back-pressure, wait for the oldest uploads to complete
+        inserted = 0
+        while len(self.in_flight) >= self.max_in_flight:
+            inserted += self.__collect(self.in_flight.popleft())
+
+        self.in_flight.append(self.executor.submit(self.__put_bulk, *pack))
+
+        return inserted
+
+    def __put_bulk(self, payload, n_items, n_bytes):
+        task_init = time()
+        result = self.elastic.put_bulk(self.url, payload)
+
+        return result, n_items, n_bytes, time() - task_init
+
+    def __collect(self, future):
+        return self.__collect_result(future.result())
+
+    def __collect_result(self, result):
+        result, n_items, n_bytes, spent = result
+        inserted = result.inserted
+
+        self.total += inserted
+        self.total_retried += result.retried
+        self.total_dead_lettered += result.dead_lettered
+        self.total_items += n_items
+        self.total_bytes += n_bytes
+        self.flushes += 1
+
+        # Uploads including the retries, as seen by the writer
+        metrics.observe('bulk.put', spent, n_bytes)
+        metrics.incr('bulk.inserted', inserted)
+        metrics.incr('bulk.retried', result.retried)
+        metrics.incr('bulk.dead_lettered', result.dead_lettered)
+
+        logger.debug("Bulk packet sent to {} ({:.2f} sec, {} docs, {:.2f} MB, {} total)".format(
+                     anonymize_url(self.url), spent, n_items, n_bytes / (1024 * 1024), self.total))
+
+        return inserted
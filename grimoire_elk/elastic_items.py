@@ -22,17 +22,32 @@
 """Generates items from ElasticSearch based on filters """
 
 
+import calendar
 import json
 import logging
+import queue
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from .enriched.utils import get_repository_filter, grimoire_con, anonymize_url
+from grimoirelab_toolkit.datetime import str_to_datetime
+
+from .enriched.utils import AdaptivePageSize, get_repository_filter, grimoire_con, anonymize_url
 from .elastic_mapping import Mapping
+from .metrics import metrics
 
 HEADER_JSON = {"Content-Type": "application/json"}
 MAX_BULK_UPDATE_SIZE = 1000
 
+# 1 minute to process the results of size items
+# In gerrit enrich with 500 items per page we need >1 min
+# In Mozilla ES in Amazon we need 10m
+MAX_PROCESS_ITEMS_PACK_TIME = "10m"  # 10 minutes
+
+PAGINATION_PIT = 'pit'
+PAGINATION_SCROLL = 'scroll'
+
 FILTER_DATA_ATTR = 'data.'
 FILTER_SEPARATOR = r",\s*%s" % FILTER_DATA_ATTR
 PROJECTS_JSON_LABELS_PATTERN = r".*(--labels=\[(.*)\]).*"
@@ -48,6 +63,16 @@ class ElasticItems:
     # Change it from p2o command line or mordred config
     scroll_size = 100
     scroll_wait = 900
+    # Point in time plus search_after (ES >= 7.10), scroll is used when not available
+    pagination = PAGINATION_PIT
+    # Slices of the point in time read concurrently, the items are not globally sorted when > 1
+    read_slices = 1
+    prefetch_pages = 0  # pages read ahead in background while the current one is consumed
+    prefetch_max_bytes = 100 * 1024 * 1024  # max size of the pages read ahead (100 MB)
+    # Adapt the size of the pages read with search_after to the size and latency of the responses,
+    # starting from scroll_size. The pages read with scroll always have scroll_size items
+    adaptive_page_size = False
+    compression_level = None  # gzip level of the HTTP traffic with ES, None to disable it
 
     def __init__(self, perceval_backend, from_date=None, insecure=True, offset=None):
         """Class to perform operations over the items stored in a ES index.
@@ -65,8 +90,12 @@ class ElasticItems:
         self.filter_raw_dict = []
         self.projects_json_repo = None
         self.repo_labels = None
+        self.source_includes = None  # fields of the items to get, None to get all of them
+        self.source_excludes = None  # fields of the items not to get
+        self.page_size = None  # controller of the adaptive page size
+        self.search_after = None  # date and uuid of the item after which the fetch is resumed
 
-        self.requests = grimoire_con(insecure)
+        self.requests = grimoire_con(insecure, compression_level=self.compression_level)
         self.elastic = None
         self.elastic_url = None
         self.cfg_section_name = None
@@ -83,6 +112,11 @@ class ElasticItems:
 
         return "metadata__updated_on"
 
+    def get_field_unique_id(self):
+        """Field with the unique id of the items, used as the id of their documents"""
+
+        return "uuid"
+
     def get_incremental_date(self):
         """Field with the date used for incremental analysis."""
 
@@ -175,6 +209,40 @@ class ElasticItems:
         """
         self.from_date = last_enrich_date
 
+    def set_search_after(self, date, uuid):
+        """Resume the incremental fetch just after an item. The raw items are
+        read sorted by `metadata__timestamp` and `uuid`, thus the ones with the
+        same date and an upper uuid are not skipped. With scroll, or when reading
+        slices of a point in time, the items from the date on are fetched.
+
+        :param date: `metadata__timestamp` of the item, as str
+        :param uuid: uuid of the item
+        """
+        self.search_after = (date, uuid)
+
+    def set_source_fields(self, includes=None, excludes=None):
+        """Set the fields of the items to get from the index when fetching
+        them, if not set in the fetch call. Wildcards are allowed.
+
+        :param includes: list of fields to get (e.g., ["data.commit", "metadata__*"]), None to get all of them
+        :param excludes: list of fields not to get (e.g., ["data.files"])
+        """
+        self.source_includes = includes
+        self.source_excludes = excludes
+
+    def get_page_size(self):
+        """Return the controller of the size of the pages read with search_after,
+        shared by all the fetches of this object. None if the page size is
+        not adaptive, thus `scroll_size` is used."""
+
+        if not self.adaptive_page_size:
+            return None
+
+        if not self.page_size:
+            self.page_size = AdaptivePageSize(self.scroll_size)
+
+        return self.page_size
+
     def free_scroll(self, scroll_id=None):
         """ Free scroll after use"""
         if not scroll_id:
@@ -192,26 +260,173 @@ class ElasticItems:
             logger.debug("Error releasing scroll: {}/{}".format(anonymize_url(url), scroll_id))
             logger.debug("Error releasing scroll: {}".format(res.json()))
 
+    def open_pit(self):
+        """Open a point in time on the index of the items
+
+        :returns: the id of the point in time, None if it is not available
+        """
+        if not self.elastic:
+            return None
+
+        url = self.elastic.index_url + "/_pit?keep_alive=" + MAX_PROCESS_ITEMS_PACK_TIME
+        try:
+            res = self.requests.post(url)
+            res.raise_for_status()
+            pit_id = res.json()['id']
+        except Exception:
+            # Not supported before ES 7.10, or the index doesn't exist
+            logger.debug("Point in time not available in {}, using scroll".format(anonymize_url(url)))
+            return None
+
+        return pit_id
+
+    def close_pit(self, pit_id=None):
+        """Release a point in time after use"""
+        if not pit_id:
+            return
+
+        logger.debug("Releasing pit_id={}".format(pit_id))
+        url = self.elastic.url + "/_pit"
+        query_data = json.dumps({"id": pit_id})
+        try:
+            res = self.requests.delete(url, data=query_data, headers=HEADER_JSON)
+            res.raise_for_status()
+        except Exception:
+            logger.debug("Error releasing point in time: {}/{}".format(anonymize_url(url), pit_id))
+
     # Items generator
-    def fetch(self, _filter=None, ignore_incremental=False):
+    def fetch(self, _filter=None, ignore_incremental=False, includes=None, excludes=None):
         """Fetch the items from raw or enriched index. An optional _filter can be
-        provided to filter the data collected
+        provided to filter the data collected. The fields of the items can be
+        limited with `includes` and `excludes`, which default to the ones
+        set with `set_source_fields`.
 
         :param _filter: optional filter of data collected
         :param ignore_incremental: if True, incremental collection is ignored
+        :param includes: list of fields of the items to get, None to get all of them
+        :param excludes: list of fields of the items not to get
         """
 
         logger.debug("Creating a elastic items generator.")
 
+        if includes is None and excludes is None:
+            includes = self.source_includes
+            excludes = self.source_excludes
+        source = self.__get_source(includes, excludes)
+
+        pages = self.__get_pages(_filter=_filter, ignore_incremental=ignore_incremental, source=source)
+        if self.prefetch_pages > 0:
+            pages = self.__prefetch(pages)
+
+        try:
+            # Time waiting for each page, with prefetch it is the time not overlapped with the consumer
+            for items, _ in metrics.timed_iter('fetch.page_wait', pages):
+                metrics.incr('fetch.items', len(items))
+                yield from items
+        finally:
+            pages.close()
+
+    def __get_pages(self, _filter=None, ignore_incremental=False, source=None):
+        """Return a generator of the pages of items, according to the pagination.
+        Each page is returned with the size in bytes of its response."""
+
+        if self.pagination == PAGINATION_PIT:
+            pit_id = self.open_pit()
+            if pit_id and self.read_slices > 1:
+                return self.__fetch_sliced(pit_id, _filter=_filter, ignore_incremental=ignore_incremental,
+                                           source=source)
+            if pit_id:
+                return self.__fetch_pit(pit_id, _filter=_filter, ignore_incremental=ignore_incremental,
+                                        source=source)
+
+        if self.elastic and self.read_slices > 1:
+            reason = "point in time not available" if self.pagination == PAGINATION_PIT else "scroll pagination"
+            logger.warning("Reading {} with a single scroll instead of {} slices, slicing needs "
+                           "a point in time ({})".format(anonymize_url(self.elastic.index_url),
+                                                         self.read_slices, reason))
+
+        return self.__fetch_scroll(_filter=_filter, ignore_incremental=ignore_incremental, source=source)
+
+    @staticmethod
+    def __get_source(includes=None, excludes=None):
+        """Return the `_source` param of the queries to get only some fields"""
+
+        if not includes and not excludes:
+            return None
+
+        source = {}
+        if includes:
+            source['includes'] = includes
+        if excludes:
+            source['excludes'] = excludes
+
+        return source
+
+    def __prefetch(self, pages):
+        """Read ahead up to `prefetch_pages` pages in a background thread, while
+        the current page is consumed. The pages read ahead are limited to
+        `prefetch_max_bytes` (the size of their responses), but at least one
+        page is always read ahead. The reading is stopped, and the
+        scroll or point in time released, when the generator is exhausted or closed."""
+
+        ahead = queue.Queue(maxsize=self.prefetch_pages)
+        stop = threading.Event()
+        released = threading.Condition()
+        buffered = {"bytes": 0}
+        errors = []
+
+        def read_ahead():
+            try:
+                for items, size in pages:
+                    with released:
+                        while self.prefetch_max_bytes and buffered["bytes"] and \
+                                buffered["bytes"] + size > self.prefetch_max_bytes:
+                            if stop.is_set():
+                                return
+                            released.wait(1)
+                        buffered["bytes"] += size
+                    if not self.__put_page(ahead, (items, size), stop):
+                        break
+            except Exception as e:
+                errors.append(e)
+            finally:
+                pages.close()
+                self.__put_page(ahead, None, stop)
+
+        reader = threading.Thread(target=read_ahead, daemon=True)
+        reader.start()
+
+        try:
+            while True:
+                page = ahead.get()
+                if page is None:
+                    break
+                _, size = page
+                with released:
+                    buffered["bytes"] -= size
+                    released.notify()
+                yield page
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+            reader.join()
+
+    def __fetch_scroll(self, _filter=None, ignore_incremental=False, source=None):
+        """Fetch the pages of items with the scroll API. The scroll is released
+        when the generator is exhausted or closed."""
+
         scroll_id = None
-        page = self.get_elastic_items(scroll_id, _filter=_filter, ignore_incremental=ignore_incremental)
+        page, n_bytes = self.__get_scroll_page(scroll_id, _filter=_filter, ignore_incremental=ignore_incremental,
+                                               source=source)
         if page and 'too_many_scrolls' in page:
             sec = self.scroll_wait
             while sec > 0:
                 logger.debug("Too many scrolls open, waiting up to {} seconds".format(sec))
                 time.sleep(1)
                 sec -= 1
-                page = self.get_elastic_items(scroll_id, _filter=_filter, ignore_incremental=ignore_incremental)
+                page, n_bytes = self.__get_scroll_page(scroll_id, _filter=_filter,
+                                                       ignore_incremental=ignore_incremental, source=source)
                 if not page:
                     logger.debug("Waiting for scroll terminated")
                     break
@@ -220,7 +435,7 @@ class ElasticItems:
                     break
 
         if not page:
-            return []
+            return
 
         scroll_id = page["_scroll_id"]
         total = page['hits']['total']
@@ -232,42 +447,195 @@ class ElasticItems:
             self.free_scroll(scroll_id)
             return
 
-        while scroll_size > 0:
+        try:
+            while scroll_size > 0:
 
-            logger.debug("Fetching from {}: {} received".format(
-                         anonymize_url(self.elastic.index_url), len(page['hits']['hits'])))
-            for item in page['hits']['hits']:
-                eitem = item['_source']
-                yield eitem
+                logger.debug("Fetching from {}: {} received".format(
+                             anonymize_url(self.elastic.index_url), len(page['hits']['hits'])))
+                yield [item['_source'] for item in page['hits']['hits']], n_bytes
+
+                page, n_bytes = self.__get_scroll_page(scroll_id, _filter=_filter,
+                                                       ignore_incremental=ignore_incremental)
+
+                if not page:
+                    break
+
+                scroll_size = len(page['hits']['hits'])
+        finally:
+            self.free_scroll(scroll_id)
 
-            page = self.get_elastic_items(scroll_id, _filter=_filter, ignore_incremental=ignore_incremental)
+        logger.debug("Fetching from {}: done receiving".format(anonymize_url(self.elastic.index_url)))
 
+    def __fetch_pit(self, pit_id, _filter=None, ignore_incremental=False, source=None):
+        """Fetch the pages of items paginating with search_after on a point in time.
+        The point in time is released when the generator is exhausted or closed."""
+
+        received = False
+        try:
+            search_after = None if ignore_incremental else self.__get_search_after()
+            for pit_id, items, n_bytes in self.__get_pit_pages(pit_id, _filter=_filter,
+                                                               ignore_incremental=ignore_incremental,
+                                                               source=source, search_after=search_after):
+                received = True
+                yield items, n_bytes
+        finally:
+            self.close_pit(pit_id)
+
+        if received:
+            logger.debug("Fetching from {}: done receiving".format(anonymize_url(self.elastic.index_url)))
+
+    def fetch_slice(self, pit_id, slice_id, max_slices, _filter=None, ignore_incremental=False,
+                    includes=None, excludes=None):
+        """Fetch the items of a slice of a point in time. It allows to read
+        the index with parallel consumers sharing the same point in time
+        (see `open_pit`), which must be released by the caller (see `close_pit`).
+
+        :param pit_id: id of the point in time
+        :param slice_id: id of the slice, from 0 to `max_slices` - 1
+        :param max_slices: number of slices
+        :param _filter: optional filter of data collected
+        :param ignore_incremental: if True, incremental collection is ignored
+        :param includes: list of fields of the items to get, None to get all of them
+        :param excludes: list of fields of the items not to get
+        """
+        source = self.__get_source(includes, excludes)
+        for _, items, _ in self.__get_pit_pages(pit_id, _filter=_filter, ignore_incremental=ignore_incremental,
+                                                slice_id=slice_id, max_slices=max_slices, source=source):
+            yield from items
+
+    def __fetch_sliced(self, pit_id, _filter=None, ignore_incremental=False, source=None):
+        """Fetch the pages of items reading `read_slices` slices of a point in
+        time concurrently. The pages read by the threads are merged in a single
+        generator, thus the items are sorted within each slice but not
+        globally. The point in time is released when the generator is
+        exhausted or closed."""
+
+        max_slices = self.read_slices
+        pages = queue.Queue(maxsize=2 * max_slices)
+        stop = threading.Event()
+
+        def read_slice(slice_id):
+            try:
+                for _, items, n_bytes in self.__get_pit_pages(pit_id, _filter=_filter,
+                                                              ignore_incremental=ignore_incremental,
+                                                              slice_id=slice_id, max_slices=max_slices,
+                                                              source=source):
+                    if not self.__put_page(pages, (items, n_bytes), stop):
+                        break
+            finally:
+                self.__put_page(pages, None, stop)
+
+        executor = ThreadPoolExecutor(max_workers=max_slices)
+        futures = [executor.submit(read_slice, slice_id) for slice_id in range(max_slices)]
+
+        try:
+            pending = max_slices
+            while pending:
+                page = pages.get()
+                if page is None:
+                    pending -= 1
+                    continue
+                yield page
+            # Raise the errors of the threads, if any
+            for future in futures:
+                future.result()
+        finally:
+            stop.set()
+            executor.shutdown(wait=True)
+            self.close_pit(pit_id)
+
+        logger.debug("Fetching from {}: done receiving {} slices".format(
+                     anonymize_url(self.elastic.index_url), max_slices))
+
+    @staticmethod
+    def __put_page(pages, items, stop):
+        """Add a page to the queue unless the reading was stopped"""
+
+        while not stop.is_set():
+            try:
+                pages.put(items, timeout=1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def __get_pit_pages(self, pit_id, _filter=None, ignore_incremental=False, slice_id=None, max_slices=None,
+                        source=None, search_after=None):
+        """Generator of the pages of items, paginating with search_after
+        on a point in time, from the first item or the one after `search_after`.
+        It returns the latest id of the point in time together with the items
+        of each page and the size in bytes of its response."""
+
+        page_size = self.get_page_size()
+        while True:
+            size = page_size.size if page_size else self.scroll_size
+            before = time.time()
+            page, n_bytes = self.__get_pit_page(pit_id, search_after=search_after, _filter=_filter,
+                                                ignore_incremental=ignore_incremental,
+                                                slice_id=slice_id, max_slices=max_slices, source=source,
+                                                size=size)
             if not page:
                 break
 
-            scroll_size = len(page['hits']['hits'])
+            # The id of the point in time may change between searches
+            pit_id = page.get('pit_id', pit_id)
+            hits = page['hits']['hits']
 
-        self.free_scroll(scroll_id)
-        logger.debug("Fetching from {}: done receiving".format(anonymize_url(self.elastic.index_url)))
+            if not hits:
+                if search_after is None:
+                    logger.debug("No results found from {} and filter {}".format(
+                                 anonymize_url(self.elastic.index_url), _filter))
+                break
 
-    def get_elastic_items(self, elastic_scroll_id=None, _filter=None, ignore_incremental=False):
+            if page_size:
+                page_size.update(len(hits), time.time() - before, n_bytes)
+
+            logger.debug("Fetching from {}: {} received".format(
+                         anonymize_url(self.elastic.index_url), len(hits)))
+            yield pit_id, [item['_source'] for item in hits], n_bytes
+
+            search_after = hits[-1]['sort']
+            if len(hits) < size:
+                break
+
+    def __get_search_after(self):
+        """Return the sort values of the item set with `set_search_after`"""
+
+        if not self.search_after:
+            return None
+
+        date, uuid = self.search_after
+        # Dates are sorted as milliseconds since the epoch
+        date = str_to_datetime(date)
+        millis = int(calendar.timegm(date.utctimetuple())) * 1000 + date.microsecond // 1000
+
+        return [millis, uuid]
+
+    def get_elastic_items(self, elastic_scroll_id=None, _filter=None, ignore_incremental=False, source=None):
         """Get the items from the index related to the backend applying and
         optional _filter if provided
 
         :param elastic_scroll_id: If not None, it allows to continue scrolling the data
         :param _filter: if not None, it allows to define a terms filter (e.g., "uuid": ["hash1", "hash2, ...]
         :param ignore_incremental: if True, incremental collection is ignored
+        :param source: if not None, `_source` param to get only some fields (e.g., {"includes": ["uuid"]})
+        """
+        rjson, _ = self.__get_scroll_page(elastic_scroll_id, _filter=_filter, ignore_incremental=ignore_incremental,
+                                          source=source)
+        return rjson
+
+    def __get_scroll_page(self, elastic_scroll_id=None, _filter=None, ignore_incremental=False, source=None):
+        """Get a page of items scrolling the index, see `get_elastic_items`.
+
+        :returns: the page and the size in bytes of the response
         """
         headers = {"Content-Type": "application/json"}
 
         if not self.elastic:
-            return None
+            return None, 0
         url = self.elastic.index_url
-        # 1 minute to process the results of size items
-        # In gerrit enrich with 500 items per page we need >1 min
-        # In Mozilla ES in Amazon we need 10m
-        max_process_items_pack_time = "10m"  # 10 minutes
-        url += "/_search?scroll=%s&size=%i" % (max_process_items_pack_time,
+        url += "/_search?scroll=%s&size=%i" % (MAX_PROCESS_ITEMS_PACK_TIME,
                                                self.scroll_size)
 
         if elastic_scroll_id:
@@ -275,57 +643,12 @@ class ElasticItems:
             url = self.elastic.url
             url += "/_search/scroll"
             scroll_data = {
-                "scroll": max_process_items_pack_time,
+                "scroll": MAX_PROCESS_ITEMS_PACK_TIME,
                 "scroll_id": elastic_scroll_id
             }
             query_data = json.dumps(scroll_data)
         else:
-            # If using a perceval backends always filter by repository
-            # to support multi repository indexes
-            filters_dict = self.get_repository_filter_raw(term=True)
-            if filters_dict:
-                filters = json.dumps(filters_dict)
-            else:
-                filters = ''
-
-            if self.filter_raw:
-                for fltr in self.filter_raw_dict:
-                    filters += '''
-                        , {"term":
-                            { "%s":"%s"  }
-                        }
-                    ''' % (fltr['name'], fltr['value'])
-
-            if _filter:
-                filter_str = '''
-                    , {"terms":
-                        { "%s": %s }
-                    }
-                ''' % (_filter['name'], _filter['value'])
-                # List to string conversion uses ' that are not allowed in JSON
-                filter_str = filter_str.replace("'", "\"")
-                filters += filter_str
-
-            # The code below performs the incremental enrichment based on the last value of `metadata__timestamp`
-            # in the enriched index, which is calculated in the TaskEnrich before enriching the single repos that
-            # belong to a given data source. The old implementation of the incremental enrichment, which consisted in
-            # collecting the last value of `metadata__timestamp` in the enriched index for each repo, didn't work
-            # for global data source (which are collected globally and only partially enriched).
-            if self.from_date and not ignore_incremental:
-                date_field = self.get_incremental_date()
-                from_date = self.from_date.isoformat()
-
-                filters += '''
-                    , {"range":
-                        {"%s": {"gte": "%s"}}
-                    }
-                ''' % (date_field, from_date)
-            elif self.offset and not ignore_incremental:
-                filters += '''
-                    , {"range":
-                        {"offset": {"gte": %i}}
-                    }
-                ''' % self.offset
+            filters = self.__get_query_filters(_filter=_filter, ignore_incremental=ignore_incremental)
 
             # Order the raw items from the old ones to the new so if the
             # enrich process fails, it could be resume incrementally
@@ -335,9 +658,8 @@ class ElasticItems:
                 order_field = self.get_incremental_date()
             if order_field is not None:
                 order_query = ', "sort": { "%s": { "order": "asc" }} ' % order_field
-
-            # Fix the filters string if it starts with "," (empty first filter)
-            filters = filters.lstrip()[1:] if filters.lstrip().startswith(',') else filters
+            if source:
+                order_query += ', "_source": %s ' % json.dumps(source)
 
             query = """
             {
@@ -354,18 +676,169 @@ class ElasticItems:
             query_data = query
 
         rjson = None
+        n_bytes = 0
         try:
-            res = self.requests.post(url, data=query_data, headers=headers)
+            with metrics.timer('fetch.search') as timer:
+                res = self.requests.post(url, data=query_data, headers=headers)
+                timer.add_bytes(len(res.content))
             if self.too_many_scrolls(res):
-                return {'too_many_scrolls': True}
+                return {'too_many_scrolls': True}, 0
             res.raise_for_status()
+            n_bytes = len(res.content)
             rjson = res.json()
         except Exception:
             # The index could not exists yet or it could be empty
             logger.debug("No results found from {}".format(anonymize_url(url)))
 
+        return rjson, n_bytes
+
+    def get_elastic_items_pit(self, pit_id, search_after=None, _filter=None, ignore_incremental=False,
+                              slice_id=None, max_slices=None, source=None, size=None):
+        """Get a page of items from a point in time of the index related to the
+        backend applying and optional _filter if provided. The items are sorted
+        by `metadata__timestamp` and their unique id (see `get_field_unique_id`),
+        so the sort values of the last item of a page are used to get the next one.
+
+        :param pit_id: id of the point in time
+        :param search_after: sort values of the last item of the previous page
+        :param _filter: if not None, it allows to define a terms filter (e.g., "uuid": ["hash1", "hash2, ...]
+        :param ignore_incremental: if True, incremental collection is ignored
+        :param slice_id: if not None, id of the slice of the point in time to get
+        :param max_slices: number of slices of the point in time
+        :param source: if not None, `_source` param to get only some fields (e.g., {"includes": ["uuid"]})
+        :param size: number of items of the page, if None `scroll_size` is used
+        """
+        rjson, _ = self.__get_pit_page(pit_id, search_after=search_after, _filter=_filter,
+                                       ignore_incremental=ignore_incremental, slice_id=slice_id,
+                                       max_slices=max_slices, source=source, size=size)
         return rjson
 
+    def __get_pit_page(self, pit_id, search_after=None, _filter=None, ignore_incremental=False,
+                       slice_id=None, max_slices=None, source=None, size=None):
+        """Get a page of items from a point in time, see `get_elastic_items_pit`.
+
+        :returns: the page and the size in bytes of the response
+        """
+        if not self.elastic:
+            return None, 0
+
+        url = self.elastic.url + "/_search"
+        filters = self.__get_query_filters(_filter=_filter, ignore_incremental=ignore_incremental)
+
+        query = json.loads('{"bool": {"filter": [%s]}}' % filters)
+        # Order the raw items from the old ones to the new so if the
+        # enrich process fails, it could be resume incrementally. The unique
+        # id breaks the ties, several enriched items can share the uuid
+        sort = [
+            {self.get_incremental_date(): {"order": "asc", "unmapped_type": "date"}},
+            {self.get_field_unique_id(): {"order": "asc", "unmapped_type": "keyword"}}
+        ]
+
+        search = {
+            "size": size if size else self.scroll_size,
+            "query": query,
+            "pit": {
+                "id": pit_id,
+                "keep_alive": MAX_PROCESS_ITEMS_PACK_TIME
+            },
+            "sort": sort,
+            "track_total_hits": False
+        }
+        if source:
+            search["_source"] = source
+        if slice_id is not None and max_slices and max_slices > 1:
+            search["slice"] = {
+                "id": slice_id,
+                "max": max_slices
+            }
+        if search_after:
+            search["search_after"] = search_after
+        else:
+            logger.debug("Raw query to {}\n{}".format(anonymize_url(url), json.dumps(search, indent=4)))
+
+        try:
+            with metrics.timer('fetch.search') as timer:
+                res = self.requests.post(url, data=json.dumps(search), headers=HEADER_JSON)
+                timer.add_bytes(len(res.content))
+            res.raise_for_status()
+            n_bytes = len(res.content)
+            rjson = res.json()
+        except Exception as e:
+            # The point in time exists, so an error would silently end the fetch
+            logger.error("Error fetching a page from {}, search_after={}: {}".format(
+                         anonymize_url(self.elastic.index_url), search_after, e))
+            raise
+
+        return rjson, n_bytes
+
+    def __get_query_filters(self, _filter=None, ignore_incremental=False):
+        """Build the filters of the query to get the items, as a str with
+        a list of JSON filters.
+
+        :param _filter: if not None, it allows to define a terms filter (e.g., "uuid": ["hash1", "hash2, ...],
+            or a list of fields (e.g., ["author_uuid", "committer_uuid"]) to match any of them
+        :param ignore_incremental: if True, incremental collection is ignored
+        """
+        # If using a perceval backends always filter by repository
+        # to support multi repository indexes
+        filters_dict = self.get_repository_filter_raw(term=True)
+        if filters_dict:
+            filters = json.dumps(filters_dict)
+        else:
+            filters = ''
+
+        if self.filter_raw:
+            for fltr in self.filter_raw_dict:
+                filters += '''
+                    , {"term":
+                        { "%s":"%s"  }
+                    }
+                ''' % (fltr['name'], fltr['value'])
+
+        if _filter:
+            # The items matching the values in any of the fields when there are several of them
+            names = _filter['name'] if isinstance(_filter['name'], list) else [_filter['name']]
+            terms = [{"terms": {name: _filter['value']}} for name in names]
+            if len(terms) > 1:
+                filters += ", " + json.dumps({"bool": {"should": terms, "minimum_should_match": 1}})
+            else:
+                filters += ", " + json.dumps(terms[0])
+
+        # The code below performs the incremental enrichment based on the last value of `metadata__timestamp`
+        # in the enriched index, which is calculated in the TaskEnrich before enriching the single repos that
+        # belong to a given data source. The old implementation of the incremental enrichment, which consisted in
+        # collecting the last value of `metadata__timestamp` in the enriched index for each repo, didn't work
+        # for global data source (which are collected globally and only partially enriched).
+        if self.from_date and not ignore_incremental:
+            date_field = self.get_incremental_date()
+            from_date = self.from_date.isoformat()
+
+            filters += '''
+                , {"range":
+                    {"%s": {"gte": "%s"}}
+                }
+            ''' % (date_field, from_date)
+        elif self.offset and not ignore_incremental:
+            filters += '''
+                , {"range":
+                    {"offset": {"gte": %i}}
+                }
+            ''' % self.offset
+
+        # Items from the date of the item after which the fetch is resumed (see `set_search_after`),
+        # the items with the same date are skipped with search_after when paginating with a point in time
+        if self.search_after and not ignore_incremental:
+            filters += '''
+                , {"range":
+                    {"%s": {"gte": "%s"}}
+                }
+            ''' % (self.get_incremental_date(), self.search_after[0])
+
+        # Fix the filters string if it starts with "," (empty first filter)
+        filters = filters.lstrip()[1:] if filters.lstrip().startswith(',') else filters
+
+        return filters
+
     def too_many_scrolls(self, res):
         """Check if result conatins 'too many scroll contexts' error"""
         r = res.json()
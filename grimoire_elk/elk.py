@@ -21,6 +21,7 @@
 
 import inspect
 import logging
+from datetime import timedelta
 
 from elasticsearch import Elasticsearch
 
@@ -28,14 +29,24 @@ from perceval.backend import find_signature_parameters, Archive
 from perceval.errors import RateLimitError
 from grimoirelab_toolkit.datetime import (datetime_utcnow, str_to_datetime)
 
+from .checkpoint import Checkpoint, ESCheckpointStore, FileCheckpointStore
 from .elastic_mapping import Mapping as BaseMapping
 from .elastic_items import ElasticItems
+from .enriched.enrich import CUSTOM_META_PREFIX
+from .enriched.identities_cache import identities_cache
 from .enriched.sortinghat_gelk import SortingHat
+from .files import ElasticSearchFile
+from .metrics import metrics
 from .enriched.utils import get_last_enrich, grimoire_con, get_diff_current_date, anonymize_url
 from .utils import get_connectors, get_connector_from_name, get_elastic
 
 IDENTITIES_INDEX = "grimoirelab_identities_cache"
 SIZE_SCROLL_IDENTITIES_INDEX = 1000
+LOAD_IDENTITIES_BATCH = 1000  # new identities added to SortingHat in a single transaction
+# Checkpoint with the date of the last refresh of the identities of an enriched index
+REFRESH_IDENTITIES_ORIGIN = 'sortinghat:refresh_identities'
+# Changes in SortingHat done this time before the last refresh are refreshed again
+REFRESH_IDENTITIES_MARGIN = timedelta(minutes=5)
 
 logger = logging.getLogger(__name__)
 
@@ -55,6 +66,9 @@ def feed_backend(url, clean, fetch_archive, backend_name, backend_params,
     if es_index:
         clean = False  # don't remove index, it could be shared
 
+    # the index is fully rebuilt, tune it for bulk loading
+    bulk_load = clean
+
     if not get_connector_from_name(backend_name):
         raise RuntimeError("Unknown backend {}".format(backend_name))
     connector = get_connector_from_name(backend_name)
@@ -159,7 +173,8 @@ def feed_backend(url, clean, fetch_archive, backend_name, backend_params,
         if offset:
             params['from_offset'] = offset
 
-        ocean_backend.feed(**params)
+        with elastic_ocean.bulk_load(enabled=bulk_load), metrics.timer('feed.feed'):
+            ocean_backend.feed(**params)
 
     except RateLimitError as ex:
         logger.error("Error feeding raw from {} ({}): rate limit exceeded".format(backend_name, backend.origin))
@@ -171,24 +186,55 @@ def feed_backend(url, clean, fetch_archive, backend_name, backend_params,
         else:
             error_msg = "Error feeding raw from {}".format(ex)
             logger.error(error_msg, exc_info=True)
+    finally:
+        metrics.end_run('feed', backend_name)
 
     logger.info("[{}] Done collection for {}".format(backend_name, anonymize_url(backend.origin)))
     return error_msg
 
 
+def get_changed_fields(eitem, fields):
+    """Get the fields whose values are not the ones in an enriched item
+
+    :param eitem: enriched item, or some of its fields
+    :param fields: dict with the new values of some fields
+    :returns: dict with the fields changed
+    """
+    return {field: value for field, value in fields.items()
+            if field not in eitem or eitem[field] != value}
+
+
 def refresh_projects(enrich_backend):
+    """Refresh the project fields in enriched index.
+
+    Only the fields needed to find the project of the items are fetched,
+    and the partial documents returned have just the unique id and the
+    project fields changed (see `ElasticSearch.bulk_update`). The items
+    whose project fields did not change are skipped.
+
+    :param enrich_backend: enriched backend to update
+    """
     logger.debug("Refreshing project field in {}".format(
                  anonymize_url(enrich_backend.elastic.index_url)))
     total = 0
+    unchanged = 0
+
+    field_id = enrich_backend.get_field_unique_id()
+    includes = [field_id, 'project', 'project_*', CUSTOM_META_PREFIX + '_*'] + enrich_backend.get_project_fields()
 
-    eitems = enrich_backend.fetch()
+    eitems = enrich_backend.fetch(includes=includes)
     for eitem in eitems:
         new_project = enrich_backend.get_item_project(eitem)
-        eitem.update(new_project)
-        yield eitem
         total += 1
+        changed = get_changed_fields(eitem, new_project)
+        if not changed:
+            unchanged += 1
+            continue
+        changed[field_id] = eitem[field_id]
+        yield changed
 
-    logger.debug("Total eitems refreshed for project field {}".format(total))
+    metrics.incr('enrich.refresh_unchanged', unchanged)
+    logger.debug("Total eitems refreshed for project field {}, {} unchanged".format(total, unchanged))
 
 
 def refresh_identities(enrich_backend, author_field=None, author_values=None):
@@ -201,28 +247,45 @@ def refresh_identities(enrich_backend, author_field=None, author_values=None):
     Instead of the whole index, only items matching the filter_author
     filter are fitered, if that parameters is not None.
 
+    Only the identities fields of the roles are fetched, and the partial
+    documents returned have just the unique id and the identities fields
+    changed (see `ElasticSearch.bulk_update`). The items whose identities
+    did not change are skipped.
+
     :param enrich_backend: enriched backend to update
-    :param  author_field: field to match items authored by a user
+    :param  author_field: field, or list of fields, to match items authored by a user
     :param  author_values: values of the authored field to match items
     """
 
     def update_items(new_filter_author):
+        nonlocal unchanged
 
-        for eitem in enrich_backend.fetch(new_filter_author):
-            roles = None
-            try:
-                roles = enrich_backend.roles
-            except AttributeError:
-                pass
-
+        for eitem in enrich_backend.fetch(new_filter_author, includes=includes):
             new_identities = enrich_backend.get_item_sh_from_id(eitem, roles)
-            eitem.update(new_identities)
-            yield eitem
+            changed = get_changed_fields(eitem, new_identities)
+            if not changed:
+                unchanged += 1
+                continue
+            changed[field_id] = eitem[field_id]
+            yield changed
 
     logger.debug("Refreshing identities fields from {}".format(
                  anonymize_url(enrich_backend.elastic.index_url)))
 
     total = 0
+    unchanged = 0
+
+    roles = None
+    try:
+        roles = enrich_backend.roles
+    except AttributeError:
+        pass
+
+    field_id = enrich_backend.get_field_unique_id()
+    includes = [field_id, enrich_backend.get_field_date()]
+    for rol in (roles or [enrich_backend.get_field_author()]) + ['author']:
+        if rol and rol + '_*' not in includes:
+            includes.append(rol + '_*')
 
     max_ids = enrich_backend.elastic.max_items_clause
     logger.debug('Refreshing identities')
@@ -255,20 +318,75 @@ def refresh_identities(enrich_backend, author_field=None, author_values=None):
                 yield item
                 total += 1
 
-    logger.debug("Total eitems refreshed for identities fields {}".format(total))
+    metrics.incr('enrich.refresh_unchanged', unchanged)
+    logger.debug("Total eitems refreshed for identities fields {}, {} unchanged".format(total, unchanged))
+
+
+def get_modified_identities_filter(enrich_backend, store, enrich_index):
+    """Get the fields and values to filter the enriched items of the identities
+    and unique identities modified (e.g., merged, enrolled or with the profile
+    edited) in SortingHat since the last refresh of the identities of the index.
+
+    The items match if any of the SortingHat ids or uuids of their roles is
+    one of the modified ones. The last refresh is read from the checkpoint
+    `REFRESH_IDENTITIES_ORIGIN` of the index in `store`.
+
+    :param enrich_backend: enriched backend to update
+    :param store: CheckpointStore with the date of the last refresh
+    :param enrich_index: name of the enriched index
+    :returns: tuple (list of fields, list of values), (None, None) if the identities were never refreshed
+    """
+    last_refresh = store.get(enrich_index, REFRESH_IDENTITIES_ORIGIN)
+    if not last_refresh:
+        return None, None
+
+    after = str_to_datetime(last_refresh[0]).replace(tzinfo=None)
+    sh_ids, uuids = SortingHat.get_modified_identities(enrich_backend.sh_db, after)
+
+    roles = [enrich_backend.get_field_author(), 'author'] + (getattr(enrich_backend, 'roles', None) or [])
+    fields = []
+    for rol in roles:
+        for field in [rol + '_id', rol + '_uuid']:
+            if field not in fields:
+                fields.append(field)
+
+    values = sorted(set(sh_ids) | set(uuids))
+
+    logger.info("{} identities and {} unique identities modified in SortingHat since {}".format(
+                len(sh_ids), len(uuids), last_refresh[0]))
+    return fields, values
 
 
 def load_identities(ocean_backend, enrich_backend):
+    """Add to SortingHat the identities of the raw items not found in it.
+
+    The identities are de-duplicated by the id they have in SortingHat,
+    and the ones already in SortingHat (read with a single query) are not
+    sent again. The new identities are added in batches of
+    `LOAD_IDENTITIES_BATCH`, each one in a single transaction.
+
+    :param ocean_backend: raw backend, or a list of raw items
+    :param enrich_backend: enricher with SortingHat enabled
+    :return: number of identities added
+    """
     # First we add all new identities to SH
     items_count = 0
     identities_count = 0
     new_identities = []
+    connector_name = enrich_backend.get_connector_name()
+
+    # Ids of the identities in SortingHat or already sent to it. The
+    # identities with a company are sent once per run, to enroll them.
+    with metrics.timer('sortinghat.known_identities'):
+        known_identities = SortingHat.get_identities_ids(enrich_backend.sh_db, connector_name)
+    n_known = len(known_identities)
 
     # Support that ocean_backend is a list of items (old API)
     if isinstance(ocean_backend, list):
         items = ocean_backend
     else:
-        items = ocean_backend.fetch()
+        items = ocean_backend.fetch(includes=enrich_backend.RAW_FIELDS_INCLUDES,
+                                    excludes=enrich_backend.RAW_FIELDS_EXCLUDES)
 
     for item in items:
         items_count += 1
@@ -279,14 +397,22 @@ def load_identities(ocean_backend, enrich_backend):
             continue
 
         for identity in identities:
-            if identity not in new_identities:
-                new_identities.append(identity)
+            sh_id = SortingHat.get_identity_id(identity, connector_name)
+            if not sh_id:
+                continue
+            company = identity.get('company', None)
+            key = sh_id if company is None else (sh_id, company)
+            if key in known_identities:
+                continue
+
+            known_identities.add(key)
+            new_identities.append(identity)
 
-            if len(new_identities) > 100:
+            if len(new_identities) >= LOAD_IDENTITIES_BATCH:
                 inserted_identities = load_bulk_identities(items_count,
                                                            new_identities,
                                                            enrich_backend.sh_db,
-                                                           enrich_backend.get_connector_name())
+                                                           connector_name)
                 identities_count += inserted_identities
                 new_identities = []
 
@@ -294,16 +420,21 @@ def load_identities(ocean_backend, enrich_backend):
         inserted_identities = load_bulk_identities(items_count,
                                                    new_identities,
                                                    enrich_backend.sh_db,
-                                                   enrich_backend.get_connector_name())
+                                                   connector_name)
         identities_count += inserted_identities
 
+    logger.debug("{} identities already in SortingHat, {} new identities added from {} items of {}".format(
+                 n_known, identities_count, items_count, connector_name))
+    metrics.incr('sortinghat.identities_added', identities_count)
+
     return identities_count
 
 
 def load_bulk_identities(items_count, new_identities, sh_db, connector_name):
     identities_count = len(new_identities)
 
-    SortingHat.add_identities(sh_db, new_identities, connector_name)
+    with metrics.timer('sortinghat.add_identities'):
+        SortingHat.add_new_identities(sh_db, new_identities, connector_name)
 
     logger.debug("Processed {} items identities ({} identities) from {}".format(
                  items_count, len(new_identities), connector_name))
@@ -314,14 +445,30 @@ def load_bulk_identities(items_count, new_identities, sh_db, connector_name):
 def enrich_items(ocean_backend, enrich_backend, events=False):
     total = 0
 
-    if not events:
-        total = enrich_backend.enrich_items(ocean_backend)
+    # Get from the raw index only the fields read by the enricher
+    ocean_backend.set_source_fields(enrich_backend.RAW_FIELDS_INCLUDES, enrich_backend.RAW_FIELDS_EXCLUDES)
+    try:
+        if not events:
+            total = enrich_backend.enrich_items(ocean_backend)
+        else:
+            total = enrich_backend.enrich_events(ocean_backend)
+    finally:
+        ocean_backend.set_source_fields()
+
+    enrich_backend.elastic.refresh_index()
+    if not events and not is_file_mode(ocean_backend, enrich_backend):
         enrich_backend.update_items(ocean_backend, enrich_backend)
-    else:
-        total = enrich_backend.enrich_events(ocean_backend)
     return total
 
 
+def is_file_mode(ocean_backend, enrich_backend):
+    """Check whether the raw items are read from a file or the enriched ones
+    are written to a file, thus the operations over the indexes which
+    follow the enrichment (e.g., update items, studies) can't be done."""
+
+    return bool(ocean_backend.raw_file) or isinstance(enrich_backend.elastic, ElasticSearchFile)
+
+
 def get_ocean_backend(backend_cmd, enrich_backend, no_incremental, filter_raw=None):
     """ Get the ocean backend configured to start from the last enriched date """
 
@@ -370,6 +517,53 @@ def get_ocean_backend(backend_cmd, enrich_backend, no_incremental, filter_raw=No
     return ocean_backend
 
 
+def get_checkpoint_store(enrich_backend):
+    """Get the store of checkpoints (file or index) of `enrich_backend`
+
+    :param enrich_backend: backend to access enriched items
+    :returns: a CheckpointStore object, None if checkpoints are not enabled
+    """
+    if enrich_backend.checkpoint_file:
+        return FileCheckpointStore(enrich_backend.checkpoint_file)
+    if enrich_backend.checkpoint_index:
+        major = getattr(enrich_backend.elastic, 'major', None)
+        return ESCheckpointStore(enrich_backend.elastic.url, enrich_backend.checkpoint_index, major=major)
+
+    return None
+
+
+def get_checkpoint(ocean_backend, enrich_backend, enrich_index, origin):
+    """Get the checkpoint of the enrichment of the raw items of `origin` into
+    `enrich_index`, stored in the checkpoints file or index of `enrich_backend`.
+
+    :param ocean_backend: backend to access raw items
+    :param enrich_backend: backend to access enriched items
+    :param enrich_index: name of the enriched index
+    :param origin: origin of the raw items
+    :returns: a Checkpoint object, None if checkpoints are not enabled
+    """
+    store = get_checkpoint_store(enrich_backend)
+    if not store:
+        return None
+
+    if is_file_mode(ocean_backend, enrich_backend):
+        # The raw items of a file are not sorted, and a file is always fully enriched
+        logger.warning("Checkpoints not available when reading or writing files")
+        return None
+
+    if not enrich_backend.supports_checkpoints():
+        logger.warning("Checkpoints not available for {}, its enrichment doesn't advance them".format(
+                       enrich_backend.get_connector_name()))
+        return None
+
+    if ocean_backend.read_slices > 1:
+        # The raw items are not globally sorted
+        logger.warning("Checkpoints not available when reading slices of the raw index")
+        return None
+
+    return Checkpoint(store, enrich_index, origin, interval=enrich_backend.checkpoint_interval)
+
+
 def do_studies(ocean_backend, enrich_backend, studies_args, retention_time=None):
     """Execute studies related to a given enrich backend. If `retention_time` is not None, the
     study data is deleted based on the number of minutes declared in `retention_time`.
@@ -419,17 +613,47 @@ def enrich_backend(url, clean, backend_name, backend_params, cfg_section_name,
                    jenkins_rename_file=None,
                    unaffiliated_group=None, pair_programming=False,
                    node_regex=False, studies_args=None, es_enrich_aliases=None,
-                   last_enrich_date=None, projects_json_repo=None, repo_labels=None):
-    """ Enrich Ocean index """
+                   last_enrich_date=None, projects_json_repo=None, repo_labels=None,
+                   rebuild=False, raw_file=None, enrich_out_file=None,
+                   refresh_modified_identities=False):
+    """ Enrich Ocean index
+
+    If `rebuild` is True, the items are enriched into a new version of the
+    enriched index, which replaces the current one once the enrichment succeeds.
+
+    If `raw_file` is set, the raw items are read from that file (NDJSON or
+    Perceval dump, optionally gzipped) instead of the raw index. If
+    `enrich_out_file` is set, the enriched items are written to that file
+    (NDJSON in bulk API format, gzipped if its name ends with .gz) instead
+    of the enriched index, thus the enrichment is not incremental.
+
+    If `refresh_modified_identities` is True, the refresh of the identities
+    updates only the items of the identities modified in SortingHat since
+    the last refresh, stored in the checkpoints file or index.
+    """
 
     backend = None
+    enrich_backend = None
     enrich_index = None
 
+    # all the raw items are enriched again
+    full_enrich = clean or no_incremental or rebuild
+
     if ocean_index or ocean_index_enrich:
         clean = False  # don't remove index, it could be shared
 
     if do_refresh_projects or do_refresh_identities:
         clean = False  # refresh works over the existing enriched items
+        rebuild = False
+
+    if enrich_out_file:
+        # No enriched index to get the last enrichment date from or to swap
+        no_incremental = True
+        rebuild = False
+
+    # the index is fully rebuilt, tune it for bulk loading. An index
+    # given explicitly is not tuned unless rebuilt, it could be shared
+    bulk_load = clean or rebuild or (no_incremental and not ocean_index_enrich)
 
     if not get_connector_from_name(backend_name):
         raise RuntimeError("Unknown backend {}".format(backend_name))
@@ -456,13 +680,21 @@ def enrich_backend(url, clean, backend_name, backend_params, cfg_section_name,
         enrich_backend = connector[2](db_sortinghat, db_projects_map, json_projects_map,
                                       db_user, db_password, db_host)
         enrich_backend.set_params(backend_params)
+        # The lookups cached by previous runs of the process could be stale (e.g.,
+        # after merges or enrollments done in SortingHat by other tools)
+        enrich_backend.sync_identities_cache()
         # store the cfg section name in the enrich backend to recover the corresponding project name in projects.json
         enrich_backend.set_cfg_section_name(cfg_section_name)
         enrich_backend.set_from_date(last_enrich_date)
-        if url_enrich:
-            elastic_enrich = get_elastic(url_enrich, enrich_index, clean, enrich_backend, es_enrich_aliases)
+        if enrich_out_file:
+            enrich_backend.set_elastic_url(url_enrich if url_enrich else url)
+            elastic_enrich = ElasticSearchFile(enrich_out_file, enrich_index, es_enrich_aliases)
+        elif url_enrich:
+            elastic_enrich = get_elastic(url_enrich, enrich_index, clean, enrich_backend, es_enrich_aliases,
+                                         rebuild=rebuild)
         else:
-            elastic_enrich = get_elastic(url, enrich_index, clean, enrich_backend, es_enrich_aliases)
+            elastic_enrich = get_elastic(url, enrich_index, clean, enrich_backend, es_enrich_aliases,
+                                         rebuild=rebuild)
         enrich_backend.set_elastic(elastic_enrich)
         if jenkins_rename_file and backend_name == "jenkins":
             enrich_backend.set_jenkins_rename_file(jenkins_rename_file)
@@ -484,13 +716,16 @@ def enrich_backend(url, clean, backend_name, backend_params, cfg_section_name,
 
         if only_studies:
             logger.info("Running only studies (no SH and no enrichment)")
-            do_studies(ocean_backend, enrich_backend, studies_args)
+            with metrics.timer('enrich.studies'):
+                do_studies(ocean_backend, enrich_backend, studies_args)
         elif do_refresh_projects:
             logger.info("Refreshing project field in {}".format(
                         anonymize_url(enrich_backend.elastic.index_url)))
             field_id = enrich_backend.get_field_unique_id()
             eitems = refresh_projects(enrich_backend)
-            enrich_backend.elastic.bulk_upload(eitems, field_id)
+            with metrics.timer('enrich.refresh_projects'):
+                enrich_backend.elastic.bulk_update(eitems, field_id)
+            enrich_backend.elastic.refresh_index()
         elif do_refresh_identities:
 
             author_attr = None
@@ -502,23 +737,60 @@ def enrich_backend(url, clean, backend_name, backend_params, cfg_section_name,
                 author_attr = 'author_uuid'
                 author_values = [author_uuid]
 
+            refresh_store = None
+            refresh_started = None
+            if refresh_modified_identities and not author_attr:
+                refresh_store = get_checkpoint_store(enrich_backend)
+                if refresh_store:
+                    refresh_started = datetime_utcnow() - REFRESH_IDENTITIES_MARGIN
+                    author_attr, author_values = get_modified_identities_filter(enrich_backend, refresh_store,
+                                                                                enrich_index)
+                else:
+                    logger.warning("Refreshing the identities modified needs a checkpoints file or index, "
+                                   "refreshing all of them")
+
             logger.info("Refreshing identities fields in {}".format(
                         anonymize_url(enrich_backend.elastic.index_url)))
 
+            enrich_backend.load_identities_cache()
+            enrich_backend.load_identities_snapshot()
             field_id = enrich_backend.get_field_unique_id()
             eitems = refresh_identities(enrich_backend, author_attr, author_values)
-            enrich_backend.elastic.bulk_upload(eitems, field_id)
+            with metrics.timer('enrich.refresh_identities'):
+                enrich_backend.elastic.bulk_update(eitems, field_id)
+            enrich_backend.elastic.refresh_index()
+            if refresh_store:
+                refresh_store.set(enrich_index, REFRESH_IDENTITIES_ORIGIN, refresh_started.isoformat(), None)
         else:
             clean = False  # Don't remove ocean index when enrich
-            elastic_ocean = get_elastic(url, ocean_index, clean, ocean_backend)
-            ocean_backend.set_elastic(elastic_ocean)
+            if raw_file:
+                ocean_backend.set_elastic_url(url)
+                ocean_backend.set_raw_file(raw_file)
+            else:
+                elastic_ocean = get_elastic(url, ocean_index, clean, ocean_backend)
+                ocean_backend.set_elastic(elastic_ocean)
 
             logger.debug("Adding enrichment data to {}".format(
                          anonymize_url(enrich_backend.elastic.index_url)))
 
+            origin = anonymize_url(backend.origin) if backend else backend_name
+            if filter_raw:
+                origin += " --filter-raw=" + filter_raw
+            checkpoint = get_checkpoint(ocean_backend, enrich_backend, enrich_index, origin)
+            if checkpoint and full_enrich:
+                # All the raw items are enriched again
+                checkpoint.reset()
+            elif checkpoint:
+                last_item = checkpoint.get()
+                if last_item:
+                    logger.info("Resuming enrichment of {} after {} ({})".format(
+                                origin, last_item[1], last_item[0]))
+                    ocean_backend.set_search_after(*last_item)
+
             if db_sortinghat and enrich_backend.has_identities():
                 # FIXME: This step won't be done from enrich in the future
-                total_ids = load_identities(ocean_backend, enrich_backend)
+                with metrics.timer('enrich.load_identities'):
+                    total_ids = load_identities(ocean_backend, enrich_backend)
                 logger.debug("Total identities loaded {} ".format(total_ids))
 
             if only_identities:
@@ -526,16 +798,25 @@ def enrich_backend(url, clean, backend_name, backend_params, cfg_section_name,
 
             else:
                 # Enrichment for the new items once SH update is finished
-                if not events_enrich:
-                    enrich_count = enrich_items(ocean_backend, enrich_backend)
-                    if enrich_count is not None:
-                        logger.debug("Total items enriched {} ".format(enrich_count))
-                else:
-                    enrich_count = enrich_items(ocean_backend, enrich_backend, events=True)
-                    if enrich_count is not None:
-                        logger.debug("Total events enriched {} ".format(enrich_count))
-                if studies:
-                    do_studies(ocean_backend, enrich_backend, studies_args)
+                enrich_backend.load_identities_cache()
+                enrich_backend.load_identities_snapshot()
+                enrich_backend.set_checkpoint(checkpoint)
+                with enrich_backend.elastic.bulk_load(enabled=bulk_load), metrics.timer('enrich.enrich_items'):
+                    if not events_enrich:
+                        enrich_count = enrich_items(ocean_backend, enrich_backend)
+                        if enrich_count is not None:
+                            logger.debug("Total items enriched {} ".format(enrich_count))
+                    else:
+                        enrich_count = enrich_items(ocean_backend, enrich_backend, events=True)
+                        if enrich_count is not None:
+                            logger.debug("Total events enriched {} ".format(enrich_count))
+                if rebuild:
+                    enrich_backend.elastic.swap_aliases()
+                if studies and is_file_mode(ocean_backend, enrich_backend):
+                    logger.warning("Studies not executed, they need the raw and enriched indexes")
+                elif studies:
+                    with metrics.timer('enrich.studies'):
+                        do_studies(ocean_backend, enrich_backend, studies_args)
 
     except Exception as ex:
         if backend:
@@ -543,6 +824,13 @@ def enrich_backend(url, clean, backend_name, backend_params, cfg_section_name,
                          backend_name, anonymize_url(backend.origin), ex), exc_info=True)
         else:
             logger.error("Error enriching raw {}".format(ex), exc_info=True)
+    finally:
+        if enrich_backend and isinstance(enrich_backend.elastic, ElasticSearchFile):
+            enrich_backend.elastic.close()
+        if enrich_backend:
+            enrich_backend.save_identities_cache()
+        identities_cache.end_run('enrich', backend_name)
+        metrics.end_run('enrich', backend_name)
 
     logger.info("[{}] Done enrichment for {}".format(backend_name, anonymize_url(backend.origin)))
 
@@ -814,7 +1102,7 @@ def populate_identities_index(es_enrichment_url, enrich_index):
     logger.debug("[identities-index] Start adding identities to {}".format(IDENTITIES_INDEX))
 
     identities = []
-    for eitem in enriched_items.fetch(ignore_incremental=True):
+    for eitem in enriched_items.fetch(ignore_incremental=True, includes=sh_uuid_attributes):
         for sh_uuid_attr in sh_uuid_attributes:
 
             if sh_uuid_attr not in eitem:
@@ -837,4 +1125,6 @@ def populate_identities_index(es_enrichment_url, enrich_index):
     if len(identities) > 0:
         elastic_identities.bulk_upload(identities, 'sh_uuid')
 
+    elastic_identities.refresh_index()
+
     logger.debug("[identities-index] End adding identities to {}".format(IDENTITIES_INDEX))
@@ -62,6 +62,7 @@ class Mapping(BaseMapping):
 class BugzillaRESTEnrich(Enrich):
 
     mapping = Mapping
+    RAW_FIELDS_EXCLUDES = ["data.attachments"]
     roles = ['assigned_to_detail', 'qa_contact_detail', 'creator_detail']
 
     def get_field_author(self):
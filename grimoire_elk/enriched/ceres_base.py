@@ -21,12 +21,15 @@
 
 import logging
 from collections import namedtuple
+from time import time
 from grimoirelab_toolkit import datetime
 
 from elasticsearch import helpers
 from elasticsearch.exceptions import NotFoundError
 from elasticsearch_dsl import Search
 
+from .utils import AdaptivePageSize
+
 
 logger = logging.getLogger(__name__)
 
@@ -142,14 +145,21 @@ class ESConnector(Connector):
     :param self._es_conn: ElasticSearch connection for reading from/writing to.
     :param self._es_index: ElasticSearch index for reading from/writing to.
     :param self._sort_on_field: date field to sort results, important for incremental process.
+    :param self._unique_field: field with the unique id of the items, to break ties when sorting them.
     :param self._read_only: True to avoid unwanted writes.
     """
 
-    def __init__(self, es_conn, es_index, sort_on_field='metadata__timestamp', repo=None, read_only=True):
+    # Read the blocks with search_after adapting the size of the pages to the latency of the
+    # responses. Otherwise, the items are read with the scroll API in pages of fixed size
+    adaptive_page_size = False
+
+    def __init__(self, es_conn, es_index, sort_on_field='metadata__timestamp', repo=None, read_only=True,
+                 unique_field='uuid'):
 
         self._es_conn = es_conn
         self._es_index = es_index
         self._sort_on_field = sort_on_field
+        self._unique_field = unique_field
         self._repo = repo
         self._read_only = read_only
         self.__log_prefix = "[" + es_index + "] study "
@@ -186,11 +196,7 @@ class ESConnector(Connector):
         """
         search_query = self._build_search_query(from_date)
         hits_block = []
-        for hit in helpers.scan(self._es_conn,
-                                search_query,
-                                scroll='300m',
-                                index=self._es_index,
-                                preserve_order=True):
+        for hit in self._read_hits(search_query):
 
             hits_block.append(hit)
 
@@ -203,6 +209,43 @@ class ESConnector(Connector):
         if len(hits_block) > 0:
             yield hits_block
 
+    def _read_hits(self, search_query, size=1000):
+        """Read the hits of a search query, sorted by `_sort_on_field`.
+
+        :param search_query: JSON query in dict format
+        :param size: number of hits of each page, initial one when the page size is adaptive
+        :return: next single hit when any available.
+        """
+        if not self.adaptive_page_size:
+            yield from helpers.scan(self._es_conn,
+                                    search_query,
+                                    scroll='300m',
+                                    size=size,
+                                    index=self._es_index,
+                                    preserve_order=True)
+            return
+
+        search_query = dict(search_query)
+        # The unique id is used to break ties between items with the same date
+        search_query['sort'] = search_query['sort'] + [{self._unique_field: {"order": "asc",
+                                                                             "unmapped_type": "keyword"}}]
+
+        page_size = AdaptivePageSize(size, target_bytes=None, name='ceres')
+        while True:
+            size = page_size.size
+            before = time()
+            response = self._es_conn.search(index=self._es_index, body=search_query, size=size)
+            hits = response['hits']['hits']
+            page_size.update(len(hits), time() - before)
+
+            yield from hits
+
+            if len(hits) < size:
+                break
+            search_query['search_after'] = hits[-1]['sort']
+
+        logger.debug("{} read {} items in {} pages".format(self.__log_prefix, page_size.items, page_size.pages))
+
     def write(self, items):
         """Upload items to ElasticSearch.
 
@@ -57,6 +57,7 @@ class Mapping(BaseMapping):
 class ConfluenceEnrich(Enrich):
 
     mapping = Mapping
+    RAW_FIELDS_EXCLUDES = ["data.body"]
 
     def get_field_author(self):
         return 'by'
@@ -70,6 +71,9 @@ class ConfluenceEnrich(Enrich):
     def get_project_repository(self, eitem):
         return str(eitem['space'])
 
+    def get_project_fields(self):
+        return ['origin', 'space']
+
     def get_users_data(self, item):
         """ If user fields are inside the global item dict """
         if 'data' in item:
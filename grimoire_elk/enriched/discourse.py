@@ -25,8 +25,7 @@ from ..elastic_mapping import Mapping as BaseMapping
 from .utils import get_time_diff_days, grimoire_con
 
 from .enrich import Enrich, metadata
-
-MAX_SIZE_BULK_ENRICHED_ITEMS = 200
+from ..elastic import BulkWriter
 
 
 logger = logging.getLogger(__name__)
@@ -95,6 +94,9 @@ class DiscourseEnrich(Enrich):
     def get_project_repository(self, eitem):
         return str(eitem['category_id'])
 
+    def get_project_fields(self):
+        return ['origin', 'category_id']
+
     def get_users_data(self, post):
         """ Adapt the data to be used with standard SH enrich API """
         poster = {}
@@ -277,27 +279,18 @@ class DiscourseEnrich(Enrich):
         return "id"
 
     def enrich_items(self, ocean_backend):
-        items_to_enrich = []
-        num_items = 0
-        ins_items = 0
+        writer = BulkWriter(self.elastic)
 
         for item in ocean_backend.fetch():
             eitem = self.get_rich_item(item)
-            items_to_enrich.append(eitem)
+            writer.add(eitem, eitem[self.get_field_unique_id()])
 
             rich_item_answers = self.get_rich_item_answers(item)
-            items_to_enrich.extend(rich_item_answers)
-
-            if len(items_to_enrich) < MAX_SIZE_BULK_ENRICHED_ITEMS:
-                continue
-
-            num_items += len(items_to_enrich)
-            ins_items += self.elastic.bulk_upload(items_to_enrich, self.get_field_unique_id())
-            items_to_enrich = []
+            writer.add_items(rich_item_answers, self.get_field_unique_id())
 
-        if len(items_to_enrich) > 0:
-            num_items += len(items_to_enrich)
-            ins_items += self.elastic.bulk_upload(items_to_enrich, self.get_field_unique_id())
+        writer.flush()
+        num_items = writer.total_items
+        ins_items = writer.total
 
         if num_items != ins_items:
             missing = num_items - ins_items
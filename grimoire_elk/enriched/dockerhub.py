@@ -19,11 +19,10 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
 import logging
-import sys
 
 from .enrich import Enrich, metadata, anonymize_url
+from ..elastic import BulkWriter
 from ..elastic_mapping import Mapping as BaseMapping
 
 
@@ -123,33 +122,16 @@ class DockerHubEnrich(Enrich):
         events from raw items, a image item with the last data for an image
         must be created """
 
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        total = 0
-        bulk_json = ""
-
         items = ocean_backend.fetch()
         images_items = {}
 
-        url = self.elastic.get_bulk_url()
+        writer = BulkWriter(self.elastic)
 
-        logger.debug("[dockerhub] Adding items to {} (in {} packs)".format(anonymize_url(url), max_items))
+        logger.debug("[dockerhub] Adding items to {}".format(anonymize_url(writer.url)))
 
         for item in items:
-            if current >= max_items:
-                total += self.elastic.safe_put_bulk(url, bulk_json)
-                json_size = sys.getsizeof(bulk_json) / (1024 * 1024)
-                logger.debug("[dockerhub] Added {} items to {} ({:.2f} MB)".format(
-                             total, anonymize_url(url), json_size))
-                bulk_json = ""
-                current = 0
-
             rich_item = self.get_rich_item(item)
-            data_json = json.dumps(rich_item)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                (item[self.get_field_unique_id()])
-            bulk_json += data_json + "\n"  # Bulk document
-            current += 1
+            writer.add(rich_item, item[self.get_field_unique_id()])
 
             if rich_item['id'] not in images_items:
                 # Let's transform the rich_event in a rich_image
@@ -164,22 +146,18 @@ class DockerHubEnrich(Enrich):
                     rich_item['is_event'] = 0
                     images_items[rich_item['id']] = rich_item
 
-        if current > 0:
-            total += self.elastic.safe_put_bulk(url, bulk_json)
+        writer.flush()
 
-        if total == 0:
+        if writer.total == 0:
             # No items enriched, nothing to upload to ES
-            return total
+            return writer.total
 
         # Time to upload the images enriched items. The id is uuid+"_image"
         # Normally we are enriching events for a unique image so all images
         # data can be upload in one query
         for image in images_items:
             data = images_items[image]
-            data_json = json.dumps(data)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                (data['id'] + "_image")
-            bulk_json += data_json + "\n"  # Bulk document
+            writer.add(data, data['id'] + "_image")
 
-        total += self.elastic.safe_put_bulk(url, bulk_json)
-        return total
+        writer.flush()
+        return writer.total
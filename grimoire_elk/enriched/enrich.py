@@ -19,17 +19,18 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
+import copy
 import json
 import functools
 import logging
+import multiprocessing
 import requests
-import sys
 
+from collections import deque
 from datetime import timedelta
 from dateutil.relativedelta import relativedelta
 
 import pkg_resources
-from functools import lru_cache
 
 from elasticsearch import Elasticsearch as ES, RequestsHttpConnection
 from geopy.geocoders import Nominatim
@@ -37,16 +38,18 @@ from geopy.geocoders import Nominatim
 from perceval.backend import find_signature_parameters
 from grimoirelab_toolkit.datetime import (datetime_utcnow, str_to_datetime)
 
-from ..elastic import ElasticSearch
+from ..elastic import ElasticSearch, BulkWriter
 from ..elastic_items import (ElasticItems,
                              HEADER_JSON)
 from .study_ceres_onion import ESOnionConnector, onion_study
+from .identities_cache import IdentitiesCache, identities_cache
 from .sortinghat_gelk import MULTI_ORG_NAMES
 from .graal_study_evolution import (get_to_date,
                                     get_unique_repository)
 from statsmodels.duration.survfunc import SurvfuncRight
 
 from .utils import grimoire_con, METADATA_FILTER_RAW, REPO_LABELS, anonymize_url
+from ..metrics import Metrics, metrics
 from .. import __version__
 
 logger = logging.getLogger(__name__)
@@ -63,7 +66,8 @@ try:
     from sortinghat import api, utils
     from sortinghat.exceptions import NotFoundError, InvalidValueError
 
-    from .sortinghat_gelk import SortingHat
+    from .sortinghat_gelk import (EnrollmentsIndex, IdentitiesCacheStore, IdentitiesSnapshot,
+                                  SnapshotUniqueIdentity, SortingHat)
 
     SORTINGHAT_LIBS = True
 except ImportError:
@@ -79,6 +83,11 @@ EXTRA_PREFIX = 'extra'
 SH_UNKNOWN_VALUE = 'Unknown'
 DEMOGRAPHICS_ALIAS = 'demographics'
 ONION_ALIAS = 'all_onion'
+ENRICH_PACK_SIZE = 100  # raw items enriched together in a worker
+ENROLLMENTS_MEMO_SIZE = 1000  # organizations at the date of the items memoized by each enricher
+
+# Enricher of the current process when items are enriched by a pool of processes
+_worker_enricher = None
 
 
 def metadata(func):
@@ -101,16 +110,99 @@ def metadata(func):
     return decorator
 
 
+def _get_worker_settings():
+    """Return a list of tuples (class, attribute, value) with the class
+    attributes configured at run time (e.g., from the arguments of p2o)
+    which are read while enriching, to set them in the processes of the
+    enrichment pool."""
+
+    settings = [
+        (Enrich, ['identities_snapshot', 'identities_snapshot_fallback', 'sh_db_params']),
+        (IdentitiesCache, ['max_size', 'ttl']),
+        (Metrics, ['enabled', 'max_samples'])
+    ]
+    return [(klass, name, getattr(klass, name)) for klass, names in settings for name in names]
+
+
+def _init_enrich_worker(enricher, settings, cache_entries, log_level):
+    """Initialize a process of the enrichment pool.
+
+    The processes are spawned, thus `enricher` is a copy of the enricher
+    already configured (projects map, SortingHat snapshot, params) without
+    its connections, which are created again, and the class attributes
+    configured at run time are set again.
+
+    :param enricher: enricher used to enrich the items in this process
+    :param settings: class attributes returned by `_get_worker_settings`
+    :param cache_entries: lookups of the identities cache of the parent, encoded
+    :param log_level: level of the root logger
+    """
+    global _worker_enricher
+
+    logging.basicConfig(level=log_level)
+    for klass, name, value in settings:
+        setattr(klass, name, value)
+
+    enricher.requests = grimoire_con()
+    if Enrich.sh_db_params:
+        Enrich.sh_db = Database(*Enrich.sh_db_params)
+
+    if SORTINGHAT_LIBS:
+        for region, values in IdentitiesCacheStore.decode_entries(cache_entries).items():
+            identities_cache.put_many(region, values)
+    # The metrics, identities cache stats and lookups of the worker are returned with each pack
+    identities_cache.track_added()
+    identities_cache.pop_stats()
+    metrics.reset()
+
+    _worker_enricher = enricher
+
+
+def _enrich_pack(items, events):
+    """Enrich a pack of raw items in a process of the enrichment pool.
+
+    :returns: the rich docs, and the metrics, identities cache stats and
+        identities cache lookups (encoded) added while enriching them
+    """
+    with metrics.timer('enrich.pack'):
+        docs = _worker_enricher.get_rich_docs(items, events=events)
+
+    cache_entries = {}
+    if SORTINGHAT_LIBS:
+        cache_entries = IdentitiesCacheStore.encode_entries(identities_cache.pop_added(IdentitiesCacheStore.regions))
+
+    return docs, metrics.pop(), identities_cache.pop_stats(), cache_entries
+
+
 class Enrich(ElasticItems):
 
     sh_db = None
+    sh_db_params = None  # params of the SortingHat database, to connect to it from other processes
     kibiter_version = None
     RAW_FIELDS_COPY = ["metadata__updated_on", "metadata__timestamp",
                        "offset", "origin", "tag", "uuid"]
     KEYWORD_MAX_LENGTH = 1000  # this control allows to avoid max_bytes_length_exceeded_exception
+    # Fields of the raw items read by the enricher, to get only them from the raw index. None to get all of them
+    RAW_FIELDS_INCLUDES = None
+    RAW_FIELDS_EXCLUDES = None  # fields of the raw items not read by the enricher
 
     ONION_INTERVAL = seconds = 3600 * 24 * 7
 
+    enrich_workers = 1  # processes enriching the raw items, 1 means enrich them in the current process
+    # Resolve the identities and projects of each page of raw items at once (see `resolve_items_batch`)
+    batch_resolve = False
+    # Store of the checkpoints of the enrichment: a local JSON file or an index in the enriched ES
+    checkpoint_file = None
+    checkpoint_index = None
+    checkpoint_interval = 10000  # raw items enriched between checkpoints
+    # The enricher overrides `enrich_items` enriching the raw items with `fetch_rich_docs`,
+    # which advances the checkpoints (see `supports_checkpoints`)
+    checkpoints_enrich_items = False
+    # Load the identities of SortingHat in memory before enriching (see `load_identities_snapshot`)
+    identities_snapshot = False
+    identities_snapshot_fallback = True  # query SortingHat for the identities not found in the snapshot
+    identities_cache_file = None  # SQLite file where the SortingHat lookups are kept between runs
+
     def __init__(self, db_sortinghat=None, db_projects_map=None, json_projects_map=None,
                  db_user='', db_password='', db_host='', insecure=True):
 
@@ -126,6 +218,7 @@ class Enrich(ElasticItems):
             # self.sh_db = Database("root", "", db_sortinghat, "mariadb")
             if not Enrich.sh_db:
                 Enrich.sh_db = Database(db_user, db_password, db_sortinghat, db_host)
+                Enrich.sh_db_params = (db_user, db_password, db_sortinghat, db_host)
             self.sortinghat = True
 
         self.prjs_map = None  # mapping beetween repositories and projects
@@ -166,6 +259,37 @@ class Enrich(ElasticItems):
         # Label used during enrichment for identities with no gender info
         self.unknown_gender = 'Unknown'
 
+        # SortingHat data resolved for the current page of items (see `resolve_items_batch`)
+        self.sh_ids_batch = {}
+        self.uidentities_batch = {}
+        self.enrollments_batch = {}
+        # Projects found for the repositories of the current page of items
+        self.projects_batch = None
+        # In-memory copy of the identities of SortingHat (see `load_identities_snapshot`)
+        self.sh_snapshot = None
+        # Organizations of the identities by day of the last items enriched
+        self.enrollments_memo = {}
+        self.enrollments_memo_generation = None  # generation of the identities cache of the memo
+        # Store of the SortingHat lookups between runs (see `load_identities_cache`)
+        self.identities_cache_store = None
+
+        self.checkpoint = None  # checkpoint advanced while enriching the items
+
+    def set_checkpoint(self, checkpoint):
+        """Set the checkpoint advanced while enriching the items
+
+        :param checkpoint: Checkpoint object, None to disable checkpoints
+        """
+        self.checkpoint = checkpoint
+
+    def supports_checkpoints(self):
+        """Return whether the enrichment advances the checkpoints. They are
+        advanced by `fetch_rich_docs`, used by the default `enrich_items`, so
+        the enrichers with their own `enrich_items` ignore them unless
+        `checkpoints_enrich_items` is set."""
+
+        return self.checkpoints_enrich_items or type(self).enrich_items is Enrich.enrich_items
+
     def set_elastic_url(self, url):
         """ Elastic URL """
         self.elastic_url = url
@@ -345,6 +469,257 @@ class Enrich(ElasticItems):
     def enrich_events(self, items):
         return self.enrich_items(items, events=True)
 
+    def get_rich_docs(self, items, events=False):
+        """Enrich a pack of raw items.
+
+        An item can produce several documents (e.g., events, comments),
+        thus the enrichers generating more than one document per item
+        override this method instead of `enrich_items`, so they can
+        be enriched by a pool of processes.
+
+        :param items: list of raw items
+        :param events: enrich items or enrich events
+        :return: list of tuples (rich item, ID of the rich item)
+        """
+        docs = []
+
+        if not events:
+            rich_items = self.get_rich_items_batch(items)
+            for item, rich_item in zip(items, rich_items):
+                docs.append((rich_item, item[self.get_field_unique_id()]))
+            return docs
+
+        for item in items:
+            with metrics.timer('enrich.get_rich_events'):
+                rich_events = self.get_rich_events(item)
+            for rich_event in rich_events:
+                docs.append((rich_event, "{}_{}".format(item[self.get_field_unique_id()],
+                                                        rich_event[self.get_field_event_unique_id()])))
+
+        return docs
+
+    def get_rich_items_batch(self, items):
+        """Enrich a page of raw items.
+
+        The default implementation calls `get_rich_item` for each item,
+        after resolving the identities and projects of all the items of
+        the page at once when `batch_resolve` is set (see
+        `resolve_items_batch`).
+
+        :param items: list of raw items
+        :return: list with the rich item of each raw item, in the same order
+        """
+        if self.batch_resolve:
+            self.resolve_items_batch(items)
+
+        rich_items = []
+        for item in items:
+            with metrics.timer('enrich.get_rich_item'):
+                rich_items.append(self.get_rich_item(item))
+
+        return rich_items
+
+    def resolve_items_batch(self, items):
+        """Resolve in bulk the data needed to enrich a page of raw items.
+
+        The SortingHat ids, unique identities and enrollments of the
+        identities of the items (see `get_identities`) are read with
+        one query each, instead of a few queries per identity, except
+        the ones already in the identities cache. The projects found
+        are kept until the next page, so the projects map is searched
+        once per repository.
+
+        :param items: list of raw items
+        """
+        self.projects_batch = {}
+
+        self.sh_ids_batch = {}
+        self.uidentities_batch = {}
+        self.enrollments_batch = {}
+
+        # The identities are already in memory when there is a snapshot
+        if not self.sortinghat or self.sh_snapshot:
+            return
+
+        backend_name = self.get_connector_name()
+        identities = {}
+
+        for item in items:
+            for identity in self.get_identities(item):
+                if not identity:
+                    continue
+                iden = tuple(identity.get(field, None) for field in ['email', 'name', 'username'])
+                if iden in identities or not any(iden):
+                    continue
+                try:
+                    sh_id = utils.uuid(backend_name, email=iden[0],
+                                       name=iden[1], username=iden[2])
+                except (InvalidValueError, UnicodeEncodeError):
+                    # Resolved (and logged) when enriching the item
+                    continue
+                if sh_id:
+                    identities[iden] = sh_id
+
+        if not identities:
+            return
+
+        def get_uuids(sh_ids):
+            uuids = SortingHat.get_uuids_from_ids(self.sh_db, sh_ids)
+            # The identities not found are cached too
+            return {sh_id: uuids.get(sh_id, None) for sh_id in sh_ids}
+
+        with metrics.timer('sortinghat.resolve_batch'):
+            uuids = self.__resolve_batch('uuids', set(identities.values()), get_uuids)
+            for iden, sh_id in identities.items():
+                uuid = uuids[sh_id]
+                self.sh_ids_batch[(iden, backend_name)] = {"id": sh_id if uuid else None, "uuid": uuid}
+
+            uuids = list({uuid for uuid in uuids.values() if uuid})
+            if uuids:
+                self.uidentities_batch = self.__resolve_batch(
+                    'uidentities', uuids, lambda missing: SortingHat.get_unique_identities(self.sh_db, missing))
+                self.enrollments_batch = self.__resolve_batch(
+                    'enrollments', uuids, lambda missing: SortingHat.get_enrollments(self.sh_db, missing))
+        metrics.incr('sortinghat.batch_identities', len(identities))
+
+        logger.debug("{} identities and {} unique identities resolved for {} items".format(
+                     len(identities), len(uuids), len(items)))
+
+    @staticmethod
+    def __resolve_batch(region, keys, query):
+        """Return the values of some keys from the identities cache, querying
+        in bulk (and caching) the ones not found in it.
+
+        :param region: region of the identities cache
+        :param keys: list of keys
+        :param query: function returning a dict with the values of a list of keys
+        :return: dict with the values by key
+        """
+        values = identities_cache.get_many(region, keys)
+        missing = [key for key in keys if key not in values]
+        if missing:
+            found = query(missing)
+            identities_cache.put_many(region, found)
+            values.update(found)
+
+        return values
+
+    def fetch_rich_docs(self, items, events=False, writer=None):
+        """Enrich the raw items in packs of `ENRICH_PACK_SIZE` items.
+
+        When `enrich_workers` is greater than 1, the packs are enriched by
+        a pool of processes. At most two packs per worker are pending, and
+        the results are collected in the order of the raw items.
+
+        When a checkpoint is set (see `set_checkpoint`) and the `writer` of
+        the rich items is given, the checkpoint is advanced once the rich
+        items of the raw items enriched are flushed.
+
+        :param items: generator of raw items
+        :param events: enrich items or enrich events
+        :param writer: BulkWriter where the rich items are added
+        :return: generator of tuples (rich item, ID of the rich item)
+        """
+        checkpoint = self.checkpoint if writer else None
+
+        for pack, docs in self.__enrich_packs(items, events):
+            metrics.incr('enrich.raw_items', len(pack))
+            metrics.incr('enrich.rich_docs', len(docs))
+            for doc in docs:
+                yield doc
+            if checkpoint:
+                checkpoint.add(pack, writer)
+
+        if checkpoint:
+            checkpoint.save(writer)
+
+    def __enrich_packs(self, items, events):
+        """Generator of tuples (pack of raw items, rich docs of the pack)"""
+
+        packs = self.__get_packs(items)
+
+        if self.enrich_workers <= 1:
+            for pack in packs:
+                with metrics.timer('enrich.pack'):
+                    docs = self.get_rich_docs(pack, events=events)
+                yield pack, docs
+            return
+
+        logger.debug("Enriching items with {} processes".format(self.enrich_workers))
+
+        # The processes are spawned instead of forked, so they don't inherit the locks
+        # held by other threads (e.g., prefetching pages or uploading the rich items)
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(self.enrich_workers, initializer=_init_enrich_worker,
+                            initargs=(self.__get_worker_enricher(), _get_worker_settings(),
+                                      self.__get_cache_entries(), logging.getLogger().level))
+        pending = deque()
+
+        try:
+            for pack in packs:
+                if len(pending) >= 2 * self.enrich_workers:
+                    done, result = pending.popleft()
+                    yield done, self.__get_pack_docs(result)
+                pending.append((pack, pool.apply_async(_enrich_pack, (pack, events))))
+
+            while pending:
+                done, result = pending.popleft()
+                yield done, self.__get_pack_docs(result)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __get_worker_enricher(self):
+        """Return a copy of the enricher to send to the processes of the pool"""
+
+        worker = copy.copy(self)
+        # The connections, files and studies (bound to the enricher) are not sent
+        worker.elastic = None
+        worker.requests = None
+        worker.studies = []
+        worker.checkpoint = None
+        worker.identities_cache_store = None
+
+        return worker
+
+    @staticmethod
+    def __get_cache_entries():
+        """Return the lookups of the identities cache to send to the processes of the pool"""
+
+        if not SORTINGHAT_LIBS:
+            return {}
+
+        entries = {region: dict(identities_cache.items(region)) for region in IdentitiesCacheStore.regions}
+        return IdentitiesCacheStore.encode_entries(entries)
+
+    @staticmethod
+    def __get_pack_docs(result):
+        """Wait for a pack enriched by the pool, and merge the metrics, identities
+        cache stats and identities cache lookups of the worker"""
+
+        with metrics.timer('enrich.pack_wait'):
+            docs, worker_metrics, cache_stats, cache_entries = result.get()
+        metrics.merge(worker_metrics)
+        identities_cache.merge_stats(cache_stats)
+        if cache_entries:
+            for region, values in IdentitiesCacheStore.decode_entries(cache_entries).items():
+                identities_cache.put_many(region, values)
+
+        return docs
+
+    @staticmethod
+    def __get_packs(items):
+        pack = []
+
+        for item in items:
+            pack.append(item)
+            if len(pack) >= ENRICH_PACK_SIZE:
+                yield pack
+                pack = []
+
+        if pack:
+            yield pack
+
     def enrich_items(self, ocean_backend, events=False):
         """
         Enrich the items fetched from ocean_backend generator
@@ -356,56 +731,19 @@ class Enrich(ElasticItems):
         :return: total number of enriched items/events uploaded to Elasticsearch
         """
 
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        total = 0
-        bulk_json = ""
-
         items = ocean_backend.fetch()
 
-        url = self.elastic.get_bulk_url()
-
-        logger.debug("Adding items to {} (in {} packs)".format(anonymize_url(url), max_items))
+        writer = BulkWriter(self.elastic)
 
         if events:
             logger.debug("Adding events items")
 
-        for item in items:
-            if current >= max_items:
-                try:
-                    total += self.elastic.safe_put_bulk(url, bulk_json)
-                    json_size = sys.getsizeof(bulk_json) / (1024 * 1024)
-                    logger.debug("Added {} items to {} ({:.2f} MB)".format(total, anonymize_url(url), json_size))
-                except UnicodeEncodeError:
-                    # Why is requests encoding the POST data as ascii?
-                    logger.error("Unicode error in enriched items")
-                    logger.debug(bulk_json)
-                    safe_json = str(bulk_json.encode('ascii', 'ignore'), 'ascii')
-                    total += self.elastic.safe_put_bulk(url, safe_json)
-                bulk_json = ""
-                current = 0
-
-            if not events:
-                rich_item = self.get_rich_item(item)
-                data_json = json.dumps(rich_item)
-                bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                    (item[self.get_field_unique_id()])
-                bulk_json += data_json + "\n"  # Bulk document
-                current += 1
-            else:
-                rich_events = self.get_rich_events(item)
-                for rich_event in rich_events:
-                    data_json = json.dumps(rich_event)
-                    bulk_json += '{"index" : {"_id" : "%s_%s" } }\n' % \
-                        (item[self.get_field_unique_id()],
-                         rich_event[self.get_field_event_unique_id()])
-                    bulk_json += data_json + "\n"  # Bulk document
-                    current += 1
+        for rich_item, item_id in self.fetch_rich_docs(items, events=events, writer=writer):
+            writer.add(rich_item, item_id)
 
-        if current > 0:
-            total += self.elastic.safe_put_bulk(url, bulk_json)
+        writer.flush()
 
-        return total
+        return writer.total
 
     def add_repository_labels(self, eitem):
         """Add labels to the enriched item"""
@@ -512,6 +850,13 @@ class Enrich(ElasticItems):
         """
         return ''
 
+    def get_project_fields(self):
+        """Fields of the enriched items read to find their project (see
+        `get_project_repository`), the ones fetched to refresh the project
+        fields of an enriched index."""
+
+        return ['origin']
+
     @classmethod
     def add_project_levels(cls, project):
         """ Add project sub levels extra items """
@@ -535,6 +880,25 @@ class Enrich(ElasticItems):
         :param eitem: enriched item for which to find the project
         :return: the project entry (a dictionary)
         """
+        with metrics.timer('enrich.find_item_project'):
+            return self.__find_item_project_batch(eitem)
+
+    def __find_item_project_batch(self, eitem):
+        if self.projects_batch is None:
+            return self.__find_item_project(eitem)
+
+        try:
+            repository = (self.get_project_repository(eitem), eitem.get('origin', None),
+                          self.projects_json_repo, self.filter_raw)
+        except KeyError:
+            return self.__find_item_project(eitem)
+
+        if repository not in self.projects_batch:
+            self.projects_batch[repository] = self.__find_item_project(eitem)
+
+        return self.projects_batch[repository]
+
+    def __find_item_project(self, eitem):
         # get the data source name relying on the cfg section name, if null use the connector name
         ds_name = self.cfg_section_name if self.cfg_section_name else self.get_connector_name()
 
@@ -668,43 +1032,61 @@ class Enrich(ElasticItems):
 
     def get_enrollment(self, uuid, item_date):
         """ Get the enrollment for the uuid when the item was done """
-        # item_date must be offset-naive (utc)
-        if item_date and item_date.tzinfo:
-            item_date = (item_date - item_date.utcoffset()).replace(tzinfo=None)
 
-        enrollments = self.get_enrollments(uuid)
-        enroll = self.unaffiliated_group
-        if enrollments:
-            for enrollment in enrollments:
-                if not item_date:
-                    enroll = enrollment.organization.name
-                    break
-                elif item_date >= enrollment.start and item_date <= enrollment.end:
-                    enroll = enrollment.organization.name
-                    break
-        return enroll
+        organizations = self.__get_enrollments_at(uuid, item_date)
+        if organizations is None:
+            return self.unaffiliated_group
+
+        return organizations[0] if organizations else self.unaffiliated_group
 
     def get_multi_enrollment(self, uuid, item_date):
         """ Get the enrollments for the uuid when the item was done """
 
-        enrolls = []
+        organizations = self.__get_enrollments_at(uuid, item_date)
+        if organizations is None:
+            return [self.unaffiliated_group]
+
+        return list(organizations)
+
+    def __get_enrollments_at(self, uuid, item_date):
+        """Return the organizations of the uuid at the item date, None if
+        it has no enrollments. The uuids of the items are usually the same
+        for several roles and for the organization and multi organization
+        fields, and the items of an identity are often done the same day,
+        so the organizations are memoized by uuid and day."""
 
         # item_date must be offset-naive (utc)
         if item_date and item_date.tzinfo:
             item_date = (item_date - item_date.utcoffset()).replace(tzinfo=None)
 
-        enrollments = self.get_enrollments(uuid)
+        # The memoized organizations are derived from the identities cache
+        if self.enrollments_memo_generation != identities_cache.generation:
+            self.enrollments_memo = {}
+            self.enrollments_memo_generation = identities_cache.generation
 
-        if enrollments:
-            for enrollment in enrollments:
-                if not item_date:
-                    enrolls.append(enrollment.organization.name)
-                elif enrollment.start <= item_date <= enrollment.end:
-                    enrolls.append(enrollment.organization.name)
-        else:
-            enrolls.append(self.unaffiliated_group)
+        key = (uuid, item_date.date() if item_date else None)
+        if key in self.enrollments_memo:
+            return self.enrollments_memo[key]
+
+        index = identities_cache.get('enrollments_index', uuid, lambda: self.__get_enrollments_index(uuid))
+        organizations = index.organizations_at(item_date if item_date else None) if index else None
+
+        # The organizations are memoized by day, unless an enrollment starts or ends that day
+        if not index or not item_date or index.is_constant_on(item_date):
+            if len(self.enrollments_memo) >= ENROLLMENTS_MEMO_SIZE:
+                self.enrollments_memo.clear()
+            self.enrollments_memo[key] = organizations
 
-        return enrolls
+        return organizations
+
+    def __get_enrollments_index(self, uuid):
+        """Return the EnrollmentsIndex of the enrollments of the uuid, None if it has no enrollments"""
+
+        enrollments = self.get_enrollments(uuid)
+        if not enrollments:
+            return None
+
+        return EnrollmentsIndex(enrollments)
 
     def __get_item_sh_fields_empty(self, rol, undefined=False):
         """ Return a SH identity with all fields to empty_field """
@@ -920,28 +1302,155 @@ class Enrich(ElasticItems):
 
         return eitem_sh
 
-    @lru_cache()
+    def load_identities_snapshot(self, sources=None):
+        """Load in memory the identities of SortingHat, with their profiles
+        and enrollments, when `identities_snapshot` is set. The identities
+        of the items are then resolved from the snapshot, and only the ones
+        not found in it are queried to SortingHat, unless
+        `identities_snapshot_fallback` is disabled.
+
+        It must be called once the identities of the items are loaded into
+        SortingHat (see `elk.load_identities`).
+
+        :param sources: sources of the identities to load, default to the connector name
+        """
+        if not self.sortinghat or not self.identities_snapshot:
+            return
+
+        if not sources:
+            sources = [self.get_connector_name()]
+
+        with metrics.timer('sortinghat.snapshot_load'):
+            self.sh_snapshot = IdentitiesSnapshot.load(self.sh_db, sources)
+
+    def load_identities_cache(self):
+        """Load into the identities cache the SortingHat lookups of previous
+        runs kept in `identities_cache_file`, except the ones of identities
+        modified in SortingHat since then. They are saved again, with the
+        ones done in this run, by `save_identities_cache`.
+        """
+        if not self.sortinghat or not self.identities_cache_file:
+            return
+
+        with metrics.timer('sortinghat.cache_load'):
+            self.identities_cache_store = IdentitiesCacheStore(self.identities_cache_file)
+            self.identities_cache_store.load(identities_cache, self.sh_db)
+
+    def sync_identities_cache(self):
+        """Invalidate the lookups of the identities cache of the identities
+        modified in SortingHat since the cache was last synced (e.g., merged
+        or enrolled by other tools while the previous data sources of the
+        process were enriched), so the rest of them are reused.
+        """
+        if not self.sortinghat:
+            return
+
+        # Date of the changes in SortingHat that the next sync must invalidate
+        synced = datetime_utcnow().replace(tzinfo=None) - IdentitiesCacheStore.sync_margin
+
+        if identities_cache.synced:
+            with metrics.timer('sortinghat.cache_sync'):
+                sh_ids, uuids = SortingHat.get_modified_identities(self.sh_db, identities_cache.synced)
+            if sh_ids or uuids:
+                identities_cache.invalidate(sh_ids + uuids)
+            logger.debug("[sortinghat] {} identities and {} unique identities modified since {} "
+                         "invalidated in the identities cache".format(
+                             len(sh_ids), len(uuids), identities_cache.synced))
+        identities_cache.synced = synced
+
+    def save_identities_cache(self):
+        """Save the SortingHat lookups of the identities cache for the next runs"""
+
+        if not self.identities_cache_store:
+            return
+
+        with metrics.timer('sortinghat.cache_save'):
+            self.identities_cache_store.save(identities_cache)
+        self.identities_cache_store.close()
+        self.identities_cache_store = None
+
+    def __is_snapshot_miss(self):
+        """Count a lookup not found in the snapshot, and return whether SortingHat must be queried"""
+
+        metrics.incr('sortinghat.snapshot_misses')
+        return self.identities_snapshot_fallback
+
     def get_enrollments(self, uuid):
-        return api.enrollments(self.sh_db, uuid)
+        if uuid in self.enrollments_batch:
+            return self.enrollments_batch[uuid]
+        if self.sh_snapshot:
+            enrollments = self.sh_snapshot.get_enrollments(uuid)
+            if enrollments is not None:
+                return enrollments
+            if not self.__is_snapshot_miss():
+                return []
+
+        def load():
+            with metrics.timer('sortinghat.get_enrollments'):
+                return api.enrollments(self.sh_db, uuid)
+
+        return identities_cache.get('enrollments', uuid, load)
 
-    @lru_cache()
     def get_unique_identity(self, uuid):
-        return api.unique_identities(self.sh_db, uuid)[0]
+        if uuid in self.uidentities_batch:
+            return self.uidentities_batch[uuid]
+        if self.sh_snapshot:
+            uidentity = self.sh_snapshot.get_unique_identity(uuid)
+            if uidentity:
+                return uidentity
+            if not self.__is_snapshot_miss():
+                return SnapshotUniqueIdentity(uuid, None)
+        return identities_cache.get('uidentities', uuid, lambda: api.unique_identities(self.sh_db, uuid)[0])
 
-    @lru_cache()
     def get_uuid_from_id(self, sh_id):
         """ Get the SH identity uuid from the id """
-        return SortingHat.get_uuid_from_id(self.sh_db, sh_id)
+        if self.sh_snapshot:
+            uuid = self.sh_snapshot.get_uuid(sh_id)
+            if uuid or not self.__is_snapshot_miss():
+                return uuid
+        return identities_cache.get('uuids', sh_id, lambda: SortingHat.get_uuid_from_id(self.sh_db, sh_id))
 
     def get_sh_ids(self, identity, backend_name):
         """ Return the Sorting Hat id and uuid for an identity """
+        iden = tuple(identity.get(field, None) for field in ['email', 'name', 'username'])
+        if (iden, backend_name) in self.sh_ids_batch:
+            return self.sh_ids_batch[(iden, backend_name)]
+        if self.sh_snapshot:
+            sh_ids = self.__get_sh_ids_snapshot(iden, backend_name)
+            if sh_ids:
+                return sh_ids
+
         # Convert the dict to tuple so it is hashable
         identity_tuple = tuple(identity.items())
-        sh_ids = self.__get_sh_ids_cache(identity_tuple, backend_name)
-        return sh_ids
 
-    @lru_cache()
-    def __get_sh_ids_cache(self, identity_tuple, backend_name):
+        def load():
+            with metrics.timer('sortinghat.get_sh_ids'):
+                return self.__find_sh_ids(identity_tuple, backend_name)
+
+        return identities_cache.get('sh_ids', (identity_tuple, backend_name), load)
+
+    def __get_sh_ids_snapshot(self, iden, backend_name):
+        """Return the Sorting Hat id and uuid of an identity (email, name, username)
+        from the snapshot, None if it must be queried to SortingHat"""
+
+        if not any(iden):
+            # Logged when queried
+            return None
+
+        try:
+            sh_id = utils.uuid(backend_name, email=iden[0], name=iden[1], username=iden[2])
+        except (InvalidValueError, UnicodeEncodeError):
+            return None
+
+        uuid = self.sh_snapshot.get_uuid(sh_id)
+        if uuid:
+            return {"id": sh_id, "uuid": uuid}
+        if self.__is_snapshot_miss():
+            return None
+
+        return {"id": None, "uuid": None}
+
+    def __find_sh_ids(self, identity_tuple, backend_name):
 
         # Convert tuple to the original dict
         identity = dict((x, y) for x, y in identity_tuple)
@@ -139,3 +139,6 @@ class FinosMeetingsEnrich(Enrich):
         }
 
         return project_info
+
+    def get_project_fields(self):
+        return ['cm_title']
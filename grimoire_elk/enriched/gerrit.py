@@ -23,6 +23,7 @@ import logging
 
 from .enrich import Enrich, metadata
 from .utils import get_time_diff_days
+from ..elastic import BulkWriter
 from ..elastic_mapping import Mapping as BaseMapping
 
 from grimoirelab_toolkit.datetime import (str_to_datetime,
@@ -30,7 +31,6 @@ from grimoirelab_toolkit.datetime import (str_to_datetime,
                                           unixtime_to_datetime)
 
 
-MAX_SIZE_BULK_ENRICHED_ITEMS = 200
 REVIEW_TYPE = 'review'
 CHANGESET_TYPE = 'changeset'
 COMMENT_TYPE = 'comment'
@@ -83,6 +83,8 @@ class Mapping(BaseMapping):
 class GerritEnrich(Enrich):
 
     mapping = Mapping
+    checkpoints_enrich_items = True
+    batch_resolve = True
 
     def __init__(self, db_sortinghat=None, db_projects_map=None, json_projects_map=None,
                  db_user='', db_password='', db_host=''):
@@ -125,6 +127,9 @@ class GerritEnrich(Enrich):
         repo += "_" + eitem['repository']
         return repo
 
+    def get_project_fields(self):
+        return ['origin', 'repository']
+
     def get_identities(self, item):
         """Return the identities from an item"""
 
@@ -641,36 +646,34 @@ class GerritEnrich(Enrich):
 
         return approval_status
 
-    def enrich_items(self, ocean_backend):
-        items_to_enrich = []
-        num_items = 0
-        ins_items = 0
-
-        for item in ocean_backend.fetch():
-            eitem = self.get_rich_item(item)
+    def get_rich_docs(self, items, events=False):
+        docs = []
 
-            items_to_enrich.append(eitem)
+        eitems = self.get_rich_items_batch(items)
+        for item, eitem in zip(items, eitems):
+            docs.append((eitem, eitem[self.get_field_unique_id()]))
 
             comments = item['data'].get('comments', [])
             if comments:
                 rich_item_comments = self.get_rich_item_comments(comments, eitem)
-                items_to_enrich.extend(rich_item_comments)
+                docs.extend([(ritem, ritem[self.get_field_unique_id()]) for ritem in rich_item_comments])
 
             patchsets = item['data'].get('patchSets', [])
             if patchsets:
                 rich_item_patchsets = self.get_rich_item_patchsets(patchsets, eitem)
-                items_to_enrich.extend(rich_item_patchsets)
+                docs.extend([(ritem, ritem[self.get_field_unique_id()]) for ritem in rich_item_patchsets])
 
-            if len(items_to_enrich) < MAX_SIZE_BULK_ENRICHED_ITEMS:
-                continue
+        return docs
+
+    def enrich_items(self, ocean_backend):
+        writer = BulkWriter(self.elastic)
 
-            num_items += len(items_to_enrich)
-            ins_items += self.elastic.bulk_upload(items_to_enrich, self.get_field_unique_id())
-            items_to_enrich = []
+        for rich_item, item_id in self.fetch_rich_docs(ocean_backend.fetch(), writer=writer):
+            writer.add(rich_item, item_id)
 
-        if len(items_to_enrich) > 0:
-            num_items += len(items_to_enrich)
-            ins_items += self.elastic.bulk_upload(items_to_enrich, self.get_field_unique_id())
+        writer.flush()
+        num_items = writer.total_items
+        ins_items = writer.total
 
         if num_items != ins_items:
             missing = num_items - ins_items
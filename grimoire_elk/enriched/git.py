@@ -24,7 +24,6 @@
 import json
 import logging
 import re
-import sys
 
 import pkg_resources
 import requests
@@ -39,6 +38,7 @@ from perceval.backends.core.git import (GitCommand,
                                         RepositoryError)
 from .enrich import Enrich, metadata
 from .study_ceres_aoc import areas_of_code, ESPandasConnector
+from ..elastic import BulkWriter
 from ..elastic_mapping import Mapping as BaseMapping
 from ..elastic_items import HEADER_JSON, MAX_BULK_UPDATE_SIZE
 from .utils import anonymize_url
@@ -75,6 +75,8 @@ class Mapping(BaseMapping):
 class GitEnrich(Enrich):
 
     mapping = Mapping
+    checkpoints_enrich_items = True
+    batch_resolve = True
 
     # REGEX to extract authors from a multi author commit: several authors present
     # in the Author field in the commit. Used if self.pair_programming is True
@@ -414,21 +416,50 @@ class GitEnrich(Enrich):
             "message": "Enable users to pass flags\n\nCo-authored-by: mariiapunda <mariiapunda@users.noreply.github.com>",
         Co-authored commits like these are not considered as multiauthored commits in ELK.
         """
-        headers = {"Content-Type": "application/json"}
-
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        total = 0
-        bulk_json = ""
-
         total_signed_off = 0
         total_multi_author = 0
 
-        url = self.elastic.get_bulk_url()
+        writer = BulkWriter(self.elastic)
 
-        logger.debug("[git] Adding items to {} (in {} packs)".format(anonymize_url(url), max_items))
+        logger.debug("[git] Adding items to {}".format(anonymize_url(writer.url)))
         items = ocean_backend.fetch()
 
+        for rich_item, item_id in self.fetch_rich_docs(items, writer=writer):
+            writer.add(rich_item, item_id)
+
+            if self.pair_programming:
+                # The commits generated for signed-off authors use their ID as git_uuid
+                if rich_item['is_git_commit_signed_off'] == 1:
+                    total_signed_off += 1
+                elif item_id != rich_item[self.get_field_unique_id()]:
+                    total_multi_author += 1
+
+        writer.flush()
+        total = writer.total
+
+        if total == 0:
+            # No items enriched, nothing to upload to ES
+            return total
+
+        if self.pair_programming:
+            logger.info("[git] Signed-off commits generated: {}".format(total_signed_off))
+            logger.info("[git] Multi author commits generated: {}".format(total_multi_author))
+
+        return total
+
+    def get_rich_docs(self, items, events=False):
+        """Enrich a pack of commits. When pair programming is enabled,
+        a rich item is generated for each author and signed-off author
+        of the commit (see `enrich_items`)."""
+
+        if not self.pair_programming:
+            return super().get_rich_docs(items, events=events)
+
+        # Resolve the identities before splitting the authors of the multi author commits
+        self.resolve_items_batch(items)
+
+        docs = []
+
         for item in items:
             if self.pair_programming:
                 # First we need to add the authors field to all commits
@@ -451,26 +482,8 @@ class GitEnrich(Enrich):
                     authors_all = item['data']['Signed-off-by'] + [item['data']['Author']]
                     item['data']['authors_signed_off'] = list(set(authors_all))
 
-            if current >= max_items:
-                try:
-                    total += self.elastic.safe_put_bulk(url, bulk_json)
-                    json_size = sys.getsizeof(bulk_json) / (1024 * 1024)
-                    logger.debug("[git] Added {} items to {} ({:.2f} MB)".format(
-                                 total, anonymize_url(url), json_size))
-                except UnicodeEncodeError:
-                    # Why is requests encoding the POST data as ascii?
-                    logger.warning("[git] Unicode error in enriched items, converting to ascii")
-                    safe_json = str(bulk_json.encode('ascii', 'ignore'), 'ascii')
-                    total += self.elastic.safe_put_bulk(url, safe_json)
-                bulk_json = ""
-                current = 0
-
             rich_item = self.get_rich_item(item)
-            data_json = json.dumps(rich_item)
-            unique_field = self.get_field_unique_id()
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % (rich_item[unique_field])
-            bulk_json += data_json + "\n"  # Bulk document
-            current += 1
+            docs.append((rich_item, rich_item[self.get_field_unique_id()]))
 
             if self.pair_programming:
                 # Multi author support
@@ -483,13 +496,8 @@ class GitEnrich(Enrich):
                         item['data']['is_git_commit_multi_author'] = 1
                         rich_item = self.get_rich_item(item)
                         item['data']['is_git_commit_multi_author'] = 1
-                        data_json = json.dumps(rich_item)
                         commit_id = item["uuid"] + "_" + str(i - 1)
-                        rich_item['git_uuid'] = commit_id
-                        bulk_json += '{"index" : {"_id" : "%s" } }\n' % rich_item['git_uuid']
-                        bulk_json += data_json + "\n"  # Bulk document
-                        current += 1
-                        total_multi_author += 1
+                        docs.append((rich_item, commit_id))
 
                 if rich_item['Signed-off-by_number'] > 0:
                     nsg = 0
@@ -506,25 +514,10 @@ class GitEnrich(Enrich):
                         rich_item = self.get_rich_item(item)
                         commit_id = item["uuid"] + "_" + str(nsg)
                         rich_item['git_uuid'] = commit_id
-                        data_json = json.dumps(rich_item)
-                        bulk_json += '{"index" : {"_id" : "%s" } }\n' % rich_item['git_uuid']
-                        bulk_json += data_json + "\n"  # Bulk document
-                        current += 1
-                        total_signed_off += 1
+                        docs.append((rich_item, rich_item['git_uuid']))
                         nsg += 1
 
-        if current > 0:
-            total += self.elastic.safe_put_bulk(url, bulk_json)
-
-        if total == 0:
-            # No items enriched, nothing to upload to ES
-            return total
-
-        if self.pair_programming:
-            logger.info("[git] Signed-off commits generated: {}".format(total_signed_off))
-            logger.info("[git] Multi author commits generated: {}".format(total_multi_author))
-
-        return total
+        return docs
 
     def enrich_demography(self, ocean_backend, enrich_backend, date_field="grimoire_creation_date",
                           author_field="author_uuid"):
@@ -547,7 +540,8 @@ class GitEnrich(Enrich):
         es_out = Elasticsearch([enrich_backend.elastic.url], retry_on_timeout=True,
                                timeout=100, verify_certs=self.elastic.requests.verify,
                                connection_class=RequestsHttpConnection)
-        in_conn = ESPandasConnector(es_conn=es_in, es_index=in_index, sort_on_field=sort_on_field)
+        in_conn = ESPandasConnector(es_conn=es_in, es_index=in_index, sort_on_field=sort_on_field,
+                                    unique_field=ocean_backend.get_field_unique_id())
         out_conn = ESPandasConnector(es_conn=es_out, es_index=out_index, sort_on_field=sort_on_field, read_only=False)
 
         exists_index = out_conn.exists()
@@ -685,7 +679,8 @@ class GitEnrich(Enrich):
         }
 
         raw_hashes = set([item['data']['commit']
-                          for item in ocean_backend.fetch(ignore_incremental=True, _filter=fltr)])
+                          for item in ocean_backend.fetch(ignore_incremental=True, _filter=fltr,
+                                                          includes=["data.commit"])])
         aoc_hashes = set(self.get_unique_hashes_aoc(es_aoc, index_aoc, repository))
 
         hashes_to_delete = list(aoc_hashes.difference(raw_hashes))
@@ -767,7 +762,8 @@ class GitEnrich(Enrich):
 
         current_hashes = set(current_hashes)
         raw_hashes = set([item['data']['commit']
-                          for item in ocean_backend.fetch(ignore_incremental=True, _filter=fltr)])
+                          for item in ocean_backend.fetch(ignore_incremental=True, _filter=fltr,
+                                                          includes=["data.commit"])])
 
         hashes_to_delete = list(raw_hashes.difference(current_hashes))
 
@@ -801,6 +797,10 @@ class GitEnrich(Enrich):
             # delete documents from the enriched index
             self.remove_commits(to_process, enrich_backend.elastic.index_url, 'hash', repo_origin)
 
+        if hashes_to_delete:
+            ocean_backend.elastic.refresh_index()
+            enrich_backend.elastic.refresh_index()
+
         logger.debug("[git] update-items {} commits deleted from {} with origin {}.".format(
                      len(hashes_to_delete), anonymize_url(ocean_backend.elastic.index_url),
                      repo_origin))
@@ -836,7 +836,8 @@ class GitEnrich(Enrich):
             }
             ''' % (origin_attr, origin, attr, ",".join(['"%s"' % i for i in items]))
 
-        r = self.requests.post(index + "/_delete_by_query?refresh", data=es_query, headers=HEADER_JSON, verify=False)
+        url = self.elastic.add_refresh_param(index + "/_delete_by_query")
+        r = self.requests.post(url, data=es_query, headers=HEADER_JSON, verify=False)
         try:
             r.raise_for_status()
         except requests.exceptions.HTTPError as ex:
@@ -889,6 +890,8 @@ class GitEnrich(Enrich):
                 logger.debug("[git] study git-branches delete branch info for repo {} in index {}".format(
                              git_repo.uri, anonymize_url(enrich_backend.elastic.index_url)))
                 self.delete_commit_branches(git_repo, enrich_backend)
+                # the branches are added to the same documents, they must be visible to search
+                enrich_backend.elastic.refresh_index()
 
                 logger.debug("[git] study git-branches add branch info for repo {} in index {}".format(
                              git_repo.uri, anonymize_url(enrich_backend.elastic.index_url)))
@@ -936,7 +939,8 @@ class GitEnrich(Enrich):
             """ % fltr
 
         index = enrich_backend.elastic.index_url
-        r = self.requests.post(index + "/_update_by_query?refresh", data=es_query, headers=HEADER_JSON, verify=False)
+        url = enrich_backend.elastic.add_refresh_param(index + "/_update_by_query")
+        r = self.requests.post(url, data=es_query, headers=HEADER_JSON, verify=False)
         try:
             r.raise_for_status()
         except requests.exceptions.HTTPError:
@@ -981,6 +985,10 @@ class GitEnrich(Enrich):
                 if commit_count:
                     self.__process_commits_in_branch(enrich_backend, git_repo.uri, branch_name, to_process)
 
+                # the commits of a branch may belong to the next ones, the updates
+                # must be visible to search to avoid version conflicts
+                enrich_backend.elastic.refresh_index()
+
             except Exception as e:
                 logger.error("[git] Skip adding branch info for repo {} due to {}".format(git_repo.uri, e))
                 return
@@ -1018,7 +1026,8 @@ class GitEnrich(Enrich):
             """ % (digested_branch_name, fltr)
 
         index = enrich_backend.elastic.index_url
-        r = self.requests.post(index + "/_update_by_query?refresh", data=es_query, headers=HEADER_JSON, verify=False)
+        url = enrich_backend.elastic.add_refresh_param(index + "/_update_by_query")
+        r = self.requests.post(url, data=es_query, headers=HEADER_JSON, verify=False)
         try:
             r.raise_for_status()
         except requests.exceptions.HTTPError:
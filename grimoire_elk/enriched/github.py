@@ -38,6 +38,7 @@ from elasticsearch import Elasticsearch as ES, RequestsHttpConnection
 from .utils import get_time_diff_days
 
 from .enrich import Enrich, metadata, anonymize_url
+from ..elastic_items import ElasticItems
 from ..elastic_mapping import Mapping as BaseMapping
 
 from .github_study_evolution import (get_unique_repository_with_project_name,
@@ -94,6 +95,7 @@ class Mapping(BaseMapping):
 class GitHubEnrich(Enrich):
 
     mapping = Mapping
+    batch_resolve = True
 
     issue_roles = ['assignee_data', 'user_data']
     pr_roles = ['merged_by_data', 'user_data']
@@ -334,36 +336,12 @@ class GitHubEnrich(Enrich):
         error_msg = "Invalid index provided for enrich_pull_requests study. Aborting."
         make_request(issues_index_search_url, error_msg)
 
-        # get the number of pull requests in the pull_requests index
-        # https://www.elastic.co/guide/en/elasticsearch/reference/current/cat-count.html
-        # Example:
-        # epoch      timestamp count
-        # 1533454641 13:07:21  276
-        count_url = enrich_backend.elastic_url + "/_cat/count/" + enrich_backend.elastic.index + "?v"
-        error_msg = "Cannot fetch number of items in {} Aborting.".format(enrich_backend.elastic.index)
-        r = make_request(count_url, error_msg)
-        num_pull_requests = int(r.text.split()[-1])
-
         # get all the ids that are in the enriched pull requests index which will be used later
         # to pull requests data from the issue having the same id in the raw_issues_index
-        pull_requests_ids = []
-        size = 10000  # Default number of items that can be queried from elasticsearch at a time
-        i = 0  # counter
-        while num_pull_requests > 0:
-            fetch_id_in_repo_query = """
-            {
-                "_source": ["id_in_repo"],
-                "from": %s,
-                "size": %s
-            }
-            """ % (i, size)
-
-            error_msg = "Error extracting id_in_repo from {}. Aborting.".format(self.elastic.index_url)
-            r = make_request(enrich_index_search_url, error_msg, fetch_id_in_repo_query, "POST")
-            id_in_repo_json = r.json()["hits"]["hits"]
-            pull_requests_ids.extend([item["_source"]["id_in_repo"] for item in id_in_repo_json])
-            i += size
-            num_pull_requests -= size
+        enriched_items = ElasticItems(None)
+        enriched_items.elastic = self.elastic
+        pull_requests_ids = [eitem["id_in_repo"]
+                             for eitem in enriched_items.fetch(ignore_incremental=True, includes=["id_in_repo"])]
 
         # get pull requests data from the github_issues_raw and pull_requests only
         # index using specific id for each of the item
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Cache of the identities resolved in SortingHat while enriching"""
+
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from ..metrics import metrics
+
+STATS = ['hits', 'misses', 'evictions', 'expired']
+
+logger = logging.getLogger(__name__)
+
+
+def get_entry_ids(region, key, value):
+    """Return a tuple (id, uuid) with the SortingHat identity and unique
+    identity an entry refers to, any of them could be None.
+
+    :param region: region of the entry
+    :param key: key of the entry
+    :param value: value of the entry
+    """
+    if region == 'sh_ids':
+        return value['id'], value['uuid']
+    if region == 'uuids':
+        return key, value
+
+    # The rest of the regions are keyed by uuid
+    return None, key
+
+
+class IdentitiesCache:
+    """Bounded cache of the identities resolved in SortingHat (e.g., the
+    uuid of an identity, the profile or the enrollments of a unique
+    identity), shared by all the enrichers of a process, so the identities
+    resolved for a data source are reused by the next ones.
+
+    The entries are kept in regions (one per kind of lookup), each one
+    with up to `max_size` entries. The least recently used entries are
+    evicted, and the entries older than `ttl` seconds are expired, so the
+    changes done in SortingHat by other tools are seen after a while. The
+    entries must be invalidated when the identities change in SortingHat
+    (see `invalidate`), e.g., the ones modified by other tools since the
+    cache was last synced with SortingHat (see `synced`).
+    The entries not referring to any identity (e.g., the ids of an identity
+    not found in SortingHat) are kept `miss_ttl` seconds at most, and they
+    are removed on any invalidation, as the identity could have been added.
+    The hits, misses, evictions and expirations of each region are logged
+    at the end of each run (see `end_run`).
+    """
+    max_size = 100000  # entries kept per region
+    ttl = 3600  # seconds an entry is kept, None to keep it until evicted or invalidated
+    miss_ttl = 60  # seconds an entry not referring to any identity is kept
+
+    def __init__(self):
+        self.lock = Lock()
+        self.regions = {}
+        self.refs = {}  # entries (region, key) of each id and uuid, to invalidate them
+        self.stats = {}
+        self.added = None  # keys added by region since `pop_added`, None if they are not tracked
+        self.generation = 0  # incremented on each invalidation, to discard the data derived from the entries
+        self.synced = None  # date of the last changes in SortingHat invalidated, see `Enrich.sync_identities_cache`
+
+    def get(self, region, key, load):
+        """Return the value of a key, calling `load` to get it when it is not cached
+
+        :param region: region of the key (e.g., uuids)
+        :param key: hashable key of the entry
+        :param load: function without params returning the value of the key
+        """
+        with self.lock:
+            found, value = self.__lookup(region, key, time.monotonic())
+        if found:
+            return value
+
+        # Loaded without the lock, it can take a query to SortingHat
+        value = load()
+        self.put(region, key, value)
+
+        return value
+
+    def get_many(self, region, keys):
+        """Return the values of the keys found in the cache
+
+        :param region: region of the keys
+        :param keys: iterable of keys
+        :return: dict with the values found by key
+        """
+        now = time.monotonic()
+        values = {}
+
+        with self.lock:
+            for key in keys:
+                found, value = self.__lookup(region, key, now)
+                if found:
+                    values[key] = value
+
+        return values
+
+    def items(self, region):
+        """Return a list of tuples (key, value) with the entries of a region not expired
+
+        :param region: region of the entries
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            entries = self.regions.get(region, {})
+            return [(key, value) for key, (value, expires) in entries.items()
+                    if expires is None or expires > now]
+
+    def put(self, region, key, value):
+        """Add or replace an entry, evicting the least recently used ones if the region is full
+
+        :param region: region of the key
+        :param key: hashable key of the entry
+        :param value: value of the entry
+        """
+        self.put_many(region, {key: value})
+
+    def put_many(self, region, values):
+        """Add or replace the entries of a dict of values by key
+
+        :param region: region of the keys
+        :param values: dict with the values by key
+        """
+        now = time.monotonic()
+        expires = now + self.ttl if self.ttl else None
+        miss_expires = now + min(self.ttl, self.miss_ttl) if self.ttl else now + self.miss_ttl
+
+        with self.lock:
+            entries = self.regions.get(region, None)
+            if entries is None:
+                entries = OrderedDict()
+                self.regions[region] = entries
+
+            for key, value in values.items():
+                ids = [entry_id for entry_id in get_entry_ids(region, key, value) if entry_id]
+                if key in entries:
+                    self.__unref(region, key, entries[key][0])
+                # The misses are referenced by None, to remove them on any invalidation
+                entries[key] = (value, expires if ids else miss_expires)
+                ids = ids or [None]
+                entries.move_to_end(key)
+                if self.added is not None:
+                    self.added.setdefault(region, set()).add(key)
+                for entry_id in ids:
+                    self.refs.setdefault(entry_id, set()).add((region, key))
+            while len(entries) > self.max_size:
+                key, (value, _) = entries.popitem(last=False)
+                self.__unref(region, key, value)
+                self.__incr(region, 'evictions')
+
+    def __lookup(self, region, key, now):
+        """Return a tuple (found, value) for a key, the lock must be held"""
+
+        entries = self.regions.get(region, None)
+        if entries is not None and key in entries:
+            value, expires = entries[key]
+            if expires is None or expires > now:
+                entries.move_to_end(key)
+                self.__incr(region, 'hits')
+                return True, value
+            del entries[key]
+            self.__unref(region, key, value)
+            self.__incr(region, 'expired')
+        self.__incr(region, 'misses')
+
+        return False, None
+
+    def __unref(self, region, key, value):
+        """Remove an entry from the references of its ids, the lock must be held"""
+
+        for entry_id in get_entry_ids(region, key, value):
+            refs = self.refs.get(entry_id, None)
+            if refs is None:
+                continue
+            refs.discard((region, key))
+            if not refs:
+                del self.refs[entry_id]
+
+    def invalidate(self, ids=None):
+        """Remove the entries of some identities or unique identities (e.g.,
+        added, merged or deleted in SortingHat), or all of them.
+
+        The entries keyed by the ids and the ones referring to them (e.g.,
+        the ids and uuid of an identity merged into other unique identity)
+        are removed, together with the entries not referring to any identity.
+
+        :param ids: ids or uuids of SortingHat, None to remove all the entries
+        """
+        with self.lock:
+            self.generation += 1
+            if ids is None:
+                self.regions = {}
+                self.refs = {}
+                if self.added is not None:
+                    self.added = {}
+                return
+
+            for entry_id in list(ids) + [None]:
+                for region, key in self.refs.pop(entry_id, ()):
+                    entries = self.regions.get(region, {})
+                    if key in entries:
+                        value, _ = entries.pop(key)
+                        self.__unref(region, key, value)
+
+    def track_added(self):
+        """Start tracking the entries added, to be returned by `pop_added`"""
+
+        with self.lock:
+            self.added = {}
+
+    def pop_added(self, regions=None):
+        """Return the entries added since the last call and still cached,
+        to be added to the cache of other process, and reset them.
+
+        :param regions: regions of the entries to return, None for all of them
+        :return: dict with the values by key of each region
+        """
+        with self.lock:
+            if not self.added:
+                return {}
+
+            added = {}
+            for region, keys in self.added.items():
+                if regions is not None and region not in regions:
+                    continue
+                entries = self.regions.get(region, {})
+                values = {key: entries[key][0] for key in keys if key in entries}
+                if values:
+                    added[region] = values
+            self.added = {}
+
+        return added
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(entries) for entries in self.regions.values())
+
+    def __incr(self, region, name):
+        stats = self.stats.get(region, None)
+        if not stats:
+            stats = dict.fromkeys(STATS, 0)
+            self.stats[region] = stats
+        stats[name] += 1
+
+    def pop_stats(self):
+        """Return the stats of the regions, to be merged into the cache of
+        other process (see `merge_stats`), and reset them"""
+
+        with self.lock:
+            stats = self.stats
+            self.stats = {}
+
+        return stats
+
+    def merge_stats(self, stats):
+        """Add the stats returned by `pop_stats`"""
+
+        if not stats:
+            return
+
+        with self.lock:
+            for region, region_stats in stats.items():
+                current = self.stats.setdefault(region, dict.fromkeys(STATS, 0))
+                for name, value in region_stats.items():
+                    current[name] += value
+
+    def end_run(self, run, backend):
+        """Log the stats of the current run, add them to the run metrics, and reset them
+
+        :param run: name of the run (e.g., enrich)
+        :param backend: name of the backend
+        """
+        stats = self.pop_stats()
+
+        for region, region_stats in sorted(stats.items()):
+            lookups = region_stats['hits'] + region_stats['misses']
+            hit_rate = region_stats['hits'] / lookups if lookups else 0
+            logger.info("[{}] {} identities cache {}: {} hits, {} misses, {} evictions, {} expired, "
+                        "{:.2%} hit rate, {} entries".format(
+                            backend, run, region, region_stats['hits'], region_stats['misses'],
+                            region_stats['evictions'], region_stats['expired'], hit_rate,
+                            len(self.regions.get(region, ()))))
+            for name, value in region_stats.items():
+                metrics.incr('identities_cache.{}.{}'.format(region, name), value)
+
+        return stats
+
+
+# Cache of the identities of the current process
+identities_cache = IdentitiesCache()
@@ -25,12 +25,12 @@ from grimoirelab_toolkit.datetime import (datetime_utcnow,
                                           str_to_datetime)
 
 from .enrich import Enrich, metadata, SH_UNKNOWN_VALUE
+from ..elastic import BulkWriter
 from ..elastic_mapping import Mapping as BaseMapping
 
 from .utils import get_time_diff_days
 
 
-MAX_SIZE_BULK_ENRICHED_ITEMS = 200
 ISSUE_TYPE = 'issue'
 COMMENT_TYPE = 'comment'
 
@@ -73,6 +73,8 @@ class Mapping(BaseMapping):
 class JiraEnrich(Enrich):
 
     mapping = Mapping
+    checkpoints_enrich_items = True
+    RAW_FIELDS_EXCLUDES = ["data.renderedFields", "data.operations", "data.transitions"]
 
     roles = ["assignee", "reporter", "creator", "author", "updateAuthor"]
 
@@ -139,6 +141,9 @@ class JiraEnrich(Enrich):
         repo += "projects/" + eitem['project_key']
         return repo
 
+    def get_project_fields(self):
+        return ['origin', 'project_key']
+
     def get_users_data(self, item):
         """ If user fields are inside the global item dict """
         if 'data' in item:
@@ -419,12 +424,10 @@ class JiraEnrich(Enrich):
     def get_field_unique_id(self):
         return "id"
 
-    def enrich_items(self, ocean_backend):
-        items_to_enrich = []
-        num_items = 0
-        ins_items = 0
+    def get_rich_docs(self, items, events=False):
+        docs = []
 
-        for item in ocean_backend.fetch():
+        for item in items:
             # This condition should never happen, since the enriched
             # data heavily relies on the `fields` attribute
             if "fields" not in item["data"]:
@@ -435,25 +438,26 @@ class JiraEnrich(Enrich):
             eitem_assignee = self.get_rich_item(item, author_type='assignee')
             eitem_reporter = self.get_rich_item(item, author_type='reporter')
 
-            items_to_enrich.append(eitem_creator)
-            items_to_enrich.append(eitem_assignee)
-            items_to_enrich.append(eitem_reporter)
+            docs.append((eitem_creator, eitem_creator[self.get_field_unique_id()]))
+            docs.append((eitem_assignee, eitem_assignee[self.get_field_unique_id()]))
+            docs.append((eitem_reporter, eitem_reporter[self.get_field_unique_id()]))
 
             comments = item['data'].get('comments_data', [])
             if comments:
                 rich_item_comments = self.get_rich_item_comments(comments, eitem_creator)
-                items_to_enrich.extend(rich_item_comments)
+                docs.extend([(ritem, ritem[self.get_field_unique_id()]) for ritem in rich_item_comments])
 
-            if len(items_to_enrich) < MAX_SIZE_BULK_ENRICHED_ITEMS:
-                continue
+        return docs
+
+    def enrich_items(self, ocean_backend):
+        writer = BulkWriter(self.elastic)
 
-            num_items += len(items_to_enrich)
-            ins_items += self.elastic.bulk_upload(items_to_enrich, self.get_field_unique_id())
-            items_to_enrich = []
+        for rich_item, item_id in self.fetch_rich_docs(ocean_backend.fetch(), writer=writer):
+            writer.add(rich_item, item_id)
 
-        if len(items_to_enrich) > 0:
-            num_items += len(items_to_enrich)
-            ins_items += self.elastic.bulk_upload(items_to_enrich, self.get_field_unique_id())
+        writer.flush()
+        num_items = writer.total_items
+        ins_items = writer.total
 
         if num_items != ins_items:
             missing = num_items - ins_items
@@ -19,10 +19,10 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
 import logging
 
 from .enrich import Enrich, metadata
+from ..elastic import BulkWriter
 from .utils import get_time_diff_days, anonymize_url
 from ..elastic_mapping import Mapping as BaseMapping
 from grimoirelab_toolkit.datetime import str_to_datetime
@@ -212,28 +212,14 @@ class KitsuneEnrich(Enrich):
         return eitem
 
     def enrich_items(self, ocean_backend):
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        bulk_json = ""
-        total = 0
+        writer = BulkWriter(self.elastic)
 
-        url = self.elastic.get_bulk_url()
-
-        logger.debug("[kitsune] Adding items to {} (in {} packs)".format(anonymize_url(url), max_items))
+        logger.debug("[kitsune] Adding items to {}".format(anonymize_url(writer.url)))
 
         items = ocean_backend.fetch()
         for item in items:
-            if current >= max_items:
-                total += self.elastic.safe_put_bulk(url, bulk_json)
-                bulk_json = ""
-                current = 0
-
             rich_item = self.get_rich_item(item)
-            data_json = json.dumps(rich_item)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                (item[self.get_field_unique_id()])
-            bulk_json += data_json + "\n"  # Bulk document
-            current += 1
+            writer.add(rich_item, item[self.get_field_unique_id()])
             # Time to enrich also de answers
             if 'answers_data' in item['data']:
                 for answer in item['data']['answers_data']:
@@ -243,14 +229,9 @@ class KitsuneEnrich(Enrich):
                     if answer['id'] == item['data']['solution']:
                         answer['solution'] = 1
                     rich_answer = self.get_rich_item(answer, kind='answer')
-                    data_json = json.dumps(rich_answer)
-                    bulk_json += '{"index" : {"_id" : "%s_%i" } }\n' % \
-                        (item[self.get_field_unique_id()],
-                         rich_answer['answer_id'])
-                    bulk_json += data_json + "\n"  # Bulk document
-                    current += 1
+                    writer.add(rich_answer, "{}_{}".format(item[self.get_field_unique_id()],
+                                                           rich_answer['answer_id']))
 
-        if current > 0:
-            total += self.elastic.safe_put_bulk(url, bulk_json)
+        writer.flush()
 
-        return total
+        return writer.total
@@ -25,12 +25,10 @@ import logging
 from grimoirelab_toolkit.datetime import unixtime_to_datetime
 
 from .enrich import Enrich, metadata
+from ..elastic import BulkWriter
 from ..elastic_mapping import Mapping as BaseMapping
 
 
-MAX_SIZE_BULK_ENRICHED_ITEMS = 200
-
-
 logger = logging.getLogger(__name__)
 
 
@@ -115,6 +113,9 @@ class MeetupEnrich(Enrich):
     def get_project_repository(self, eitem):
         return eitem['tag']
 
+    def get_project_fields(self):
+        return ['origin', 'tag']
+
     @metadata
     def get_rich_item(self, item):
         # We need to detect the category of item: activities (report), events or users
@@ -345,9 +346,7 @@ class MeetupEnrich(Enrich):
         return "id"
 
     def enrich_items(self, ocean_backend):
-        items_to_enrich = []
-        num_items = 0
-        ins_items = 0
+        writer = BulkWriter(self.elastic)
 
         for item in ocean_backend.fetch():
             eitem = self.get_rich_item(item)
@@ -355,28 +354,21 @@ class MeetupEnrich(Enrich):
             if 'uuid' not in eitem:
                 continue
 
-            items_to_enrich.append(eitem)
+            writer.add(eitem, eitem[self.get_field_unique_id()])
 
             if 'comments' in item['data'] and 'id' in eitem:
                 comments = item['data']['comments']
                 rich_item_comments = self.get_rich_item_comments(comments, eitem)
-                items_to_enrich.extend(rich_item_comments)
+                writer.add_items(rich_item_comments, self.get_field_unique_id())
 
             if 'rsvps' in item['data'] and 'id' in eitem:
                 rsvps = item['data']['rsvps']
                 rich_item_rsvps = self.get_rich_item_rsvps(rsvps, eitem)
-                items_to_enrich.extend(rich_item_rsvps)
-
-            if len(items_to_enrich) < MAX_SIZE_BULK_ENRICHED_ITEMS:
-                continue
-
-            num_items += len(items_to_enrich)
-            ins_items += self.elastic.bulk_upload(items_to_enrich, self.get_field_unique_id())
-            items_to_enrich = []
+                writer.add_items(rich_item_rsvps, self.get_field_unique_id())
 
-        if len(items_to_enrich) > 0:
-            num_items += len(items_to_enrich)
-            ins_items += self.elastic.bulk_upload(items_to_enrich, self.get_field_unique_id())
+        writer.flush()
+        num_items = writer.total_items
+        ins_items = writer.total
 
         if num_items != ins_items:
             missing = num_items - ins_items
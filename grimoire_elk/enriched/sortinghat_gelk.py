@@ -19,19 +19,38 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-from datetime import datetime
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime, timedelta
+import json
 import logging
+import sqlite3
+import time
 
-from sortinghat import api
-from sortinghat.db.model import Identity
+from grimoirelab_toolkit.datetime import str_to_datetime
+from sqlalchemy.orm import contains_eager, joinedload
+
+from sortinghat import api, utils
+from sortinghat.db.api import (add_identity as add_identity_db,
+                               add_unique_identity as add_unique_identity_db,
+                               edit_profile as edit_profile_db)
+from sortinghat.db.model import Enrollment, Identity, Organization, Profile, UniqueIdentity
 from sortinghat.exceptions import AlreadyExistsError, InvalidValueError
 
+from .identities_cache import get_entry_ids, identities_cache
+
 
 logger = logging.getLogger(__name__)
 
 
 MULTI_ORG_NAMES = '_multi_org_names'
 
+# Read-only copies of the SortingHat model objects, with the attributes read when enriching
+SnapshotUniqueIdentity = namedtuple('SnapshotUniqueIdentity', ['uuid', 'profile'])
+SnapshotProfile = namedtuple('SnapshotProfile', ['name', 'email', 'gender', 'gender_acc', 'is_bot'])
+SnapshotEnrollment = namedtuple('SnapshotEnrollment', ['start', 'end', 'organization'])
+SnapshotOrganization = namedtuple('SnapshotOrganization', ['name'])
+
 
 class SortingHat(object):
 
@@ -47,6 +66,104 @@ class SortingHat(object):
                 uuid = identities[0].uuid
         return uuid
 
+    @classmethod
+    def get_modified_identities(cls, db, after):
+        """Get the identities and unique identities modified (e.g., added,
+        merged, enrolled or with the profile edited) since a date.
+
+        :param db: SortingHat database
+        :param after: naive (UTC) date
+        :return: tuple with the list of identities ids and the list of unique identities uuids
+        """
+        with db.connect() as session:
+            query = session.query(Identity.id).\
+                filter(Identity.last_modified >= after)
+            sh_ids = [sh_id for sh_id, in query.all()]
+            query = session.query(UniqueIdentity.uuid).\
+                filter(UniqueIdentity.last_modified >= after)
+            uuids = [uuid for uuid, in query.all()]
+        return sh_ids, uuids
+
+    @classmethod
+    def get_identities_ids(cls, db, backend):
+        """Get the ids of the identities of a data source in a single query.
+
+        :param db: SortingHat database
+        :param backend: source of the identities (e.g., git)
+        :return: set with the identities identifiers
+        """
+        with db.connect() as session:
+            query = session.query(Identity.id).\
+                filter(Identity.source == backend)
+            sh_ids = {sh_id for sh_id, in query.all()}
+        return sh_ids
+
+    @classmethod
+    def get_identity_id(cls, identity, backend):
+        """Get the id an identity has (or would have) in SortingHat.
+
+        :param identity: dict with the email, name and username of the identity
+        :param backend: source of the identity
+        :return: identity identifier, None if the identity is not valid
+        """
+        try:
+            return utils.uuid(backend, email=identity.get('email', None),
+                              name=identity.get('name', None), username=identity.get('username', None))
+        except (InvalidValueError, UnicodeEncodeError):
+            return None
+
+    @classmethod
+    def get_uuids_from_ids(cls, db, sh_ids):
+        """Get the uuids of a list of identities in a single query.
+
+        :param db: SortingHat database
+        :param sh_ids: identities identifiers
+        :return: dict with the uuid of each identity found
+        """
+        with db.connect() as session:
+            query = session.query(Identity.id, Identity.uuid).\
+                filter(Identity.id.in_(sh_ids))
+            uuids = {sh_id: uuid for sh_id, uuid in query.all()}
+        return uuids
+
+    @classmethod
+    def get_unique_identities(cls, db, uuids):
+        """Get a list of unique identities, with their profiles, in a single query.
+
+        :param db: SortingHat database
+        :param uuids: unique identities identifiers
+        :return: dict with the unique identities found by uuid
+        """
+        with db.connect() as session:
+            query = session.query(UniqueIdentity).\
+                options(joinedload(UniqueIdentity.profile)).\
+                filter(UniqueIdentity.uuid.in_(uuids))
+            uidentities = {uidentity.uuid: uidentity for uidentity in query.all()}
+            session.expunge_all()
+        return uidentities
+
+    @classmethod
+    def get_enrollments(cls, db, uuids):
+        """Get the enrollments of a list of unique identities in a single query.
+        The enrollments of each identity are sorted as in `api.enrollments`.
+
+        :param db: SortingHat database
+        :param uuids: unique identities identifiers
+        :return: dict with the list of enrollments by uuid
+        """
+        enrollments = {uuid: [] for uuid in uuids}
+
+        with db.connect() as session:
+            query = session.query(Enrollment).\
+                join(Organization).\
+                options(contains_eager(Enrollment.organization)).\
+                filter(Enrollment.uuid.in_(uuids)).\
+                order_by(Enrollment.uuid, Organization.name, Enrollment.start, Enrollment.end)
+            for enrollment in query.all():
+                enrollments[enrollment.uuid].append(enrollment)
+            session.expunge_all()
+        return enrollments
+
     @classmethod
     def add_identity(cls, db, identity, backend):
         """ Load and identity list from backend in Sorting Hat """
@@ -93,17 +210,60 @@ class SortingHat(object):
         logger.debug("[sortinghat] Adding identities")
 
         total = 0
+        uuids = []
 
         for identity in identities:
             try:
-                cls.add_identity(db, identity, backend)
+                uuids.append(cls.add_identity(db, identity, backend))
                 total += 1
             except Exception as e:
                 logger.error("[sortinghat] Unexcepted error when adding identities: {}".format(e))
                 continue
 
+        # The identities (not found before) and their enrollments could be cached
+        identities_cache.invalidate([uuid for uuid in uuids if uuid])
+
         logger.debug("[sortinghat] Total identities added: {}".format(total))
 
+    @classmethod
+    def add_new_identities(cls, db, identities, backend):
+        """Add identities not found in SortingHat (see `get_identities_ids`)
+        in a single transaction, each one with a new unique identity and
+        profile, as `add_identity` does. If the transaction fails (e.g., an
+        identity was added meanwhile), they are added one by one with
+        `add_identities`. The identities with a company are added with
+        `add_identities` too, to enroll them.
+
+        :param db: SortingHat database
+        :param identities: list of identities, with distinct ids
+        :param backend: source of the identities
+        """
+        one_by_one = [identity for identity in identities if identity.get('company', None) is not None]
+        identities = [identity for identity in identities if identity.get('company', None) is None]
+
+        sh_ids = []
+        try:
+            with db.connect() as session:
+                for identity in identities:
+                    sh_id = cls.get_identity_id(identity, backend)
+                    if not sh_id:
+                        continue
+                    uidentity = add_unique_identity_db(session, sh_id)
+                    add_identity_db(session, uidentity, sh_id, backend, name=identity['name'],
+                                    email=identity['email'], username=identity['username'])
+                    edit_profile_db(session, uidentity,
+                                    name=identity['name'] if identity['name'] else identity['username'],
+                                    email=identity['email'])
+                    sh_ids.append(sh_id)
+            identities_cache.invalidate(sh_ids)
+            logger.debug("[sortinghat] Total identities added in bulk: {}".format(len(sh_ids)))
+        except Exception as e:
+            logger.warning("[sortinghat] Identities not added in bulk due to {}, adding them one by one".format(e))
+            one_by_one = identities + one_by_one
+
+        if one_by_one:
+            cls.add_identities(db, one_by_one, backend)
+
     @classmethod
     def remove_identity(cls, sh_db, ident_id):
         """Delete an identity from SortingHat.
@@ -114,6 +274,7 @@ class SortingHat(object):
         success = False
         try:
             api.delete_identity(sh_db, ident_id)
+            identities_cache.invalidate([ident_id])
             logger.debug("[sortinghat] Identity {} deleted".format(ident_id))
             success = True
         except Exception as e:
@@ -131,6 +292,7 @@ class SortingHat(object):
         success = False
         try:
             api.delete_unique_identity(sh_db, uuid)
+            identities_cache.invalidate([uuid])
             logger.debug("[sortinghat] Unique identity {} deleted".format(uuid))
             success = True
         except Exception as e:
@@ -149,3 +311,341 @@ class SortingHat(object):
                 yield unique_identity
         except Exception as e:
             logger.debug("[sortinghat] Unique identities not returned due to {}".format(e))
+
+
+class IdentitiesSnapshot:
+    """In-memory copy of the identities, profiles and enrollments of
+    SortingHat, loaded with a few bulk queries (see `load`), so the
+    identities of the items are resolved without querying the database.
+
+    The profiles and enrollments are returned as named tuples with the
+    same attributes as the SortingHat model objects read when enriching
+    (e.g., `uidentity.profile.is_bot`, `enrollment.organization.name`).
+    The lookups return None when the identity is not in the snapshot.
+
+    :param identities: iterable of (identity id, uuid)
+    :param profiles: iterable of (uuid, name, email, gender, gender_acc, is_bot)
+    :param enrollments: iterable of (uuid, organization name, start, end), sorted
+        as in `api.enrollments`
+    """
+
+    def __init__(self, identities, profiles=(), enrollments=()):
+        # The same uuid (and organization) is kept once in memory
+        uuids = {}
+        organizations = {}
+
+        self.uuids = {}
+        for sh_id, uuid in identities:
+            self.uuids[sh_id] = uuids.setdefault(uuid, uuid)
+
+        self.uidentities = {uuid: SnapshotUniqueIdentity(uuid, None) for uuid in uuids}
+        for uuid, name, email, gender, gender_acc, is_bot in profiles:
+            uuid = uuids.setdefault(uuid, uuid)
+            profile = SnapshotProfile(name, email, gender, gender_acc, is_bot)
+            self.uidentities[uuid] = SnapshotUniqueIdentity(uuid, profile)
+
+        self.enrollments = {}
+        n_enrollments = 0
+        for uuid, org_name, start, end in enrollments:
+            uuid = uuids.setdefault(uuid, uuid)
+            organization = organizations.setdefault(org_name, SnapshotOrganization(org_name))
+            self.enrollments.setdefault(uuid, []).append(SnapshotEnrollment(start, end, organization))
+            n_enrollments += 1
+
+        self.n_enrollments = n_enrollments
+
+    @classmethod
+    def load(cls, db, sources=None):
+        """Load the identities of some sources, and the profiles and enrollments
+        of their unique identities, with a query each.
+
+        :param db: SortingHat database
+        :param sources: sources of the identities (e.g., git), None to load all of them
+        :return: an IdentitiesSnapshot
+        """
+        before = time.time()
+
+        with db.connect() as session:
+            query = session.query(Identity.id, Identity.uuid)
+            uuids = session.query(Identity.uuid)
+            if sources:
+                query = query.filter(Identity.source.in_(sources))
+                uuids = uuids.filter(Identity.source.in_(sources))
+            identities = query.all()
+
+            query = session.query(Profile.uuid, Profile.name, Profile.email,
+                                  Profile.gender, Profile.gender_acc, Profile.is_bot)
+            if sources:
+                query = query.filter(Profile.uuid.in_(uuids))
+            profiles = query.all()
+
+            query = session.query(Enrollment.uuid, Organization.name, Enrollment.start, Enrollment.end).\
+                join(Organization)
+            if sources:
+                query = query.filter(Enrollment.uuid.in_(uuids))
+            query = query.order_by(Enrollment.uuid, Organization.name, Enrollment.start, Enrollment.end)
+            enrollments = query.all()
+
+        snapshot = cls(identities, profiles, enrollments)
+
+        logger.info("[sortinghat] Snapshot of {} identities, {} unique identities and {} enrollments "
+                    "loaded in {:.2f} sec (sources: {})".format(
+                        len(snapshot.uuids), len(snapshot.uidentities), snapshot.n_enrollments,
+                        time.time() - before, sources if sources else 'all'))
+        return snapshot
+
+    def get_uuid(self, sh_id):
+        """Return the uuid of an identity, None if it is not in the snapshot"""
+
+        return self.uuids.get(sh_id, None)
+
+    def get_unique_identity(self, uuid):
+        """Return the unique identity, with its profile, None if it is not in the snapshot"""
+
+        return self.uidentities.get(uuid, None)
+
+    def get_enrollments(self, uuid):
+        """Return the enrollments of a unique identity, None if it is not in the snapshot"""
+
+        if uuid not in self.uidentities:
+            return None
+
+        return self.enrollments.get(uuid, [])
+
+
+class EnrollmentsIndex:
+    """Organizations of the enrollments of a unique identity by date.
+
+    The start and end dates of the enrollments split the time in
+    elementary intervals: the dates themselves and the gaps between them.
+    The organizations enrolled in each interval are computed once, so the
+    organizations at a date are found with a binary search. They are
+    kept in the order of the enrollments (see `api.enrollments`), so the
+    first one is the organization of the identity at that date.
+
+    :param enrollments: enrollments of the unique identity, with naive (UTC) dates
+    """
+    __slots__ = ['organizations', 'dates', 'intervals']
+
+    def __init__(self, enrollments):
+        self.organizations = tuple(enrollment.organization.name for enrollment in enrollments)
+        self.dates = sorted({date for enrollment in enrollments for date in (enrollment.start, enrollment.end)})
+
+        # intervals[2 * i] is the gap before dates[i], intervals[2 * i + 1] is dates[i]
+        # and the last one is the gap after the last date, with no enrollments
+        self.intervals = []
+        before = None
+        for date in self.dates:
+            if before is None:
+                self.intervals.append(())
+            else:
+                self.intervals.append(tuple(enrollment.organization.name for enrollment in enrollments
+                                            if enrollment.start <= before and date <= enrollment.end))
+            self.intervals.append(tuple(enrollment.organization.name for enrollment in enrollments
+                                        if enrollment.start <= date <= enrollment.end))
+            before = date
+        self.intervals.append(())
+
+    def organizations_at(self, date):
+        """Return the organizations enrolled at a date, all of them if `date` is None
+
+        :param date: naive (UTC) date
+        :return: tuple of organization names
+        """
+        if date is None:
+            return self.organizations
+
+        pos = bisect_left(self.dates, date)
+        if pos < len(self.dates) and self.dates[pos] == date:
+            return self.intervals[2 * pos + 1]
+
+        return self.intervals[2 * pos]
+
+    def is_constant_on(self, date):
+        """Return whether the organizations enrolled are the same during the
+        whole day of a date, i.e., no enrollment starts or ends that day
+
+        :param date: naive (UTC) date
+        """
+        start = datetime(date.year, date.month, date.day)
+        pos = bisect_left(self.dates, start)
+
+        return pos == len(self.dates) or self.dates[pos] >= start + timedelta(days=1)
+
+
+class IdentitiesCacheStore:
+    """SQLite file where the SortingHat lookups of the identities cache
+    (see `IdentitiesCache`) are kept between runs.
+
+    The entries saved at the end of a run (see `save`) are loaded at the
+    beginning of the next one (see `load`), except the ones of the
+    identities and unique identities modified in SortingHat since the
+    previous run (according to their `last_modified` dates), which are
+    removed. The unique identities and enrollments are loaded as the
+    named tuples of `IdentitiesSnapshot`.
+
+    :param path: path of the SQLite file, created if it doesn't exist
+    """
+    version = 1  # version of the format of the entries, the entries of other versions are removed
+    regions = ['sh_ids', 'uuids', 'uidentities', 'enrollments']
+    sync_margin = timedelta(minutes=5)  # changes in SortingHat done this time before the previous run are refetched
+    max_params = 500  # ids or uuids removed per statement
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.synced = None
+
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS entries (region TEXT, key TEXT, value TEXT, "
+                              "sh_id TEXT, uuid TEXT, PRIMARY KEY (region, key))")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_sh_id ON entries (sh_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_uuid ON entries (uuid)")
+
+            if self.__get_meta('version') != str(self.version):
+                self.conn.execute("DELETE FROM entries")
+                self.conn.execute("DELETE FROM meta")
+                self.__set_meta('version', str(self.version))
+
+    def close(self):
+        self.conn.close()
+
+    def load(self, cache, db):
+        """Remove the entries of the identities modified in SortingHat since
+        the previous run, and add the rest of them to the cache.
+
+        :param cache: IdentitiesCache where the entries are added
+        :param db: SortingHat database
+        :return: number of entries loaded
+        """
+        before = time.time()
+        # Date of the changes in SortingHat that the next run must refetch
+        self.synced = datetime.utcnow() - self.sync_margin
+
+        synced = self.__get_meta('synced')
+        if not synced:
+            return 0
+
+        sh_ids, uuids = SortingHat.get_modified_identities(db, str_to_datetime(synced).replace(tzinfo=None))
+        with self.conn:
+            # The identities not found could be in SortingHat now
+            self.conn.execute("DELETE FROM entries WHERE uuid IS NULL")
+            self.__delete('sh_id', sh_ids)
+            self.__delete('uuid', uuids)
+
+        n_entries = 0
+        for region in self.regions:
+            rows = self.conn.execute("SELECT key, value FROM entries WHERE region = ?", (region,))
+            values = {self.__decode_key(region, key): self.__decode_value(region, value) for key, value in rows}
+            cache.put_many(region, values)
+            n_entries += len(values)
+
+        logger.info("[sortinghat] {} cached lookups loaded from {} in {:.2f} sec, {} identities and "
+                    "{} unique identities modified since {}".format(
+                        n_entries, self.path, time.time() - before, len(sh_ids), len(uuids), synced))
+        return n_entries
+
+    def save(self, cache):
+        """Save the entries of the cache, and the date of the changes in
+        SortingHat to refetch in the next run.
+
+        :param cache: IdentitiesCache with the entries to save
+        :return: number of entries saved
+        """
+        n_entries = 0
+
+        try:
+            with self.conn:
+                for region in self.regions:
+                    rows = []
+                    for key, value in cache.items(region):
+                        # The ids to remove the entry when any of them is modified
+                        sh_id, uuid = get_entry_ids(region, key, value)
+                        rows.append((region, self.__encode_key(region, key), self.__encode_value(region, value),
+                                     sh_id, uuid))
+                    self.conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", rows)
+                    n_entries += len(rows)
+                if self.synced:
+                    self.__set_meta('synced', self.synced.isoformat())
+        except sqlite3.Error as ex:
+            logger.error("[sortinghat] Cached lookups not saved to {}: {}".format(self.path, ex))
+            return 0
+
+        logger.debug("[sortinghat] {} cached lookups saved to {}".format(n_entries, self.path))
+        return n_entries
+
+    @classmethod
+    def encode_entries(cls, entries):
+        """Encode the entries of the regions kept by the store (e.g., the
+        ones returned by `IdentitiesCache.pop_added`) to send them to other
+        process, see `decode_entries`.
+
+        :param entries: dict with the values by key of each region
+        :return: dict with a list of tuples (key, value) encoded for each region
+        """
+        return {region: [(cls.__encode_key(region, key), cls.__encode_value(region, value))
+                         for key, value in values.items()]
+                for region, values in entries.items() if region in cls.regions}
+
+    @classmethod
+    def decode_entries(cls, data):
+        """Decode the entries encoded with `encode_entries`
+
+        :param data: dict with a list of tuples (key, value) encoded for each region
+        :return: dict with the values by key of each region
+        """
+        return {region: {cls.__decode_key(region, key): cls.__decode_value(region, value) for key, value in rows}
+                for region, rows in data.items()}
+
+    def __delete(self, column, values):
+        for pos in range(0, len(values), self.max_params):
+            chunk = values[pos:pos + self.max_params]
+            self.conn.execute("DELETE FROM entries WHERE {} IN ({})".format(column, ",".join("?" * len(chunk))),
+                              chunk)
+
+    def __get_meta(self, name):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def __set_meta(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, value))
+
+    @staticmethod
+    def __encode_key(region, key):
+        if region == 'sh_ids':
+            identity_tuple, backend_name = key
+            return json.dumps([identity_tuple, backend_name])
+        return key
+
+    @staticmethod
+    def __decode_key(region, key):
+        if region == 'sh_ids':
+            identity_tuple, backend_name = json.loads(key)
+            return tuple(tuple(field) for field in identity_tuple), backend_name
+        return key
+
+    @staticmethod
+    def __encode_value(region, value):
+        if region == 'uidentities':
+            profile = value.profile
+            if profile:
+                profile = [profile.name, profile.email, profile.gender, profile.gender_acc, profile.is_bot]
+            value = [value.uuid, profile]
+        elif region == 'enrollments':
+            value = [[enrollment.organization.name, enrollment.start.isoformat(), enrollment.end.isoformat()]
+                     for enrollment in value]
+        return json.dumps(value)
+
+    @staticmethod
+    def __decode_value(region, value):
+        value = json.loads(value)
+        if region == 'uidentities':
+            uuid, profile = value
+            value = SnapshotUniqueIdentity(uuid, SnapshotProfile(*profile) if profile else None)
+        elif region == 'enrollments':
+            value = [SnapshotEnrollment(str_to_datetime(start).replace(tzinfo=None),
+                                        str_to_datetime(end).replace(tzinfo=None),
+                                        SnapshotOrganization(org_name))
+                     for org_name, start, end in value]
+        return value
@@ -56,6 +56,7 @@ class Mapping(BaseMapping):
 class StackExchangeEnrich(Enrich):
 
     mapping = Mapping
+    RAW_FIELDS_EXCLUDES = ["data.body_markdown", "data.answers.body_markdown"]
 
     def get_field_unique_id(self):
         return "item_id"
@@ -43,10 +43,11 @@ class ESPandasConnector(ESConnector):
     Writing is also ready to work directly with Pandas dataframes.
     """
 
-    def __init__(self, es_conn, es_index, sort_on_field='metadata__timestamp', repo=None, read_only=True):
+    def __init__(self, es_conn, es_index, sort_on_field='metadata__timestamp', repo=None, read_only=True,
+                 unique_field='uuid'):
 
         super().__init__(es_conn=es_conn, es_index=es_index, sort_on_field=sort_on_field, repo=repo,
-                         read_only=read_only)
+                         read_only=read_only, unique_field=unique_field)
         self.__log_prefix = "[" + es_index + "] study areas_of_code "
 
     @staticmethod
@@ -91,12 +92,7 @@ class ESPandasConnector(ESConnector):
         search_query = self._build_search_query(from_date)
         logger.debug(self.__log_prefix + str(search_query))
         hits_block = []
-        for hit in helpers.scan(self._es_conn,
-                                search_query,
-                                scroll='300m',
-                                size=500,
-                                index=self._es_index,
-                                preserve_order=True):
+        for hit in self._read_hits(search_query, size=500):
 
             hits_block.append(hit["_source"])
 
@@ -119,6 +119,9 @@ class TwitterEnrich(Enrich):
 
         return eitem_project
 
+    def get_project_fields(self):
+        return ['hashtags_analyzed']
+
     @metadata
     def get_rich_item(self, item):
         eitem = {}
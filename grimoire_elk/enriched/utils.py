@@ -20,10 +20,12 @@
 #
 
 import datetime
+import gzip
 import inspect
 import json
 import logging
 import re
+from threading import Lock
 
 import requests
 import urllib3
@@ -31,6 +33,8 @@ import urllib3
 from grimoirelab_toolkit.datetime import (datetime_utcnow,
                                           str_to_datetime)
 
+from ..metrics import metrics
+
 
 BACKOFF_FACTOR = 0.2
 MAX_RETRIES = 21
@@ -40,6 +44,12 @@ MAX_RETRIES_ON_CONNECT = 21
 STATUS_FORCE_LIST = [408, 409, 429, 502, 503, 504]
 METADATA_FILTER_RAW = 'metadata__filter_raw'
 REPO_LABELS = 'repository_labels'
+COMPRESSED_PATHS = ['_bulk']
+
+PAGE_SIZE_MIN = 10
+PAGE_SIZE_MAX = 10000  # max number of hits returned by a search
+PAGE_TARGET_BYTES = 5 * 1024 * 1024  # 5 MB
+PAGE_TARGET_LATENCY = 2  # seconds
 
 logger = logging.getLogger(__name__)
 
@@ -115,7 +125,148 @@ def get_time_diff_days(start, end):
     return diff_days
 
 
-def grimoire_con(insecure=True, conn_retries=MAX_RETRIES_ON_CONNECT, total=MAX_RETRIES):
+class CompressionAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter which compresses with gzip the body of the requests
+    sent to the bulk API. Only those request bodies change: the responses
+    are already requested gzip encoded by `requests`. The bytes sent, before
+    and after the compression, are accumulated in the counters shared by
+    all the adapters (see `get_compression_stats`).
+
+    :param compression_level: gzip compression level (1-9)
+    """
+    stats = {
+        "sent_bytes": 0,  # size of the request bodies
+        "sent_compressed_bytes": 0  # size of the compressed request bodies
+    }
+    stats_lock = Lock()
+
+    def __init__(self, compression_level=6, **kwargs):
+        self.compression_level = compression_level
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        sent_bytes = 0
+        sent_compressed_bytes = 0
+
+        if self.__compress_body(request):
+            body = request.body
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            sent_bytes = len(body)
+            request.body = gzip.compress(body, compresslevel=self.compression_level)
+            request.headers['Content-Encoding'] = 'gzip'
+            request.headers['Content-Length'] = str(len(request.body))
+            sent_compressed_bytes = len(request.body)
+
+        with self.stats_lock:
+            self.stats["sent_bytes"] += sent_bytes
+            self.stats["sent_compressed_bytes"] += sent_compressed_bytes
+
+        return super().send(request, **kwargs)
+
+    @staticmethod
+    def __compress_body(request):
+        if not request.body or 'Content-Encoding' in request.headers:
+            return False
+
+        path = urllib3.util.parse_url(request.url).path or ''
+        return path.rstrip('/').split('/')[-1] in COMPRESSED_PATHS
+
+
+def get_compression_stats():
+    """Return a copy of the counters of the compressed traffic"""
+
+    with CompressionAdapter.stats_lock:
+        return dict(CompressionAdapter.stats)
+
+
+def log_compression_stats():
+    """Log the bytes saved by compressing the bulk requests, if any"""
+
+    stats = get_compression_stats()
+
+    if stats["sent_compressed_bytes"]:
+        logger.info("Compressed requests: {:.2f} MB sent instead of {:.2f} MB ({:.1f}x)".format(
+                    stats["sent_compressed_bytes"] / (1024 * 1024), stats["sent_bytes"] / (1024 * 1024),
+                    stats["sent_bytes"] / stats["sent_compressed_bytes"]))
+
+
+class AdaptivePageSize:
+    """Adapt the number of items of the pages read from ElasticSearch to the
+    observed responses. After each page, the size moves toward the one which
+    would produce responses of `target_bytes` in `target_latency` seconds,
+    at most doubling or halving it, and within `min_size` and `max_size`.
+    The sizes chosen are counted in the metrics, as `<name>.page_size.pages`,
+    `<name>.page_size.items` (sum of the sizes of the pages requested, so
+    their ratio is the mean page size) and `<name>.page_size.changes`.
+
+    :param size: initial number of items per page
+    :param min_size: min number of items per page
+    :param max_size: max number of items per page
+    :param target_bytes: target size of the responses, None to ignore it
+    :param target_latency: target time (in seconds) to get the responses, None to ignore it
+    :param name: prefix of the metrics of the page sizes
+    """
+    def __init__(self, size, min_size=PAGE_SIZE_MIN, max_size=PAGE_SIZE_MAX,
+                 target_bytes=PAGE_TARGET_BYTES, target_latency=PAGE_TARGET_LATENCY, name='fetch'):
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_bytes = target_bytes
+        self.target_latency = target_latency
+        self.size = max(min_size, min(size, max_size))
+
+        self.pages = 0
+        self.items = 0
+        self.bytes = 0
+        self.latency = 0
+        self.lock = Lock()
+
+    def update(self, n_items, latency, n_bytes=None):
+        """Update the page size with the results of a page
+
+        :param n_items: number of items of the page
+        :param latency: seconds spent to get the page
+        :param n_bytes: size of the response in bytes, None if not known
+
+        :returns: the new page size
+        """
+        with self.lock:
+            self.pages += 1
+            self.items += n_items
+            self.bytes += n_bytes if n_bytes else 0
+            self.latency += latency
+            metrics.incr(self.name + '.page_size.pages')
+            metrics.incr(self.name + '.page_size.items', self.size)
+
+            if not n_items:
+                return self.size
+
+            # Size of the pages which would reach each target, from the cost per item
+            sizes = []
+            if self.target_bytes and n_bytes:
+                sizes.append(self.target_bytes * n_items / n_bytes)
+            if self.target_latency and latency > 0:
+                sizes.append(self.target_latency * n_items / latency)
+
+            if not sizes:
+                return self.size
+
+            size = int(min(sizes))
+            size = max(self.size // 2, min(size, self.size * 2))
+            size = max(self.min_size, min(size, self.max_size))
+
+            if size != self.size:
+                logger.debug("Page size changed from {} to {} ({} items, {:.2f} MB, {:.2f} sec)".format(
+                             self.size, size, n_items, (n_bytes or 0) / (1024 * 1024), latency))
+                self.size = size
+                metrics.incr(self.name + '.page_size.changes')
+
+            return self.size
+
+
+def grimoire_con(insecure=True, conn_retries=MAX_RETRIES_ON_CONNECT, total=MAX_RETRIES,
+                 compression_level=None):
     conn = requests.Session()
     # {backoff factor} * (2 ^ ({number of total retries} - 1))
     # conn_retries = 21  # 209715.2 = 2.4d
@@ -124,7 +275,11 @@ def grimoire_con(insecure=True, conn_retries=MAX_RETRIES_ON_CONNECT, total=MAX_R
     retries = urllib3.util.Retry(total=total, connect=conn_retries, read=MAX_RETRIES_ON_READ,
                                  redirect=MAX_RETRIES_ON_REDIRECT, backoff_factor=BACKOFF_FACTOR,
                                  method_whitelist=False, status_forcelist=STATUS_FORCE_LIST)
-    adapter = requests.adapters.HTTPAdapter(max_retries=retries)
+    if compression_level:
+        # Compress the bulk requests
+        adapter = CompressionAdapter(compression_level=compression_level, max_retries=retries)
+    else:
+        adapter = requests.adapters.HTTPAdapter(max_retries=retries)
     conn.mount('http://', adapter)
     conn.mount('https://', adapter)
 
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Files used instead of ElasticSearch as source of the raw items and sink of the enriched ones"""
+
+import gzip
+import json
+import logging
+import os
+from contextlib import contextmanager
+from threading import Lock
+
+from .elastic import BulkResult, BulkWriter, ElasticSearch
+
+GZIP_SUFFIX = ".gz"
+READ_BLOCK_SIZE = 1024 * 1024  # chars read from the files of items at once
+FILE_URL_PREFIX = "file://"
+
+logger = logging.getLogger(__name__)
+
+
+def open_file(path, mode='r'):
+    """Open a file of items, gzipped if its name ends with `.gz`
+
+    :param path: path of the file
+    :param mode: 'r' to read text, 'w' or 'a' to write bytes
+    """
+    if mode != 'r':
+        mode += 'b'
+
+    if path.endswith(GZIP_SUFFIX):
+        if mode == 'r':
+            return gzip.open(path, 'rt', encoding='utf-8')
+        return gzip.open(path, mode)
+
+    if mode == 'r':
+        return open(path, 'r', encoding='utf-8')
+    return open(path, mode)
+
+
+def read_items(path):
+    """Read the JSON items of a file, optionally gzipped. The items can be
+    either one per line (NDJSON), concatenated (as dumped by the Perceval
+    command line, which indents them) or the elements of a JSON list.
+
+    :param path: path of the file
+    :returns: a generator of items
+    """
+    decoder = json.JSONDecoder()
+
+    with open_file(path) as fd:
+        buffer = fd.read(READ_BLOCK_SIZE).lstrip()
+        if buffer.startswith('['):
+            # The items are in a list, which is loaded at once
+            items = json.loads(buffer + fd.read())
+            yield from items
+            return
+
+        pos = 0
+        eof = not buffer
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+
+            if pos == len(buffer) and eof:
+                break
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise
+                # Incomplete item, read the next block
+                buffer = buffer[pos:]
+                pos = 0
+                block = fd.read(READ_BLOCK_SIZE)
+                buffer += block
+                eof = not block
+                continue
+
+            yield item
+            pos = end
+
+
+def get_item_field(item, name):
+    """Get the value of a field of an item, with a dot separating
+    the names of the nested fields (e.g., `data.product`)
+
+    :param item: JSON item
+    :param name: name of the field
+    :returns: the value of the field, None if it doesn't exist
+    """
+    value = item
+    for field in name.split('.'):
+        if not isinstance(value, dict) or field not in value:
+            return None
+        value = value[field]
+
+    return value
+
+
+class ElasticSearchFile:
+    """Sink of the documents uploaded with the bulk API (see `BulkWriter`)
+    which writes them to a NDJSON file, gzipped if its name ends with `.gz`,
+    instead of sending them to ElasticSearch. The file keeps the format
+    of the bulk API, an action line with the `_id` of the document
+    followed by the document, so it can be bulk loaded later in
+    any index.
+
+    It stands in for `ElasticSearch` only as the target of the bulk
+    uploads, so the operations which read from the index are not available.
+    The packs of documents are sized as the ones sent to ElasticSearch.
+
+    :param path: path of the file
+    :param index: name of the index of the documents
+    :param aliases: list of aliases of the index, not used
+    """
+    def __init__(self, path, index, aliases=None):
+        self.path = path
+        self.url = FILE_URL_PREFIX + os.path.abspath(path)
+        self.index = ElasticSearch.safe_index(index)
+        self.index_url = self.url + "/" + self.index
+
+        self.max_items_bulk = ElasticSearch.max_items_bulk
+        self.max_bytes_bulk = ElasticSearch.max_bytes_bulk
+        self.bulk_workers = ElasticSearch.bulk_workers
+        self.max_bulk_in_flight = ElasticSearch.max_bulk_in_flight
+
+        self.lock = Lock()
+        self.fd = open_file(path, 'w')
+        self.total = 0
+
+        logger.info("Writing documents of {} to {}".format(self.index, path))
+
+    def get_bulk_url(self):
+        """Get the bulk URL endpoint, only used to name the sink"""
+
+        return self.index_url + '/_bulk'
+
+    def bulk_upload(self, items, field_id):
+        """Write the items to the file in packs, as `ElasticSearch.bulk_upload`
+
+        :param items: list of items to be written
+        :param field_id: unique ID attribute used to differentiate the items
+        """
+        if not items:
+            return 0
+
+        writer = BulkWriter(self)
+        writer.add_items(items, field_id)
+        writer.flush()
+
+        return writer.total
+
+    def put_bulk(self, url, bulk_json):
+        """Write a bulk payload to the file
+
+        :param url: bulk url, not used
+        :param bulk_json: payload of the bulk request, as bytes
+        :returns: a `BulkResult` with the number of documents written
+        """
+        if isinstance(bulk_json, str):
+            bulk_json = bulk_json.encode('utf-8')
+
+        # Each document is an action line plus the document line
+        n_items = bulk_json.count(b"\n") // 2
+
+        with self.lock:
+            self.fd.write(bulk_json)
+            self.total += n_items
+
+        return BulkResult(n_items, 0, 0)
+
+    def refresh_index(self):
+        """Flush the documents written to the file"""
+
+        with self.lock:
+            self.fd.flush()
+
+    @contextmanager
+    def bulk_load(self, enabled=True, force_merge=None):
+        """No index settings to tune when writing to a file"""
+
+        yield self
+
+    def close(self):
+        """Close the file, once all the documents are written"""
+
+        with self.lock:
+            if self.fd.closed:
+                return
+            self.fd.close()
+
+        logger.info("{} documents of {} written to {}".format(self.total, self.index, self.path))
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Timers and counters of the stages of the feed and enrich pipeline"""
+
+import json
+import logging
+import math
+import os
+import random
+import re
+import time
+from threading import Lock
+
+from grimoirelab_toolkit.datetime import datetime_utcnow
+
+PROMETHEUS_PREFIX = "grimoirelab_elk_"
+QUANTILES = [0.5, 0.95]
+
+logger = logging.getLogger(__name__)
+
+
+class StageStats:
+    """Latencies and bytes of the calls of a stage. Up to `max_samples`
+    latencies are kept (reservoir sampling) to estimate the percentiles."""
+
+    __slots__ = ['count', 'total', 'max', 'bytes', 'samples', 'max_samples']
+
+    def __init__(self, max_samples):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes = 0
+        self.samples = []
+        self.max_samples = max_samples
+
+    def add(self, seconds, n_bytes=0):
+        self.count += 1
+        self.total += seconds
+        self.bytes += n_bytes
+        if seconds > self.max:
+            self.max = seconds
+
+        if len(self.samples) < self.max_samples:
+            self.samples.append(seconds)
+        else:
+            pos = random.randrange(self.count)
+            if pos < self.max_samples:
+                self.samples[pos] = seconds
+
+    def merge(self, data):
+        """Add the stats of a stage exported with `to_dict`"""
+
+        self.count += data['count']
+        self.total += data['total']
+        self.bytes += data['bytes']
+        self.max = max(self.max, data['max'])
+
+        self.samples.extend(data['samples'])
+        if len(self.samples) > self.max_samples:
+            self.samples = random.sample(self.samples, self.max_samples)
+
+    def percentile(self, quantile):
+        if not self.samples:
+            return None
+
+        samples = sorted(self.samples)
+        pos = max(0, int(math.ceil(quantile * len(samples))) - 1)
+        return samples[pos]
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            "bytes": self.bytes,
+            "samples": list(self.samples)
+        }
+
+    def summary(self):
+        summary = {
+            "count": self.count,
+            "total_seconds": round(self.total, 6),
+            "max_seconds": round(self.max, 6),
+            "bytes": self.bytes
+        }
+        for quantile in QUANTILES:
+            value = self.percentile(quantile)
+            summary["p{}_seconds".format(int(quantile * 100))] = round(value, 6) if value is not None else None
+
+        return summary
+
+
+class Timer:
+    """Context manager which adds the time spent in its block to a stage"""
+
+    __slots__ = ['metrics', 'stage', 'start', 'n_bytes']
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.start = None
+        self.n_bytes = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start, self.n_bytes)
+        return False
+
+    def add_bytes(self, n_bytes):
+        """Add bytes (e.g., size of a request) to the stage"""
+
+        self.n_bytes += n_bytes
+
+
+class NullTimer:
+    """Timer used when the metrics are disabled, it does nothing"""
+
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add_bytes(self, n_bytes):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    """Timers and counters of the stages of a run (e.g., feed or enrich of a
+    backend). When disabled (the default), the timers and counters do
+    nothing and cost a check of `enabled`.
+
+    The stages are named with dotted names (e.g., `es.put_bulk`). At the end
+    of a run (see `end_run`) a summary with the count, total, p50 and p95
+    latencies and bytes of each stage is logged, appended as a JSON line to
+    `report_file` and written to `prometheus_file` in the text exposition
+    format (e.g., for the textfile collector of node exporter).
+    """
+    enabled = False
+    report_file = None  # file where the JSON report of each run is appended
+    prometheus_file = None  # file rewritten with the metrics of the last run in Prometheus text format
+    max_samples = 10000  # latencies kept per stage to estimate the percentiles
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stages = {}
+        self.counters = {}
+        self.started = datetime_utcnow()
+
+    def timer(self, stage):
+        """Return a context manager which times its block as a call of `stage`
+
+        :param stage: name of the stage
+        """
+        if not self.enabled:
+            return NULL_TIMER
+
+        return Timer(self, stage)
+
+    def timed_iter(self, stage, items):
+        """Time how long each element of an iterable (e.g., a generator
+        fetching items) takes to be produced.
+
+        :param stage: name of the stage
+        :param items: iterable to time
+        """
+        if not self.enabled:
+            return items
+
+        return self.__timed_iter(stage, items)
+
+    def __timed_iter(self, stage, items):
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(stage, time.perf_counter() - start)
+            yield item
+
+    def observe(self, stage, seconds, n_bytes=0):
+        """Add a call of `seconds` to a stage
+
+        :param stage: name of the stage
+        :param seconds: time spent in the call
+        :param n_bytes: bytes processed in the call
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            stats = self.stages.get(stage, None)
+            if not stats:
+                stats = StageStats(self.max_samples)
+                self.stages[stage] = stats
+            stats.add(seconds, n_bytes)
+
+    def incr(self, name, value=1):
+        """Increment a counter
+
+        :param name: name of the counter
+        :param value: value added to the counter
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        """Remove the stages and counters"""
+
+        self.lock = Lock()
+        self.stages = {}
+        self.counters = {}
+        self.started = datetime_utcnow()
+
+    def pop(self):
+        """Return the stages and counters collected so far, to be merged
+        into the metrics of other process (see `merge`), and reset them.
+
+        :returns: a dict with the stages and counters, None if disabled
+        """
+        if not self.enabled:
+            return None
+
+        with self.lock:
+            data = {
+                "stages": {stage: stats.to_dict() for stage, stats in self.stages.items()},
+                "counters": dict(self.counters)
+            }
+            self.stages = {}
+            self.counters = {}
+
+        return data
+
+    def merge(self, data):
+        """Merge the stages and counters returned by `pop`
+
+        :param data: stages and counters to merge
+        """
+        if not self.enabled or not data:
+            return
+
+        with self.lock:
+            for stage, stage_data in data['stages'].items():
+                stats = self.stages.get(stage, None)
+                if not stats:
+                    stats = StageStats(self.max_samples)
+                    self.stages[stage] = stats
+                stats.merge(stage_data)
+            for name, value in data['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self, run=None, backend=None):
+        """Summary of the stages and counters of the current run
+
+        :param run: name of the run (e.g., feed, enrich)
+        :param backend: name of the backend
+        """
+        ended = datetime_utcnow()
+
+        with self.lock:
+            stages = {stage: stats.summary() for stage, stats in sorted(self.stages.items())}
+            counters = dict(sorted(self.counters.items()))
+
+        return {
+            "run": run,
+            "backend": backend,
+            "started": self.started.isoformat(),
+            "ended": ended.isoformat(),
+            "seconds": round((ended - self.started).total_seconds(), 3),
+            "stages": stages,
+            "counters": counters
+        }
+
+    def end_run(self, run, backend):
+        """Log and write the summary of the current run, and reset the
+        stages and counters for the next one.
+
+        :param run: name of the run (e.g., feed, enrich)
+        :param backend: name of the backend
+        """
+        if not self.enabled:
+            return None
+
+        summary = self.summary(run, backend)
+        self.log_summary(summary)
+
+        try:
+            if self.report_file:
+                self.write_report(summary, self.report_file)
+            if self.prometheus_file:
+                self.write_prometheus(summary, self.prometheus_file)
+        except OSError as ex:
+            logger.error("Metrics of {} of {} not written: {}".format(run, backend, ex))
+
+        self.reset()
+
+        return summary
+
+    @staticmethod
+    def log_summary(summary):
+        for stage, stats in summary['stages'].items():
+            logger.info("[{}] {} {}: {} calls, {:.3f} s, p50 {:.6f} s, p95 {:.6f} s, {:.2f} MB".format(
+                        summary['backend'], summary['run'], stage, stats['count'], stats['total_seconds'],
+                        stats['p50_seconds'], stats['p95_seconds'], stats['bytes'] / (1024 * 1024)))
+        for name, value in summary['counters'].items():
+            logger.info("[{}] {} {}: {}".format(summary['backend'], summary['run'], name, value))
+
+    @staticmethod
+    def write_report(summary, path):
+        """Append a summary to a file, as a JSON line"""
+
+        with open(path, 'a') as fd:
+            fd.write(json.dumps(summary, sort_keys=True) + "\n")
+
+    @staticmethod
+    def write_prometheus(summary, path):
+        """Write a summary to a file in Prometheus text format. The file is
+        replaced atomically, so it is never read half written."""
+
+        with open(path + '.tmp', 'w') as fd:
+            fd.write(Metrics.format_prometheus(summary))
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def format_prometheus(summary):
+        """Format a summary in Prometheus text exposition format"""
+
+        labels = 'run="{}",backend="{}"'.format(summary['run'], summary['backend'])
+        lines = []
+
+        name = PROMETHEUS_PREFIX + "stage_seconds"
+        lines.append("# HELP {} Time spent in the stages of the pipeline".format(name))
+        lines.append("# TYPE {} summary".format(name))
+        for stage, stats in summary['stages'].items():
+            stage_labels = '{},stage="{}"'.format(labels, stage)
+            for quantile in QUANTILES:
+                value = stats["p{}_seconds".format(int(quantile * 100))]
+                if value is not None:
+                    lines.append('{}{{{},quantile="{}"}} {}'.format(name, stage_labels, quantile, value))
+            lines.append('{}_sum{{{}}} {}'.format(name, stage_labels, stats['total_seconds']))
+            lines.append('{}_count{{{}}} {}'.format(name, stage_labels, stats['count']))
+
+        name = PROMETHEUS_PREFIX + "stage_bytes_total"
+        lines.append("# HELP {} Bytes processed in the stages of the pipeline".format(name))
+        lines.append("# TYPE {} counter".format(name))
+        for stage, stats in summary['stages'].items():
+            lines.append('{}{{{},stage="{}"}} {}'.format(name, labels, stage, stats['bytes']))
+
+        for counter, value in summary['counters'].items():
+            name = PROMETHEUS_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', counter) + "_total"
+            lines.append("# TYPE {} counter".format(name))
+            lines.append('{}{{{}}} {}'.format(name, labels, value))
+
+        name = PROMETHEUS_PREFIX + "run_seconds"
+        lines.append("# TYPE {} gauge".format(name))
+        lines.append('{}{{{}}} {}'.format(name, labels, summary['seconds']))
+
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of the current process
+metrics = Metrics()
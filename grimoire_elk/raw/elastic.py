@@ -26,14 +26,16 @@
 import inspect
 import logging
 
-from grimoirelab_toolkit.datetime import unixtime_to_datetime
+from grimoirelab_toolkit.datetime import str_to_datetime, unixtime_to_datetime
 
 from datetime import datetime
 from ..enriched.utils import get_repository_filter, anonymize_url
 from ..elastic_items import ElasticItems
 from ..elastic_mapping import Mapping
 from ..errors import ELKError
+from ..files import get_item_field, read_items
 from ..identities.identities import Identities
+from ..metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -66,6 +68,7 @@ class ElasticOcean(ElasticItems):
         self.fetch_archive = fetch_archive  # fetch from archive
         self.project = project  # project to be used for this data source
         self.anonymize = anonymize
+        self.raw_file = None  # file with the raw items, read instead of the raw index
 
     def set_elastic_url(self, url):
         """ Elastic URL """
@@ -75,6 +78,13 @@ class ElasticOcean(ElasticItems):
         """ Elastic used to store last data source state """
         self.elastic = elastic
 
+    def set_raw_file(self, raw_file):
+        """Read the raw items from a file instead of the raw index
+
+        :param raw_file: path of the file, see `read_items` for its format
+        """
+        self.raw_file = raw_file
+
     def get_field_date(self):
         """ Field with the update in the JSON items. Now the same in all. """
         return "metadata__updated_on"
@@ -228,6 +238,80 @@ class ElasticOcean(ElasticItems):
         self.feed_items(items)
         self.update_items()
 
+    def fetch(self, _filter=None, ignore_incremental=False, includes=None, excludes=None):
+        """Fetch the items from the raw index, or from the raw file if it is set"""
+
+        if self.raw_file:
+            return self.fetch_file(_filter=_filter, ignore_incremental=ignore_incremental)
+
+        return super().fetch(_filter=_filter, ignore_incremental=ignore_incremental,
+                             includes=includes, excludes=excludes)
+
+    def fetch_file(self, _filter=None, ignore_incremental=False):
+        """Fetch the items from the raw file. The items dumped by Perceval
+        are prepared as when they are fed into the raw index. The items are
+        filtered as in the raw index, except when resuming after a checkpoint,
+        since the items of a file aren't sorted. All the fields of the
+        items are returned.
+
+        :param _filter: optional filter of data collected
+        :param ignore_incremental: if True, incremental collection is ignored
+        """
+        logger.debug("Reading raw items from {}".format(self.raw_file))
+
+        filters = []
+        repo_filter = self.get_repository_filter_raw()
+        if repo_filter:
+            filters.append((repo_filter['name'], [repo_filter['value']]))
+        for fltr in self.filter_raw_dict:
+            filters.append((fltr['name'], [fltr['value']]))
+        if _filter:
+            filters.append((_filter['name'], _filter['value']))
+
+        from_date = None
+        offset = None
+        if self.from_date and not ignore_incremental:
+            # Naive dates are in UTC
+            from_date = str_to_datetime(self.from_date.isoformat())
+        elif self.offset and not ignore_incremental:
+            offset = self.offset
+
+        for item in read_items(self.raw_file):
+            if self.get_incremental_date() not in item:
+                # Item dumped by Perceval
+                self.add_update_date(item)
+                self._fix_item(item)
+                if self.project:
+                    item['project'] = self.project
+                if self.anonymize:
+                    self.identities.anonymize_item(item)
+                if self.drop_item(item):
+                    continue
+
+            if not self.__match_filters(item, filters):
+                continue
+            if from_date and str_to_datetime(item[self.get_incremental_date()]) < from_date:
+                continue
+            if offset and item.get('offset', 0) < offset:
+                continue
+
+            yield item
+
+    @staticmethod
+    def __match_filters(item, filters):
+        """Check whether the item matches all the filters, as terms filters"""
+
+        for name, values in filters:
+            value = get_item_field(item, name)
+            values = [str(v) for v in values]
+            if isinstance(value, list):
+                if not any(str(v) in values for v in value):
+                    return False
+            elif str(value) not in values:
+                return False
+
+        return True
+
     def update_items(self):
         """Perform update operations over a raw index, just after the collection.
         It must be redefined in the raw connectors."""
@@ -241,7 +325,8 @@ class ElasticOcean(ElasticItems):
         drop = 0
         added = 0
 
-        for item in items:
+        # Time spent by the backend producing each item (e.g., fetching it from the data source)
+        for item in metrics.timed_iter('feed.fetch_item', items):
             # print("%s %s" % (item['url'], item['lastUpdated_date']))
             # Add date field for incremental analysis if needed
             self.add_update_date(item)
@@ -259,6 +344,10 @@ class ElasticOcean(ElasticItems):
             else:
                 drop += 1
         self._items_to_es(items_pack)
+        self.elastic.refresh_index()
+
+        metrics.incr('feed.items_added', added)
+        metrics.incr('feed.items_dropped', drop)
 
         total_time_min = (datetime.now() - task_init).total_seconds() / 60
 
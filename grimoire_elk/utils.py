@@ -271,7 +271,7 @@ def get_connectors():
             }  # Will come from Registry
 
 
-def get_elastic(url, es_index, clean=None, backend=None, es_aliases=None, mapping=None):
+def get_elastic(url, es_index, clean=None, backend=None, es_aliases=None, mapping=None, rebuild=False):
 
     analyzers = None
 
@@ -284,7 +284,7 @@ def get_elastic(url, es_index, clean=None, backend=None, es_aliases=None, mappin
         insecure = True
         elastic = ElasticSearch(url=url, index=es_index, mappings=mapping,
                                 clean=clean, insecure=insecure,
-                                analyzers=analyzers, aliases=es_aliases)
+                                analyzers=analyzers, aliases=es_aliases, rebuild=rebuild)
 
     except ElasticError:
         msg = "Can't connect to Elastic Search. Is it running?"
@@ -384,15 +384,68 @@ def get_params_parser():
     parser.add_argument('--refresh-identities', action='store_true', help="Refresh identities in enriched items")
     parser.add_argument('--author_id', nargs='*', help="Field author_ids to be refreshed")
     parser.add_argument('--author_uuid', nargs='*', help="Field author_uuids to be refreshed")
+    parser.add_argument('--refresh-modified-identities', action='store_true',
+                        help="Refresh only the identities modified in SortingHat since the last refresh "
+                             "(needs --checkpoint-file or --checkpoint-index)")
     parser.add_argument('--github-token', help="If provided, github usernames will be retrieved in git enrich.")
     parser.add_argument('--jenkins-rename-file', help="CSV mapping file with nodes renamed schema.")
     parser.add_argument('--studies', action='store_true', help="Execute studies after enrichment.")
     parser.add_argument('--only-studies', action='store_true', help="Execute only studies.")
     parser.add_argument('--bulk-size', default=1000, type=int,
                         help="Number of items per bulk request to Elasticsearch.")
+    parser.add_argument('--bulk-workers', default=1, type=int,
+                        help="Number of threads sending bulk requests to Elasticsearch concurrently.")
+    parser.add_argument('--bulk-in-flight', type=int,
+                        help="Max number of bulk requests pending to be sent (default to --bulk-workers).")
+    parser.add_argument('--bulk-refresh', choices=['wait_for', 'true'],
+                        help="Refresh the index on each bulk request (default: refresh once at the end).")
+    parser.add_argument('--rebuild-enrich', action='store_true',
+                        help="Enrich into a new version of the enriched index and swap the aliases when done.")
+    parser.add_argument('--bulk-load-force-merge', action='store_true',
+                        help="Force merge the indexes at the end of a full (not incremental) load.")
+    parser.add_argument('--bulk-retries', type=int,
+                        help="Max attempts to send again the bulk items rejected by ES (default 5).")
+    parser.add_argument('--bulk-dead-letter-file',
+                        help="NDJSON file where the items not inserted to ES are appended.")
+    parser.add_argument('--http-compression', type=int, choices=range(1, 10), metavar='LEVEL',
+                        help="Compress with gzip (level 1-9) the bulk requests sent to ES.")
     parser.add_argument('--scroll-wait', default=900, type=int, help="Wait for available scroll (default 900s)")
+    parser.add_argument('--pagination', choices=['pit', 'scroll'],
+                        help="Read items with point in time and search_after (default), or with scroll.")
+    parser.add_argument('--read-slices', type=int,
+                        help="Slices of the point in time read concurrently (items aren't sorted by date if > 1).")
+    parser.add_argument('--adaptive-page-size', action='store_true',
+                        help="Adapt the number of items read per page to the size and latency of the responses.")
+    parser.add_argument('--prefetch-pages', type=int,
+                        help="Pages of items read ahead in background while the current one is processed.")
     parser.add_argument('--scroll-size', default=100, type=int,
                         help="Number of items to get from Elasticsearch when scrolling.")
+    parser.add_argument('--enrich-workers', type=int,
+                        help="Processes enriching the raw items (default 1, enrich them in the current process).")
+    parser.add_argument('--checkpoint-file',
+                        help="JSON file with the checkpoints to resume the enrichment after the last item enriched.")
+    parser.add_argument('--checkpoint-index',
+                        help="Index of the enriched ES with the checkpoints, instead of --checkpoint-file.")
+    parser.add_argument('--checkpoint-interval', type=int,
+                        help="Raw items enriched between checkpoints (default 10000).")
+    parser.add_argument('--raw-file',
+                        help="NDJSON file (or Perceval dump, .gz to gunzip it) with the raw items to enrich.")
+    parser.add_argument('--enrich-out-file',
+                        help="NDJSON file (.gz to gzip it) where the enriched items are written in bulk format.")
+    parser.add_argument('--identities-snapshot', action='store_true',
+                        help="Load the SortingHat identities, profiles and enrollments in memory before enriching.")
+    parser.add_argument('--identities-snapshot-no-fallback', action='store_true',
+                        help="Don't query SortingHat for the identities not found in the snapshot.")
+    parser.add_argument('--identities-cache-size', type=int,
+                        help="SortingHat lookups (of each kind) cached while enriching, default 100000.")
+    parser.add_argument('--identities-cache-ttl', type=int,
+                        help="Seconds the SortingHat lookups are cached while enriching, default 3600.")
+    parser.add_argument('--identities-cache-file',
+                        help="SQLite file where the SortingHat lookups are kept between runs.")
+    parser.add_argument('--metrics-file',
+                        help="File where the timings and counters of the stages of each run are appended as JSON.")
+    parser.add_argument('--metrics-prometheus-file',
+                        help="File where the timings and counters of the last run are written in Prometheus format.")
     parser.add_argument('--pair-programming', action='store_true', help="Do pair programming in git enrich")
     parser.add_argument('--studies-list', nargs='*', help="List of studies to be executed")
     parser.add_argument('backend', help=argparse.SUPPRESS)
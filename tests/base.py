@@ -32,7 +32,9 @@ from elasticsearch import Elasticsearch
 if '..' not in sys.path:
     sys.path.insert(0, '..')
 
+from grimoire_elk.elastic import ElasticSearch, REFRESH_WAIT_FOR
 from grimoire_elk.elk import load_identities
+from grimoire_elk.enriched.identities_cache import identities_cache
 from grimoire_elk.utils import get_connectors, get_elastic
 from tests.model import ESMapping
 
@@ -123,6 +125,9 @@ class TestBaseBackend(unittest.TestCase):
         cls.connectors = get_connectors()
         cls.maxDiff = None
 
+        # Items are read back just after being written
+        ElasticSearch.refresh_policy = REFRESH_WAIT_FOR
+
         # Sorting hat settings
         cls.db_user = ''
         cls.db_password = ''
@@ -134,6 +139,8 @@ class TestBaseBackend(unittest.TestCase):
                 cls.db_password = cls.config['Database']['password']
 
     def setUp(self):
+        identities_cache.invalidate()
+
         with open(os.path.join("data", self.connector + ".json")) as f:
             self.items = json.load(f)
 
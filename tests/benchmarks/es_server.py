@@ -0,0 +1,1095 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""In-process stand-in of ElasticSearch, implementing over HTTP the subset of
+the API used by GrimoireELK: indexes, mappings, settings, aliases, documents,
+the bulk API, searches (with scroll, point in time and search_after), basic
+aggregations and update/delete by query. The documents are kept in memory.
+
+It is meant for benchmarks and tests, not to check ES semantics: the
+queries are evaluated over the JSON documents, without analyzers."""
+
+import fnmatch
+import gzip
+import json
+import re
+import threading
+import uuid
+import zlib
+from datetime import datetime, timezone
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+ES_VERSION = "7.10.0"
+DEFAULT_SEARCH_SIZE = 10
+DEFAULT_TERMS_SIZE = 10
+
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?(Z|[+-]\d{2}:?\d{2})?$")
+SCRIPT_ASSIGNMENT_PATTERN = re.compile(r"ctx\._source\.([\w.]+)\s*=\s*params\.(\w+)")
+
+
+class ESError(Exception):
+    """Error returned to the client as an ES error response"""
+
+    def __init__(self, status, error_type, reason):
+        super().__init__(reason)
+        self.status = status
+        self.error_type = error_type
+        self.reason = reason
+
+    def to_json(self):
+        return {
+            "error": {
+                "root_cause": [{"type": self.error_type, "reason": self.reason}],
+                "type": self.error_type,
+                "reason": self.reason
+            },
+            "status": self.status
+        }
+
+
+@lru_cache(maxsize=100000)
+def parse_date(value):
+    """Convert a date, as str, to milliseconds since the epoch. None
+    if the value is not a date."""
+
+    if not isinstance(value, str) or not DATE_PATTERN.match(value):
+        return None
+
+    value = value.replace('Z', '+00:00').replace(' ', 'T')
+    if len(value) == 10:
+        value += "T00:00:00"
+    # Python < 3.7 doesn't support ':' in the offset
+    if len(value) > 6 and value[-3] == ':' and value[-6] in '+-':
+        value = value[:-3] + value[-2:]
+
+    for fmt in ["%Y-%m-%dT%H:%M:%S.%f%z", "%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%dT%H:%M%z",
+                "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M"]:
+        try:
+            date = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if not date.tzinfo:
+            date = date.replace(tzinfo=timezone.utc)
+        return int(date.timestamp() * 1000)
+
+    return None
+
+
+def format_date(millis):
+    """Format milliseconds since the epoch as ES does"""
+
+    date = datetime.fromtimestamp(millis / 1000, tz=timezone.utc)
+    return date.strftime("%Y-%m-%dT%H:%M:%S.") + "{:03d}Z".format(date.microsecond // 1000)
+
+
+def sort_value(value):
+    """Value used to sort and compare, the dates are sorted as milliseconds"""
+
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+
+    millis = parse_date(value)
+    if millis is not None:
+        return millis
+
+    return value
+
+
+def compare(value, other):
+    """Compare two values as ES would do, -1, 0 or 1"""
+
+    value = sort_value(value)
+    other = sort_value(other)
+    if type(value) is not type(other) and not (isinstance(value, (int, float)) and isinstance(other, (int, float))):
+        value = str(value)
+        other = str(other)
+
+    return (value > other) - (value < other)
+
+
+def get_values(doc, field):
+    """Get the values of a field of a document, as a list. The field can be
+    either a key with dots or the path of nested objects."""
+
+    if field in doc:
+        values = doc[field]
+    else:
+        values = doc
+        for name in field.split('.'):
+            if isinstance(values, dict) and name in values:
+                values = values[name]
+            else:
+                return []
+
+    if values is None:
+        return []
+    if isinstance(values, list):
+        return [value for value in values if value is not None]
+
+    return [values]
+
+
+def set_value(doc, field, value):
+    """Set the value of a field of a document"""
+
+    if '.' not in field or field in doc:
+        doc[field] = value
+        return
+
+    names = field.split('.')
+    for name in names[:-1]:
+        doc = doc.setdefault(name, {})
+    doc[names[-1]] = value
+
+
+def filter_source(doc, source):
+    """Apply the `_source` param of a search to a document"""
+
+    if source is None or source is True:
+        return doc
+    if source is False:
+        return {}
+
+    if isinstance(source, (str, list)):
+        source = {"includes": source}
+
+    includes = source.get('includes', [])
+    excludes = source.get('excludes', [])
+    if isinstance(includes, str):
+        includes = [includes]
+    if isinstance(excludes, str):
+        excludes = [excludes]
+
+    def match_any(path, patterns):
+        return any(fnmatch.fnmatchcase(path, pattern) for pattern in patterns)
+
+    def prefix_of_any(path, patterns):
+        return any(pattern.startswith(path + '.') or pattern.startswith('*') for pattern in patterns)
+
+    def filter_object(obj, prefix):
+        filtered = {}
+        for key, value in obj.items():
+            path = prefix + key
+            if match_any(path, excludes):
+                continue
+            if not includes or match_any(path, includes):
+                filtered[key] = value
+            elif isinstance(value, dict) and prefix_of_any(path, includes):
+                value = filter_object(value, path + '.')
+                if value:
+                    filtered[key] = value
+        return filtered
+
+    return filter_object(doc, '')
+
+
+class Query:
+    """Evaluation of the query DSL over a document"""
+
+    def __init__(self, query):
+        self.query = query if query else {"match_all": {}}
+
+    def match(self, doc):
+        return self.__match(self.query, doc)
+
+    def __match(self, query, doc):
+        if len(query) != 1:
+            raise ESError(400, "parsing_exception", "Invalid query {}".format(query))
+
+        kind, params = list(query.items())[0]
+        method = getattr(self, '_Query__match_' + kind, None)
+        if not method:
+            raise ESError(400, "parsing_exception", "Query [{}] not supported".format(kind))
+
+        return method(params, doc)
+
+    def __match_match_all(self, params, doc):
+        return True
+
+    def __match_match_none(self, params, doc):
+        return False
+
+    def __match_bool(self, params, doc):
+        def clauses(name):
+            value = params.get(name, [])
+            return value if isinstance(value, list) else [value]
+
+        for clause in clauses('must') + clauses('filter'):
+            if not self.__match(clause, doc):
+                return False
+        for clause in clauses('must_not'):
+            if self.__match(clause, doc):
+                return False
+
+        should = clauses('should')
+        if should:
+            default_min = 0 if clauses('must') or clauses('filter') else 1
+            minimum = int(params.get('minimum_should_match', default_min))
+            if sum(1 for clause in should if self.__match(clause, doc)) < minimum:
+                return False
+
+        return True
+
+    @staticmethod
+    def __field_params(params):
+        field, value = list(params.items())[0]
+        return field, value
+
+    def __match_term(self, params, doc):
+        field, value = self.__field_params(params)
+        if isinstance(value, dict):
+            value = value.get('value')
+
+        return any(compare(v, value) == 0 for v in get_values(doc, field))
+
+    def __match_terms(self, params, doc):
+        field, values = self.__field_params(params)
+        doc_values = get_values(doc, field)
+
+        return any(compare(v, value) == 0 for v in doc_values for value in values)
+
+    def __match_match(self, params, doc):
+        field, value = self.__field_params(params)
+        if isinstance(value, dict):
+            value = value.get('query')
+
+        for doc_value in get_values(doc, field):
+            if compare(doc_value, value) == 0:
+                return True
+            if isinstance(doc_value, str) and str(value).lower() in doc_value.lower():
+                return True
+
+        return False
+
+    def __match_match_phrase(self, params, doc):
+        return self.__match_match(params, doc)
+
+    def __match_exists(self, params, doc):
+        return bool(get_values(doc, params['field']))
+
+    def __match_range(self, params, doc):
+        field, bounds = self.__field_params(params)
+        checks = {
+            'gt': lambda c: c > 0,
+            'gte': lambda c: c >= 0,
+            'lt': lambda c: c < 0,
+            'lte': lambda c: c <= 0
+        }
+
+        for value in get_values(doc, field):
+            if all(checks[op](compare(value, bound)) for op, bound in bounds.items() if op in checks):
+                return True
+
+        return False
+
+    def __match_prefix(self, params, doc):
+        field, value = self.__field_params(params)
+        if isinstance(value, dict):
+            value = value.get('value')
+
+        return any(str(v).startswith(value) for v in get_values(doc, field))
+
+    def __match_wildcard(self, params, doc):
+        field, value = self.__field_params(params)
+        if isinstance(value, dict):
+            value = value.get('value')
+
+        return any(fnmatch.fnmatchcase(str(v), value) for v in get_values(doc, field))
+
+
+class Index:
+    """Documents, mappings and settings of an index"""
+
+    def __init__(self, name, body=None):
+        body = body if body else {}
+
+        self.name = name
+        self.docs = {}
+        self.properties = {}
+        self.dynamic_templates = []
+        self.settings = {
+            "number_of_shards": "1",
+            "number_of_replicas": "1",
+            "provided_name": name
+        }
+
+        settings = body.get('settings', {})
+        self.settings.update(settings.get('index', settings))
+        self.put_mapping(body.get('mappings', {}))
+
+    def put_mapping(self, mapping):
+        if 'items' in mapping:
+            mapping = mapping['items']
+        self.properties.update(mapping.get('properties', {}))
+        self.dynamic_templates.extend(mapping.get('dynamic_templates', []))
+
+    def get_mapping(self):
+        mapping = {"properties": self.properties}
+        if self.dynamic_templates:
+            mapping["dynamic_templates"] = self.dynamic_templates
+        return mapping
+
+
+class Store:
+    """In-memory state of the ES stand-in: indexes, aliases,
+    scroll contexts and points in time"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.indexes = {}
+        self.aliases = {}  # alias -> set of indexes
+        self.scrolls = {}  # scroll id -> list of pending hits
+        self.pits = {}  # pit id -> snapshot of the docs of each index
+
+    def resolve(self, target, must_exist=True):
+        """Names of the indexes of a target: an index, alias or pattern,
+        or a comma separated list of them"""
+
+        names = []
+        for name in target.split(','):
+            if name in ('_all', '*'):
+                names.extend(self.indexes.keys())
+            elif '*' in name:
+                names.extend(index for index in self.indexes if fnmatch.fnmatchcase(index, name))
+                for alias, indexes in self.aliases.items():
+                    if fnmatch.fnmatchcase(alias, name):
+                        names.extend(indexes)
+            elif name in self.indexes:
+                names.append(name)
+            elif name in self.aliases:
+                names.extend(self.aliases[name])
+            elif must_exist:
+                raise ESError(404, "index_not_found_exception", "no such index [{}]".format(name))
+
+        return sorted(set(names))
+
+    def get_index(self, name, create=False):
+        """Concrete index of a name. If `create`, the index is created when it doesn't exist"""
+
+        if name in self.indexes:
+            return self.indexes[name]
+
+        if name in self.aliases:
+            indexes = list(self.aliases[name])
+            if len(indexes) != 1:
+                raise ESError(400, "illegal_argument_exception",
+                              "alias [{}] points to more than one index".format(name))
+            return self.indexes[indexes[0]]
+
+        if not create:
+            raise ESError(404, "index_not_found_exception", "no such index [{}]".format(name))
+
+        index = Index(name)
+        self.indexes[name] = index
+        return index
+
+    def index_aliases(self, name):
+        return {alias: {} for alias, indexes in self.aliases.items() if name in indexes}
+
+
+class ESHandler(BaseHTTPRequestHandler):
+    """HTTP handler of the ES stand-in. The routes are matched
+    against the path split by '/'."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        return
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def do_GET(self):
+        self.__handle('GET')
+
+    def do_POST(self):
+        self.__handle('POST')
+
+    def do_PUT(self):
+        self.__handle('PUT')
+
+    def do_DELETE(self):
+        self.__handle('DELETE')
+
+    def do_HEAD(self):
+        self.__handle('HEAD')
+
+    def __handle(self, method):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+
+        body = self.__read_body()
+
+        try:
+            with self.store.lock:
+                status, response = self.__route(method, parts, params, body)
+        except ESError as ex:
+            status, response = ex.status, ex.to_json()
+        except Exception as ex:
+            status, response = 500, ESError(500, "exception", repr(ex)).to_json()
+
+        self.__send(method, status, response)
+
+    def __read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        if body and self.headers.get('Content-Encoding', '') == 'gzip':
+            body = gzip.decompress(body)
+
+        return body
+
+    def __send(self, method, status, response):
+        data = json.dumps(response).encode('utf-8') if response is not None else b''
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if method != 'HEAD':
+            self.wfile.write(data)
+
+    @staticmethod
+    def __json(body):
+        if not body:
+            return {}
+        return json.loads(body.decode('utf-8'))
+
+    def __route(self, method, parts, params, body):
+        if not parts:
+            return 200, {
+                "name": "es-stand-in",
+                "cluster_name": "grimoirelab-benchmarks",
+                "version": {"number": ES_VERSION},
+                "tagline": "You know, for search"
+            }
+
+        api = parts[-1] if parts[-1].startswith('_') else None
+        first = parts[0]
+
+        if first == '_aliases':
+            if method == 'POST':
+                return self.__update_aliases(self.__json(body))
+            return self.__get_aliases(None)
+        if first == '_alias':
+            return self.__get_aliases(None)
+        if first == '_bulk':
+            return self.__bulk(None, body, params)
+        if first == '_search' and len(parts) > 1 and parts[1] == 'scroll':
+            if method == 'DELETE':
+                return self.__clear_scroll(self.__json(body))
+            return self.__scroll(self.__json(body), params)
+        if first == '_search':
+            return self.__search(None, self.__json(body), params)
+        if first == '_pit':
+            return self.__close_pit(self.__json(body))
+        if first.startswith('_'):
+            raise ESError(400, "invalid_request", "API [{}] not supported".format(first))
+
+        target = first
+        if len(parts) == 1:
+            return self.__index(method, target, self.__json(body))
+
+        if api in ('_mapping', '_mappings'):
+            if method in ('PUT', 'POST'):
+                return self.__put_mapping(target, self.__json(body))
+            return self.__get_mapping(target)
+        if api == '_settings':
+            if method == 'PUT':
+                return self.__put_settings(target, self.__json(body))
+            return self.__get_settings(target)
+        if api in ('_alias', '_aliases'):
+            return self.__get_aliases(target)
+        if api in ('_refresh', '_forcemerge', '_flush'):
+            indexes = self.store.resolve(target)
+            return 200, {"_shards": {"total": len(indexes), "successful": len(indexes), "failed": 0}}
+        if api == '_bulk':
+            return self.__bulk(target, body, params)
+        if api == '_search':
+            return self.__search(target, self.__json(body), params)
+        if api == '_count':
+            return self.__count(target, self.__json(body))
+        if api == '_pit':
+            return self.__open_pit(target)
+        if api == '_delete_by_query':
+            return self.__delete_by_query(target, self.__json(body))
+        if api == '_update_by_query':
+            return self.__update_by_query(target, self.__json(body))
+        if len(parts) >= 3 and parts[-2] == '_update':
+            return self.__update_doc(target, parts[-1], self.__json(body))
+        if len(parts) >= 3 and not api:
+            # /index/_doc/id or /index/type/id
+            return self.__doc(method, target, parts[-1], self.__json(body))
+
+        raise ESError(400, "invalid_request", "API [{}] not supported".format('/'.join(parts)))
+
+    # Indexes
+
+    def __index(self, method, name, body):
+        store = self.store
+
+        if method == 'PUT':
+            if name in store.indexes or name in store.aliases:
+                raise ESError(400, "resource_already_exists_exception",
+                              "index [{}] already exists".format(name))
+            store.indexes[name] = Index(name, body)
+            for alias in body.get('aliases', {}):
+                store.aliases.setdefault(alias, set()).add(name)
+            return 200, {"acknowledged": True, "shards_acknowledged": True, "index": name}
+
+        if method == 'DELETE':
+            for index in store.resolve(name):
+                del store.indexes[index]
+                for indexes in store.aliases.values():
+                    indexes.discard(index)
+            store.aliases = {alias: indexes for alias, indexes in store.aliases.items() if indexes}
+            return 200, {"acknowledged": True}
+
+        response = {}
+        for index in store.resolve(name):
+            response[index] = {
+                "aliases": store.index_aliases(index),
+                "mappings": store.indexes[index].get_mapping(),
+                "settings": {"index": store.indexes[index].settings}
+            }
+        return 200, response
+
+    def __put_mapping(self, target, body):
+        for index in self.store.resolve(target):
+            self.store.indexes[index].put_mapping(body)
+
+        return 200, {"acknowledged": True}
+
+    def __get_mapping(self, target):
+        return 200, {index: {"mappings": self.store.indexes[index].get_mapping()}
+                     for index in self.store.resolve(target)}
+
+    def __put_settings(self, target, body):
+        settings = body.get('index', body)
+        for index in self.store.resolve(target):
+            for key, value in settings.items():
+                if value is None:
+                    self.store.indexes[index].settings.pop(key, None)
+                else:
+                    self.store.indexes[index].settings[key] = str(value)
+
+        return 200, {"acknowledged": True}
+
+    def __get_settings(self, target):
+        return 200, {index: {"settings": {"index": self.store.indexes[index].settings}}
+                     for index in self.store.resolve(target)}
+
+    # Aliases
+
+    def __get_aliases(self, target):
+        store = self.store
+        indexes = store.resolve(target) if target else sorted(store.indexes)
+
+        return 200, {index: {"aliases": store.index_aliases(index)} for index in indexes}
+
+    def __update_aliases(self, body):
+        store = self.store
+
+        for action in body.get('actions', []):
+            kind, params = list(action.items())[0]
+            # The indexes of the actions could be aliases or patterns, as in ES
+            if kind == 'add':
+                for index in store.resolve(params['index']):
+                    store.aliases.setdefault(params['alias'], set()).add(index)
+            elif kind == 'remove':
+                for index in store.resolve(params['index'], must_exist=False):
+                    store.aliases.get(params['alias'], set()).discard(index)
+            elif kind == 'remove_index':
+                self.__index('DELETE', params['index'], {})
+            else:
+                raise ESError(400, "illegal_argument_exception", "Unknown alias action [{}]".format(kind))
+
+        store.aliases = {alias: indexes for alias, indexes in store.aliases.items() if indexes}
+        return 200, {"acknowledged": True}
+
+    # Documents
+
+    def __doc(self, method, target, doc_id, body):
+        if method in ('PUT', 'POST'):
+            index = self.store.get_index(target, create=True)
+            result = "updated" if doc_id in index.docs else "created"
+            index.docs[doc_id] = body
+            return 200 if result == "updated" else 201, {"_index": index.name, "_id": doc_id, "result": result}
+
+        index = self.store.get_index(target)
+        if method == 'DELETE':
+            if index.docs.pop(doc_id, None) is None:
+                return 404, {"_index": index.name, "_id": doc_id, "result": "not_found"}
+            return 200, {"_index": index.name, "_id": doc_id, "result": "deleted"}
+
+        if doc_id not in index.docs:
+            return 404, {"_index": index.name, "_id": doc_id, "found": False}
+        return 200, {"_index": index.name, "_id": doc_id, "found": True, "_source": index.docs[doc_id]}
+
+    def __update_doc(self, target, doc_id, body):
+        index = self.store.get_index(target)
+        status = self.__apply_update(index, doc_id, body)
+        if status == 404:
+            raise ESError(404, "document_missing_exception", "[{}]: document missing".format(doc_id))
+
+        return 200, {"_index": index.name, "_id": doc_id, "result": "updated"}
+
+    @staticmethod
+    def __apply_update(index, doc_id, body):
+        if doc_id not in index.docs:
+            if body.get('doc_as_upsert'):
+                index.docs[doc_id] = dict(body.get('doc', {}))
+                return 201
+            if 'upsert' in body:
+                index.docs[doc_id] = dict(body['upsert'])
+                return 201
+            return 404
+
+        doc = dict(index.docs[doc_id])
+        doc.update(body.get('doc', {}))
+        index.docs[doc_id] = doc
+        return 200
+
+    def __bulk(self, target, body, params):
+        lines = [line for line in body.split(b"\n") if line.strip()]
+        items = []
+        errors = False
+
+        pos = 0
+        while pos < len(lines):
+            action = json.loads(lines[pos].decode('utf-8'))
+            kind, meta = list(action.items())[0]
+            pos += 1
+
+            source = None
+            if kind != 'delete':
+                source = json.loads(lines[pos].decode('utf-8'))
+                pos += 1
+
+            index = self.store.get_index(meta.get('_index', target), create=True)
+            doc_id = meta.get('_id')
+            if doc_id is None:
+                doc_id = uuid.uuid4().hex
+            doc_id = str(doc_id)
+
+            result = {"_index": index.name, "_id": doc_id}
+            if kind in ('index', 'create'):
+                if kind == 'create' and doc_id in index.docs:
+                    result["status"] = 409
+                    result["error"] = {"type": "version_conflict_engine_exception",
+                                       "reason": "[{}]: document already exists".format(doc_id)}
+                else:
+                    result["status"] = 200 if doc_id in index.docs else 201
+                    index.docs[doc_id] = source
+            elif kind == 'update':
+                result["status"] = self.__apply_update(index, doc_id, source)
+                if result["status"] == 404:
+                    result["error"] = {"type": "document_missing_exception",
+                                       "reason": "[{}]: document missing".format(doc_id)}
+            elif kind == 'delete':
+                result["status"] = 200 if index.docs.pop(doc_id, None) is not None else 404
+            else:
+                raise ESError(400, "illegal_argument_exception", "Unknown bulk action [{}]".format(kind))
+
+            errors = errors or 'error' in result
+            items.append({kind: result})
+
+        return 200, {"took": 0, "errors": errors, "items": items}
+
+    # Searches
+
+    def __search_docs(self, target, query, docs=None):
+        """List of (index, id, doc) matching the query"""
+
+        query = Query(query)
+        if docs is None:
+            docs = [(name, self.store.indexes[name].docs) for name in self.store.resolve(target)]
+
+        hits = []
+        for name, index_docs in docs:
+            for doc_id, doc in index_docs.items():
+                if query.match(doc):
+                    hits.append((name, doc_id, doc))
+
+        return hits
+
+    @staticmethod
+    def __sort_spec(sort):
+        if not sort:
+            return []
+        if not isinstance(sort, list):
+            sort = [sort]
+
+        spec = []
+        for field in sort:
+            if isinstance(field, str):
+                spec.append((field, 'desc' if field == '_score' else 'asc'))
+                continue
+
+            name, order = list(field.items())[0]
+            if isinstance(order, dict):
+                order = order.get('order', 'asc')
+            spec.append((name, order))
+
+        return spec
+
+    @staticmethod
+    def __sort_values(hit, spec, position):
+        _, doc_id, doc = hit
+
+        values = []
+        for field, order in spec:
+            if field == '_doc':
+                values.append(position)
+            elif field == '_id':
+                values.append(doc_id)
+            elif field == '_score':
+                values.append(1.0)
+            else:
+                field_values = [sort_value(value) for value in get_values(doc, field)]
+                if not field_values:
+                    values.append(None)
+                else:
+                    values.append(min(field_values) if order == 'asc' else max(field_values))
+
+        return values
+
+    def __sort_hits(self, hits, sort):
+        spec = self.__sort_spec(sort)
+        if not spec:
+            return [(hit, None) for hit in hits]
+
+        sorted_hits = [(hit, self.__sort_values(hit, spec, pos)) for pos, hit in enumerate(hits)]
+
+        # Stable sort from the last criterion, the missing values go last
+        for pos in reversed(range(len(spec))):
+            reverse = spec[pos][1] == 'desc'
+            present = [hit for hit in sorted_hits if hit[1][pos] is not None]
+            missing = [hit for hit in sorted_hits if hit[1][pos] is None]
+            present.sort(key=lambda hit: _SortKey(hit[1][pos]), reverse=reverse)
+            sorted_hits = present + missing
+
+        return sorted_hits
+
+    @staticmethod
+    def __after(values, search_after, spec):
+        for value, after, (_, order) in zip(values, search_after, spec):
+            if value is None:
+                return True
+            result = compare(value, after)
+            if order == 'desc':
+                result = -result
+            if result != 0:
+                return result > 0
+
+        return False
+
+    @staticmethod
+    def __hit(hit, values, source):
+        name, doc_id, doc = hit
+
+        result = {
+            "_index": name,
+            "_type": "_doc",
+            "_id": doc_id,
+            "_score": None if values is not None else 1.0,
+            "_source": filter_source(doc, source)
+        }
+        if values is not None:
+            result["sort"] = values
+
+        return result
+
+    def __search(self, target, body, params):
+        pit = body.get('pit')
+        docs = None
+        if pit:
+            if pit['id'] not in self.store.pits:
+                raise ESError(404, "search_context_missing_exception",
+                              "No search context found for id [{}]".format(pit['id']))
+            docs = self.store.pits[pit['id']]
+
+        hits = self.__search_docs(target, body.get('query'), docs=docs)
+
+        slice_ = body.get('slice')
+        if slice_ and slice_.get('max', 1) > 1:
+            hits = [hit for hit in hits
+                    if zlib.crc32(hit[1].encode('utf-8')) % slice_['max'] == slice_['id']]
+
+        sort = body.get('sort')
+        spec = self.__sort_spec(sort)
+        sorted_hits = self.__sort_hits(hits, sort)
+
+        search_after = body.get('search_after')
+        if search_after:
+            sorted_hits = [hit for hit in sorted_hits if self.__after(hit[1], search_after, spec)]
+
+        total = len(sorted_hits)
+        size = int(params.get('size', body.get('size', DEFAULT_SEARCH_SIZE)))
+        start = int(params.get('from', body.get('from', 0)))
+        source = body.get('_source', params.get('_source'))
+        page = [self.__hit(hit, values, source) for hit, values in sorted_hits[start:]]
+
+        response = {
+            "took": 0,
+            "timed_out": False,
+            "hits": {
+                "total": {"value": total, "relation": "eq"},
+                "max_score": None,
+                "hits": page[:size]
+            }
+        }
+
+        if 'scroll' in params:
+            scroll_id = uuid.uuid4().hex
+            self.store.scrolls[scroll_id] = (page[size:], size)
+            response["_scroll_id"] = scroll_id
+        if pit:
+            response["pit_id"] = pit['id']
+
+        aggs = body.get('aggs', body.get('aggregations'))
+        if aggs:
+            response["aggregations"] = self.__aggregations(aggs, [hit for hit, _ in sorted_hits])
+
+        return 200, response
+
+    def __scroll(self, body, params):
+        scroll_id = body.get('scroll_id', params.get('scroll_id'))
+        if scroll_id not in self.store.scrolls:
+            raise ESError(404, "search_context_missing_exception",
+                          "No search context found for id [{}]".format(scroll_id))
+
+        pending, size = self.store.scrolls[scroll_id]
+        self.store.scrolls[scroll_id] = (pending[size:], size)
+
+        return 200, {
+            "_scroll_id": scroll_id,
+            "took": 0,
+            "timed_out": False,
+            "hits": {
+                "total": {"value": len(pending), "relation": "eq"},
+                "max_score": None,
+                "hits": pending[:size]
+            }
+        }
+
+    def __clear_scroll(self, body):
+        scroll_ids = body.get('scroll_id', [])
+        if isinstance(scroll_ids, str):
+            scroll_ids = [scroll_ids]
+
+        freed = 0
+        for scroll_id in scroll_ids:
+            if self.store.scrolls.pop(scroll_id, None) is not None:
+                freed += 1
+
+        return 200, {"succeeded": True, "num_freed": freed}
+
+    def __open_pit(self, target):
+        pit_id = uuid.uuid4().hex
+        self.store.pits[pit_id] = [(name, dict(self.store.indexes[name].docs))
+                                   for name in self.store.resolve(target)]
+
+        return 200, {"id": pit_id}
+
+    def __close_pit(self, body):
+        found = self.store.pits.pop(body.get('id'), None) is not None
+        return 200 if found else 404, {"succeeded": found, "num_freed": int(found)}
+
+    def __count(self, target, body):
+        return 200, {"count": len(self.__search_docs(target, body.get('query')))}
+
+    def __delete_by_query(self, target, body):
+        hits = self.__search_docs(target, body.get('query'))
+        for name, doc_id, _ in hits:
+            del self.store.indexes[name].docs[doc_id]
+
+        return 200, {"took": 0, "deleted": len(hits), "total": len(hits), "failures": []}
+
+    def __update_by_query(self, target, body):
+        """Update the documents matching the query. Only scripts which
+        assign params to fields (`ctx._source.field = params.name`) are
+        supported."""
+
+        script = body.get('script', {})
+        source = script.get('source', script.get('inline', ''))
+        script_params = script.get('params', {})
+        assignments = SCRIPT_ASSIGNMENT_PATTERN.findall(source)
+        if source and not assignments:
+            raise ESError(400, "script_exception", "Script not supported [{}]".format(source))
+
+        hits = self.__search_docs(target, body.get('query'))
+        for name, doc_id, doc in hits:
+            doc = dict(doc)
+            for field, param in assignments:
+                set_value(doc, field, script_params.get(param))
+            self.store.indexes[name].docs[doc_id] = doc
+
+        return 200, {"took": 0, "updated": len(hits), "total": len(hits), "failures": []}
+
+    # Aggregations
+
+    def __aggregations(self, aggs, hits):
+        results = {}
+        for name, agg in aggs.items():
+            sub_aggs = agg.get('aggs', agg.get('aggregations'))
+            kinds = [kind for kind in agg if kind not in ('aggs', 'aggregations', 'meta')]
+            if len(kinds) != 1:
+                raise ESError(400, "parsing_exception", "Invalid aggregation [{}]".format(name))
+
+            kind = kinds[0]
+            params = agg[kind]
+            if kind == 'terms':
+                results[name] = self.__terms(params, sub_aggs, hits)
+            elif kind == 'filter':
+                query = Query(params)
+                filtered = [hit for hit in hits if query.match(hit[2])]
+                results[name] = {"doc_count": len(filtered)}
+                if sub_aggs:
+                    results[name].update(self.__aggregations(sub_aggs, filtered))
+            elif kind in ('max', 'min', 'avg', 'sum', 'value_count', 'cardinality'):
+                results[name] = self.__metric(kind, params, hits)
+            else:
+                raise ESError(400, "parsing_exception", "Aggregation [{}] not supported".format(kind))
+
+        return results
+
+    @staticmethod
+    def __metric(kind, params, hits):
+        raw_values = [value for hit in hits for value in get_values(hit[2], params['field'])]
+
+        if kind == 'value_count':
+            return {"value": len(raw_values)}
+        if kind == 'cardinality':
+            return {"value": len({json.dumps(value, sort_keys=True) for value in raw_values})}
+
+        values = [sort_value(value) for value in raw_values]
+        values = [value for value in values if isinstance(value, (int, float))]
+        is_date = any(parse_date(value) is not None for value in raw_values)
+
+        if not values:
+            return {"value": None if kind != 'sum' else 0}
+
+        if kind == 'max':
+            value = max(values)
+        elif kind == 'min':
+            value = min(values)
+        elif kind == 'sum':
+            value = sum(values)
+        else:
+            value = sum(values) / len(values)
+
+        result = {"value": float(value)}
+        if is_date and kind in ('max', 'min', 'avg'):
+            result["value_as_string"] = format_date(value)
+
+        return result
+
+    def __terms(self, params, sub_aggs, hits):
+        buckets = {}
+        keys = {}
+        for hit in hits:
+            for value in {json.dumps(v) for v in get_values(hit[2], params['field'])}:
+                buckets.setdefault(value, []).append(hit)
+                keys[value] = json.loads(value)
+
+        order = params.get('order', {"_count": "desc"})
+        field, direction = list(order.items())[0]
+        reverse = direction == 'desc'
+        ordered = sorted(buckets, key=lambda k: _SortKey(keys[k]), reverse=reverse and field == '_key')
+        if field != '_key':
+            # Stable sort, the buckets with the same count are sorted by key
+            ordered.sort(key=lambda k: len(buckets[k]), reverse=reverse)
+
+        size = int(params.get('size', DEFAULT_TERMS_SIZE))
+        results = []
+        for key in ordered[:size]:
+            bucket = {"key": keys[key], "doc_count": len(buckets[key])}
+            millis = parse_date(keys[key])
+            if millis is not None:
+                bucket["key"] = millis
+                bucket["key_as_string"] = format_date(millis)
+            if sub_aggs:
+                bucket.update(self.__aggregations(sub_aggs, buckets[key]))
+            results.append(bucket)
+
+        others = sum(len(buckets[key]) for key in ordered[size:])
+        return {"doc_count_error_upper_bound": 0, "sum_other_doc_count": others, "buckets": results}
+
+
+class _SortKey:
+    """Key to sort values of different types, as `compare` does"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return compare(self.value, other.value) < 0
+
+    def __eq__(self, other):
+        return compare(self.value, other.value) == 0
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ElasticSearchServer:
+    """ES stand-in serving HTTP in a background thread.
+
+    :param host: host to listen on
+    :param port: port to listen on, 0 to pick a free one
+    """
+    def __init__(self, host='127.0.0.1', port=0):
+        self.httpd = _ThreadingHTTPServer((host, port), ESHandler)
+        self.httpd.store = Store()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    @property
+    def store(self):
+        return self.httpd.store
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Synthetic Perceval items, scaled from the fixtures of the tests"""
+
+import copy
+import hashlib
+import json
+import os
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+# Seconds between the copies of an item, so the copies are sorted by date
+CLONE_TIME_SHIFT = 60
+# Offset of the numeric ids between the copies of an item
+CLONE_ID_OFFSET = 1000000
+
+# Fields of the data of the items which must be unique, and how to change them
+UNIQUE_FIELDS = {
+    'git': [('commit', 'hash')],
+    'github': [('id', 'number'), ('number', 'number')],
+    'gerrit': [('id', 'str'), ('number', 'number')],
+    'jira': [('id', 'number'), ('key', 'str')],
+    'mbox': [('Message-ID', 'message_id')],
+    'slack': [('ts', 'ts')]
+}
+BACKENDS = sorted(UNIQUE_FIELDS.keys())
+
+
+def load_fixtures(backend):
+    """Load the items of the fixture of a backend
+
+    :param backend: name of the backend (e.g., git)
+    :returns: list of Perceval items
+    """
+    with open(os.path.join(DATA_DIR, backend + '.json')) as fd:
+        return json.load(fd)
+
+
+def sha1(*values):
+    return hashlib.sha1(':'.join([str(value) for value in values]).encode('utf-8')).hexdigest()
+
+
+def clone_value(value, kind, copy_id):
+    """Change a unique value for the copy `copy_id` of an item"""
+
+    if kind == 'hash':
+        return sha1(value, copy_id)
+    if kind == 'number':
+        # Some numbers are dumped as str
+        return type(value)(int(value) + copy_id * CLONE_ID_OFFSET)
+    if kind == 'message_id':
+        return "<{}.{}".format(copy_id, value.lstrip('<'))
+    if kind == 'ts':
+        return "{:.6f}".format(float(value) + copy_id * CLONE_TIME_SHIFT)
+
+    return "{}-{}".format(value, copy_id)
+
+
+def clone_item(item, backend, copy_id):
+    """Copy of an item with new uuid, dates and unique fields. The first
+    copy (`copy_id` 0) is the item itself.
+
+    :param item: Perceval item
+    :param backend: name of the backend of the item
+    :param copy_id: number of the copy
+    :returns: a new item
+    """
+    clone = copy.deepcopy(item)
+    if not copy_id:
+        return clone
+
+    clone['uuid'] = sha1(item['uuid'], copy_id)
+    clone['timestamp'] = item['timestamp'] + copy_id * CLONE_TIME_SHIFT
+    clone['updated_on'] = item['updated_on'] + copy_id * CLONE_TIME_SHIFT
+
+    for field, kind in UNIQUE_FIELDS[backend]:
+        if clone['data'].get(field, None) is not None:
+            clone['data'][field] = clone_value(clone['data'][field], kind, copy_id)
+
+    return clone
+
+
+def generate_items(backend, n_items):
+    """Generate `n_items` items of a backend, copying its fixture items
+    as many times as needed. The items are generated lazily.
+
+    :param backend: name of the backend, one of `BACKENDS`
+    :param n_items: number of items
+    :returns: a generator of Perceval items
+    """
+    if backend not in UNIQUE_FIELDS:
+        raise ValueError("Unknown backend {}, use one of {}".format(backend, BACKENDS))
+
+    fixtures = load_fixtures(backend)
+    for pos in range(n_items):
+        copy_id, fixture_id = divmod(pos, len(fixtures))
+        yield clone_item(fixtures[fixture_id], backend, copy_id)
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Throughput benchmarks of the raw feeding, enrichment, refresh of
+identities and studies, over synthetic items (see `generators`).
+
+Each stage runs in a new process, so its peak RSS is measured apart
+from the other stages and from the ES stand-in, which runs in this
+process unless an ElasticSearch url is given. The results are
+written as JSON and can be compared with the ones of a baseline:
+
+    ./run_benchmarks.py -n 20000 -o results.json
+    ./run_benchmarks.py -n 20000 -o new.json --compare results.json
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(BENCHMARKS_DIR)))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+from grimoire_elk._version import __version__  # noqa: E402
+from grimoire_elk.enriched.utils import anonymize_url  # noqa: E402
+
+from benchmarks.generators import BACKENDS  # noqa: E402
+
+STAGE_FEED = 'feed_items'
+STAGE_ENRICH = 'enrich_items'
+STAGE_REFRESH_IDENTITIES = 'refresh_identities'
+STAGE_STUDIES = 'studies'
+STAGES = [STAGE_FEED, STAGE_ENRICH, STAGE_REFRESH_IDENTITIES, STAGE_STUDIES]
+
+STATUS_OK = 'ok'
+STATUS_SKIPPED = 'skipped'
+STATUS_FAILED = 'failed'
+
+INDEX_PREFIX = 'bench_'
+DEFAULT_ITEMS = 10000
+DEFAULT_THRESHOLD = 0.1  # relative change considered a regression
+
+logger = logging.getLogger(__name__)
+
+
+def get_peak_rss_mb():
+    """Peak resident set size of the current process, in MB"""
+
+    # The peak of `getrusage` is kept across exec, thus it includes the
+    # one of the parent process. The one of /proc is reset.
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    if not resource:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes in macOS, KB in Linux
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def configure(settings):
+    """Set the class attributes of GrimoireELK from the settings of the run"""
+
+    from grimoire_elk.elastic import ElasticSearch
+    from grimoire_elk.elastic_items import ElasticItems
+    from grimoire_elk.enriched.enrich import Enrich
+
+    if settings['bulk_size']:
+        ElasticSearch.max_items_bulk = settings['bulk_size']
+    if settings['bulk_workers']:
+        ElasticSearch.bulk_workers = settings['bulk_workers']
+    if settings['scroll_size']:
+        ElasticItems.scroll_size = settings['scroll_size']
+    if settings['enrich_workers']:
+        Enrich.enrich_workers = settings['enrich_workers']
+
+
+def get_backends(backend, es_url, settings, clean_enrich=False):
+    """Create the raw and enriched backends of a connector, with their indexes"""
+
+    from grimoire_elk.utils import get_connectors, get_elastic
+
+    connector = get_connectors()[backend]
+
+    ocean_backend = connector[1](None)
+    ocean_backend.set_elastic(get_elastic(es_url, INDEX_PREFIX + backend, False, ocean_backend))
+
+    if settings['db_sortinghat']:
+        enrich_backend = connector[2](db_sortinghat=settings['db_sortinghat'],
+                                      db_user=settings['db_user'],
+                                      db_password=settings['db_password'],
+                                      db_host=settings['db_host'])
+    else:
+        enrich_backend = connector[2]()
+    enrich_backend.set_elastic(get_elastic(es_url, INDEX_PREFIX + backend + '_enrich',
+                                           clean_enrich, enrich_backend))
+
+    return ocean_backend, enrich_backend
+
+
+def run_feed(backend, es_url, n_items, settings):
+    from grimoire_elk.utils import get_connectors, get_elastic
+
+    from benchmarks.generators import generate_items
+
+    ocean_backend = get_connectors()[backend][1](None)
+    ocean_backend.set_elastic(get_elastic(es_url, INDEX_PREFIX + backend, True, ocean_backend))
+
+    # The items are generated while they are fed
+    before = time.time()
+    ocean_backend.feed_items(generate_items(backend, n_items))
+    spent = time.time() - before
+
+    return n_items, spent
+
+
+def run_enrich(backend, es_url, n_items, settings):
+    from grimoire_elk.elk import load_identities
+
+    ocean_backend, enrich_backend = get_backends(backend, es_url, settings, clean_enrich=True)
+    if settings['db_sortinghat']:
+        load_identities(ocean_backend, enrich_backend)
+
+    ocean_backend.set_source_fields(enrich_backend.RAW_FIELDS_INCLUDES, enrich_backend.RAW_FIELDS_EXCLUDES)
+
+    before = time.time()
+    enrich_backend.enrich_items(ocean_backend)
+    enrich_backend.elastic.refresh_index()
+    spent = time.time() - before
+
+    return n_items, spent
+
+
+def run_refresh_identities(backend, es_url, n_items, settings):
+    from grimoire_elk.elk import refresh_identities
+
+    if not settings['db_sortinghat']:
+        return None, None
+
+    _, enrich_backend = get_backends(backend, es_url, settings)
+    field_id = enrich_backend.get_field_unique_id()
+
+    before = time.time()
+    total = enrich_backend.elastic.bulk_upload(refresh_identities(enrich_backend), field_id)
+    enrich_backend.elastic.refresh_index()
+    spent = time.time() - before
+
+    return total, spent
+
+
+def run_studies(backend, es_url, n_items, settings):
+    ocean_backend, enrich_backend = get_backends(backend, es_url, settings)
+    docs = sum(1 for _ in enrich_backend.fetch())
+
+    before = time.time()
+    enrich_backend.enrich_demography(ocean_backend, enrich_backend)
+    spent = time.time() - before
+
+    return docs, spent
+
+
+STAGE_RUNNERS = {
+    STAGE_FEED: run_feed,
+    STAGE_ENRICH: run_enrich,
+    STAGE_REFRESH_IDENTITIES: run_refresh_identities,
+    STAGE_STUDIES: run_studies
+}
+
+
+def run_stage(stage, backend, es_url, n_items, settings, queue):
+    """Run a stage in the current process and put its result in `queue`"""
+
+    logging.basicConfig(level=logging.DEBUG if settings['debug'] else logging.ERROR,
+                        format='%(asctime)s %(message)s')
+    configure(settings)
+
+    result = {
+        "backend": backend,
+        "benchmark": stage,
+        "status": STATUS_OK,
+        "items": None,
+        "seconds": None,
+        "items_per_sec": None,
+        "peak_rss_mb": None
+    }
+
+    try:
+        items, spent = STAGE_RUNNERS[stage](backend, es_url, n_items, settings)
+    except Exception as ex:
+        logger.error("[{}] {} failed: {}".format(backend, stage, ex), exc_info=True)
+        result["status"] = STATUS_FAILED
+        result["error"] = repr(ex)
+        queue.put(result)
+        return
+
+    if items is None:
+        result["status"] = STATUS_SKIPPED
+    else:
+        result["items"] = items
+        result["seconds"] = round(spent, 3)
+        result["items_per_sec"] = round(items / spent, 2) if spent else None
+        peak_rss = get_peak_rss_mb()
+        result["peak_rss_mb"] = round(peak_rss, 2) if peak_rss is not None else None
+
+    queue.put(result)
+
+
+def run_stage_process(stage, backend, es_url, n_items, settings):
+    """Run a stage in a new process, so its peak RSS isn't
+    affected by the previous stages"""
+
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_stage, args=(stage, backend, es_url, n_items, settings, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    return result
+
+
+def compare_results(results, baseline, threshold):
+    """Compare the results with the ones of a baseline. A regression is a drop
+    of the items per second, or a growth of the peak RSS, over `threshold`.
+
+    :returns: list of the regressions found, as str
+    """
+    baseline_results = {(r['backend'], r['benchmark']): r for r in baseline['results']}
+    regressions = []
+
+    print("{:<8} {:<20} {:>14} {:>14} {:>8} {:>10} {:>10} {:>8}".format(
+          "backend", "benchmark", "items/s base", "items/s", "change", "RSS base", "RSS", "change"))
+
+    for result in results:
+        base = baseline_results.get((result['backend'], result['benchmark']), None)
+        if not base or result['status'] != STATUS_OK or base['status'] != STATUS_OK:
+            continue
+
+        speed_change = result['items_per_sec'] / base['items_per_sec'] - 1
+        rss_change = 0
+        if result['peak_rss_mb'] and base['peak_rss_mb']:
+            rss_change = result['peak_rss_mb'] / base['peak_rss_mb'] - 1
+
+        print("{:<8} {:<20} {:>14.2f} {:>14.2f} {:>+7.1%} {:>10.2f} {:>10.2f} {:>+7.1%}".format(
+              result['backend'], result['benchmark'], base['items_per_sec'], result['items_per_sec'],
+              speed_change, base['peak_rss_mb'] or 0, result['peak_rss_mb'] or 0, rss_change))
+
+        if speed_change < -threshold:
+            regressions.append("{} {}: items/s {:+.1%}".format(result['backend'], result['benchmark'], speed_change))
+        if rss_change > threshold:
+            regressions.append("{} {}: peak RSS {:+.1%}".format(result['backend'], result['benchmark'], rss_change))
+
+    return regressions
+
+
+def get_params():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-b', '--backends', nargs='*', default=BACKENDS, choices=BACKENDS,
+                        help="Backends to benchmark (default all)")
+    parser.add_argument('-s', '--benchmarks', nargs='*', default=STAGES, choices=STAGES,
+                        help="Benchmarks to run, the stages they depend on are always run (default all)")
+    parser.add_argument('-n', '--items', type=int, default=DEFAULT_ITEMS,
+                        help="Raw items of each backend (default {})".format(DEFAULT_ITEMS))
+    parser.add_argument('-o', '--output', help="JSON file where the results are written")
+    parser.add_argument('--compare', help="JSON file with the results of a baseline to compare with")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="Relative change considered a regression (default {})".format(DEFAULT_THRESHOLD))
+    parser.add_argument('-e', '--elastic-url',
+                        help="ElasticSearch to use instead of the stand-in, its {}* indexes are replaced".format(
+                             INDEX_PREFIX))
+    parser.add_argument('--bulk-size', type=int, help="Documents per bulk request")
+    parser.add_argument('--bulk-workers', type=int, help="Threads uploading bulk requests")
+    parser.add_argument('--scroll-size', type=int, help="Items per page read")
+    parser.add_argument('--enrich-workers', type=int, help="Processes enriching the raw items")
+    parser.add_argument('--db-sortinghat', help="SortingHat database, needed by refresh_identities")
+    parser.add_argument('--db-host', default='127.0.0.1', help="SortingHat host")
+    parser.add_argument('--db-user', default='root', help="SortingHat user")
+    parser.add_argument('--db-password', default='', help="SortingHat password")
+    parser.add_argument('-g', '--debug', action='store_true')
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_params()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(asctime)s %(message)s')
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+    settings = {
+        'bulk_size': args.bulk_size,
+        'bulk_workers': args.bulk_workers,
+        'scroll_size': args.scroll_size,
+        'enrich_workers': args.enrich_workers,
+        'db_sortinghat': args.db_sortinghat,
+        'db_host': args.db_host,
+        'db_user': args.db_user,
+        'db_password': args.db_password,
+        'debug': args.debug
+    }
+
+    server = None
+    es_url = args.elastic_url
+    if not es_url:
+        from benchmarks.es_server import ElasticSearchServer
+        server = ElasticSearchServer().start()
+        es_url = server.url
+
+    # The stages a benchmark depends on are run before it
+    last_stage = max(STAGES.index(benchmark) for benchmark in args.benchmarks)
+    results = []
+    try:
+        for backend in args.backends:
+            for stage in STAGES[:last_stage + 1]:
+                if stage == STAGE_REFRESH_IDENTITIES and stage not in args.benchmarks:
+                    continue
+
+                result = run_stage_process(stage, backend, es_url, args.items, settings)
+                logger.info("[{}] {}: {} items, {} s, {} items/s, peak RSS {} MB ({})".format(
+                            backend, stage, result['items'], result['seconds'],
+                            result['items_per_sec'], result['peak_rss_mb'], result['status']))
+                if stage in args.benchmarks:
+                    results.append(result)
+                if result['status'] == STATUS_FAILED:
+                    break
+    finally:
+        if server:
+            server.stop()
+
+    report = {
+        "grimoirelab_elk": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "elasticsearch": anonymize_url(args.elastic_url) if args.elastic_url else "stand-in",
+        "items": args.items,
+        "settings": {key: value for key, value in settings.items() if key not in ('db_password', 'debug')},
+        "results": results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=4, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=4, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as fd:
+            baseline = json.load(fd)
+
+        regressions = compare_results(results, baseline, args.threshold)
+        for regression in regressions:
+            logger.warning("Regression {}".format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import requests
+
+from benchmarks.es_server import ElasticSearchServer
+from benchmarks.generators import BACKENDS, generate_items, load_fixtures
+from benchmarks.run_benchmarks import compare_results
+from grimoire_elk.elastic import ElasticSearch
+from grimoire_elk.elk import refresh_identities, refresh_projects
+from grimoire_elk.utils import get_connectors, get_elastic
+
+HEADER_JSON = {"Content-Type": "application/json"}
+
+
+class TestElasticSearchServer(unittest.TestCase):
+    """Functional tests of the ES stand-in of the benchmarks"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ElasticSearchServer().start()
+        cls.url = cls.server.url
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        requests.delete(self.url + "/test*")
+
+    def test_index(self):
+        """Test whether indexes, aliases and settings are managed by ElasticSearch"""
+
+        elastic = ElasticSearch(self.url, 'test_git', aliases=['git-raw'])
+        self.assertEqual(elastic.major, '7')
+        self.assertIn('git-raw', elastic.list_aliases())
+        self.assertTrue(elastic.alias_in_use('git-raw'))
+
+        with elastic.bulk_load():
+            self.assertEqual(elastic.get_index_settings()['refresh_interval'], '-1')
+        self.assertNotIn('refresh_interval', elastic.get_index_settings())
+
+        elastic = ElasticSearch(self.url, 'test_git_enrich', rebuild=True, aliases=['git'])
+        elastic.swap_aliases()
+        self.assertIn('test_git_enrich', elastic.list_aliases())
+        self.assertTrue(elastic.alias_in_use('git'))
+
+    def test_swap_aliases(self):
+        """Test whether the aliases set by other tools are kept when a rebuilt index is swapped"""
+
+        elastic = ElasticSearch(self.url, 'test_git_enrich', aliases=['git'])
+        elastic.add_alias('test_studies')
+        elastic = ElasticSearch(self.url, 'test_git_enrich', rebuild=True, aliases=['git'])
+        elastic.swap_aliases()
+        self.assertListEqual(sorted(elastic.list_aliases()), ['git', 'test_git_enrich', 'test_studies'])
+
+        # The index is an alias of the rebuilt one now
+        elastic = ElasticSearch(self.url, 'test_git_enrich')
+        elastic.add_alias('test_other')
+        self.assertIn('test_other', elastic.list_aliases())
+
+        previous = elastic.list_aliases()
+        elastic = ElasticSearch(self.url, 'test_git_enrich', rebuild=True, aliases=['git'])
+        elastic.swap_aliases()
+        self.assertDictEqual(elastic.list_aliases(), previous)
+        self.assertListEqual(elastic.get_index_versions(), [elastic.index])
+
+    def test_bulk_search(self):
+        """Test whether the documents uploaded are searched"""
+
+        elastic = ElasticSearch(self.url, 'test_docs')
+        items = [{"uuid": str(i), "value": i, "date": "2019-01-{:02d}T00:00:00+00:00".format(i + 1),
+                  "author": "a" if i % 2 else "b"} for i in range(20)]
+        self.assertEqual(elastic.bulk_upload(items, 'uuid'), 20)
+
+        query = {
+            "size": 5,
+            "query": {"bool": {"filter": [{"term": {"author": "a"}}, {"range": {"value": {"gte": 5}}}]}},
+            "sort": [{"date": {"order": "desc"}}],
+            "aggs": {
+                "author": {"terms": {"field": "author"}, "aggs": {"max": {"max": {"field": "date"}}}}
+            }
+        }
+        res = requests.post(elastic.index_url + "/_search", data=json.dumps(query), headers=HEADER_JSON).json()
+
+        hits = [hit['_source']['value'] for hit in res['hits']['hits']]
+        self.assertListEqual(hits, [19, 17, 15, 13, 11])
+        self.assertEqual(res['hits']['total']['value'], 8)
+
+        bucket = res['aggregations']['author']['buckets'][0]
+        self.assertEqual(bucket['key'], 'a')
+        self.assertEqual(bucket['max']['value_as_string'], '2019-01-20T00:00:00.000Z')
+
+        last_date = elastic.get_last_date('date', filters_=[{"name": "author", "value": "b"}])
+        self.assertEqual(last_date.isoformat(), '2019-01-19T00:00:00+00:00')
+
+    def test_fetch(self):
+        """Test whether the raw items are fed and fetched with scroll and point in time"""
+
+        connector = get_connectors()['git']
+        items = load_fixtures('git')
+
+        ocean_backend = connector[1](None)
+        ocean_backend.set_elastic(get_elastic(self.url, 'test_git', True, ocean_backend))
+        ocean_backend.feed_items(items)
+
+        for pagination in ['scroll', 'pit']:
+            ocean_backend.pagination = pagination
+            ocean_backend.scroll_size = 3
+            uuids = [item['uuid'] for item in ocean_backend.fetch()]
+            self.assertEqual(sorted(uuids), sorted(item['uuid'] for item in items))
+
+        commit = items[0]['data']['commit']
+        fetched = [item for item in ocean_backend.fetch(_filter={"name": "data.commit", "value": [commit]},
+                                                        includes=['uuid', 'data.commit'])]
+        self.assertEqual(len(fetched), 1)
+        self.assertDictEqual(fetched[0], {"uuid": items[0]['uuid'], "data": {"commit": commit}})
+
+    def test_fetch_pit_error(self):
+        """Test whether an error getting a page of a point in time is raised instead of ending the fetch"""
+
+        connector = get_connectors()['git']
+        items = load_fixtures('git')
+
+        ocean_backend = connector[1](None)
+        ocean_backend.set_elastic(get_elastic(self.url, 'test_git', True, ocean_backend))
+        ocean_backend.feed_items(items)
+        ocean_backend.pagination = 'pit'
+        ocean_backend.scroll_size = 1
+
+        fetched = ocean_backend.fetch()
+        next(fetched)
+        # Expire the point in time before getting the next page
+        self.server.store.pits.clear()
+        with self.assertRaises(requests.exceptions.HTTPError):
+            list(fetched)
+
+    def test_fetch_pit_ties(self):
+        """Test whether the items with the same date and uuid are not skipped between pages"""
+
+        enrich_backend = get_connectors()['git'][2]()
+        enrich_backend.pair_programming = True
+        enrich_backend.set_elastic(get_elastic(self.url, 'test_git_enrich', True, enrich_backend))
+
+        # The commits of several authors share the date and uuid
+        items = [{"uuid": str(i // 3), "git_uuid": "{}_{}".format(i // 3, i % 3),
+                  "metadata__timestamp": "2020-01-01T00:00:00+00:00"}
+                 for i in range(9)]
+        enrich_backend.elastic.bulk_upload(items, 'git_uuid')
+        enrich_backend.elastic.refresh_index()
+
+        enrich_backend.pagination = 'pit'
+        enrich_backend.scroll_size = 2
+        git_uuids = [item['git_uuid'] for item in enrich_backend.fetch()]
+        self.assertListEqual(git_uuids, sorted(item['git_uuid'] for item in items))
+
+    def test_fetch_fields(self):
+        """Test whether the items matching the values in any of the fields of a filter are fetched"""
+
+        enrich_backend = get_connectors()['git'][2]()
+        enrich_backend.set_elastic(get_elastic(self.url, 'test_git_enrich', True, enrich_backend))
+        items = [{"uuid": "1", "author_uuid": "a", "Committer_uuid": "b"},
+                 {"uuid": "2", "author_uuid": "b", "Committer_uuid": "b"},
+                 {"uuid": "3", "author_uuid": "c", "Committer_uuid": "a"},
+                 {"uuid": "4", "author_uuid": "c", "Committer_uuid": "c"}]
+        enrich_backend.elastic.bulk_upload(items, 'uuid')
+        enrich_backend.elastic.refresh_index()
+
+        _filter = {"name": ["author_uuid", "Committer_uuid"], "value": ["a", "b"]}
+        uuids = [item['uuid'] for item in enrich_backend.fetch(_filter)]
+        self.assertListEqual(sorted(uuids), ["1", "2", "3"])
+
+        _filter = {"name": ["author_uuid"], "value": ["c"]}
+        uuids = [item['uuid'] for item in enrich_backend.fetch(_filter)]
+        self.assertListEqual(sorted(uuids), ["3", "4"])
+
+    def test_refresh_projects(self):
+        """Test whether only the project fields changed are updated"""
+
+        tmp_path = tempfile.mkdtemp(prefix='benchmarks_')
+        self.addCleanup(shutil.rmtree, tmp_path)
+        projects_file = os.path.join(tmp_path, 'projects.json')
+        with open(projects_file, 'w') as fd:
+            json.dump({"grimoire": {"git": ["https://repo1"], "meta": {"title": "Grimoire"}}}, fd)
+
+        enrich_backend = get_connectors()['git'][2](json_projects_map=projects_file)
+        enrich_backend.set_elastic(get_elastic(self.url, 'test_git_enrich', True, enrich_backend))
+        items = [{"uuid": "1", "origin": "https://repo1", "message": "fix", "project": "grimoire",
+                  "project_1": "grimoire", "cm_title": "Grimoire"},
+                 {"uuid": "2", "origin": "https://repo1", "message": "fix", "project": "Main",
+                  "project_1": "Main"},
+                 {"uuid": "3", "origin": "https://repo2", "message": "fix", "project": "Main",
+                  "project_1": "Main"}]
+        enrich_backend.elastic.bulk_upload(items, 'uuid')
+        enrich_backend.elastic.refresh_index()
+
+        eitems = list(refresh_projects(enrich_backend))
+        self.assertListEqual(eitems, [{"uuid": "2", "project": "grimoire", "project_1": "grimoire",
+                                       "cm_title": "Grimoire"}])
+
+        self.assertEqual(enrich_backend.elastic.bulk_update(eitems, 'uuid'), 1)
+        enrich_backend.elastic.refresh_index()
+
+        eitems = {item['uuid']: item for item in enrich_backend.fetch()}
+        self.assertDictEqual(eitems["2"], {"uuid": "2", "origin": "https://repo1", "message": "fix",
+                                           "project": "grimoire", "project_1": "grimoire",
+                                           "cm_title": "Grimoire"})
+        self.assertEqual(eitems["3"]['project'], "Main")
+        self.assertListEqual(list(refresh_projects(enrich_backend)), [])
+
+    def test_refresh_identities(self):
+        """Test whether only the identities fields of the roles are fetched, and the ones changed updated"""
+
+        enrich_backend = get_connectors()['git'][2]()
+        enrich_backend.set_elastic(get_elastic(self.url, 'test_git_enrich', True, enrich_backend))
+        items = [{"uuid": str(i), "grimoire_creation_date": "2019-01-01T00:00:00+00:00", "message": "fix",
+                  "Author_id": "a", "Author_org_name": "Unknown" if i % 2 else "Bitergia",
+                  "author_id": "a", "author_org_name": "Bitergia"} for i in range(4)]
+        enrich_backend.elastic.bulk_upload(items, 'uuid')
+        enrich_backend.elastic.refresh_index()
+
+        fetched = []
+
+        def get_item_sh_from_id(eitem, roles):
+            fetched.append(eitem)
+            return {"Author_org_name": "Bitergia", "author_org_name": "Bitergia"}
+
+        with unittest.mock.patch.object(enrich_backend, 'get_item_sh_from_id', side_effect=get_item_sh_from_id):
+            eitems = list(refresh_identities(enrich_backend))
+
+        self.assertEqual(len(fetched), 4)
+        self.assertNotIn('message', fetched[0])
+        self.assertListEqual(sorted(eitems, key=lambda eitem: eitem['uuid']),
+                             [{"uuid": "1", "Author_org_name": "Bitergia"},
+                              {"uuid": "3", "Author_org_name": "Bitergia"}])
+
+
+class TestGenerators(unittest.TestCase):
+    """Unit tests of the synthetic items of the benchmarks"""
+
+    def test_generate_items(self):
+        """Test whether the copies of the fixtures are unique"""
+
+        for backend in BACKENDS:
+            fixtures = load_fixtures(backend)
+            n_items = len(fixtures) * 3 + 1
+            items = list(generate_items(backend, n_items))
+
+            self.assertEqual(len(items), n_items)
+            self.assertListEqual(items[:len(fixtures)], fixtures)
+            # Some fixtures have items with the same uuid (e.g., updates of an issue)
+            n_uuids = len({item['uuid'] for item in fixtures})
+            self.assertEqual(len({item['uuid'] for item in items[len(fixtures):]}), n_uuids * 2 + 1)
+
+            copy = items[len(fixtures)]
+            self.assertGreater(copy['timestamp'], fixtures[0]['timestamp'])
+
+        items = list(generate_items('git', 100))
+        self.assertEqual(len({item['data']['commit'] for item in items}), 100)
+
+    def test_unknown_backend(self):
+        """Test whether an exception is thrown with an unknown backend"""
+
+        with self.assertRaises(ValueError):
+            _ = list(generate_items('unknown', 10))
+
+
+class TestCompareResults(unittest.TestCase):
+    """Unit tests of the comparison of the results of the benchmarks"""
+
+    def test_compare(self):
+        """Test whether the regressions over the threshold are found"""
+
+        def result(benchmark, speed, rss, status='ok'):
+            return {"backend": "git", "benchmark": benchmark, "status": status,
+                    "items_per_sec": speed, "peak_rss_mb": rss}
+
+        baseline = {"results": [result('feed_items', 100, 100), result('enrich_items', 100, 100),
+                                result('studies', 100, 100)]}
+        results = [result('feed_items', 95, 105), result('enrich_items', 80, 130),
+                   result('studies', None, None, status='failed')]
+
+        regressions = compare_results(results, baseline, 0.1)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('git enrich_items: items/s'))
+        self.assertTrue(regressions[1].startswith('git enrich_items: peak RSS'))
+
+
+if __name__ == "__main__":
+    unittest.main(warnings='ignore')
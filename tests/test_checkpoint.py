@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import configparser
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import httpretty
+import requests
+
+from grimoire_elk.checkpoint import (Checkpoint,
+                                     ESCheckpointStore,
+                                     FileCheckpointStore)
+from grimoire_elk.elk import REFRESH_IDENTITIES_ORIGIN, get_modified_identities_filter
+from grimoire_elk.enriched.sortinghat_gelk import SortingHat
+from grimoire_elk.utils import get_connectors
+
+CONFIG_FILE = 'tests.conf'
+
+
+class MockBulkWriter:
+    """Writer whose documents are inserted, or not, when flushed"""
+
+    def __init__(self):
+        self.total = 0
+        self.total_items = 0
+        self.pending = 0
+        self.fail = False
+        self.flushes = 0
+
+    def add(self, item, item_id):
+        self.pending += 1
+
+    def flush(self):
+        self.total_items += self.pending
+        if not self.fail:
+            self.total += self.pending
+        self.pending = 0
+        self.flushes += 1
+
+
+def item(uuid, date="2019-01-01T10:00:00+00:00"):
+    return {"uuid": uuid, "metadata__timestamp": date}
+
+
+class TestFileCheckpointStore(unittest.TestCase):
+    """Unit tests for FileCheckpointStore class"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='checkpoints_')
+        self.path = os.path.join(self.tmp_path, 'checkpoints.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_set_get(self):
+        """Test whether the checkpoints are stored by index and origin"""
+
+        store = FileCheckpointStore(self.path)
+        self.assertIsNone(store.get('git_enrich', 'https://repo'))
+
+        store.set('git_enrich', 'https://repo', '2019-01-01T10:00:00+00:00', 'a')
+        store.set('git_enrich', 'https://repo2', '2019-01-02T10:00:00+00:00', 'b')
+        store.set('git_enrich', 'https://repo', '2019-01-03T10:00:00+00:00', 'c')
+
+        store = FileCheckpointStore(self.path)
+        self.assertEqual(store.get('git_enrich', 'https://repo'), ('2019-01-03T10:00:00+00:00', 'c'))
+        self.assertEqual(store.get('git_enrich', 'https://repo2'), ('2019-01-02T10:00:00+00:00', 'b'))
+        self.assertIsNone(store.get('github_enrich', 'https://repo'))
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_delete(self):
+        """Test whether a checkpoint is deleted"""
+
+        store = FileCheckpointStore(self.path)
+        store.set('git_enrich', 'https://repo', '2019-01-01T10:00:00+00:00', 'a')
+        store.delete('git_enrich', 'https://repo')
+        store.delete('git_enrich', 'https://unknown')
+
+        self.assertIsNone(store.get('git_enrich', 'https://repo'))
+
+
+class TestESCheckpointStore(unittest.TestCase):
+    """Unit tests for ESCheckpointStore class"""
+
+    @httpretty.activate
+    def test_set_get(self):
+        """Test whether the checkpoints are stored as documents of an index"""
+
+        index_url = 'http://localhost:9200/checkpoints'
+
+        for major, doc_type in [('6', 'items'), ('7', '_doc')]:
+            docs = {}
+
+            def doc_callback(request, uri, headers):
+                doc_id = uri.split('?')[0].split('/')[-1]
+                if request.method == 'PUT':
+                    docs[doc_id] = json.loads(request.body)
+                    return 200, headers, json.dumps({"result": "created"})
+                if doc_id not in docs:
+                    return 404, headers, json.dumps({"found": False})
+                return 200, headers, json.dumps({"found": True, "_source": docs[doc_id]})
+
+            httpretty.reset()
+            for method in [httpretty.GET, httpretty.PUT]:
+                httpretty.register_uri(method, re.compile(index_url + '/' + doc_type + r'/\w+'), body=doc_callback)
+
+            store = ESCheckpointStore('http://localhost:9200', 'checkpoints', major=major)
+            self.assertIsNone(store.get('git_enrich', 'https://repo'))
+
+            store.set('git_enrich', 'https://repo', '2019-01-01T10:00:00+00:00', 'a')
+            self.assertEqual(store.get('git_enrich', 'https://repo'), ('2019-01-01T10:00:00+00:00', 'a'))
+
+            doc = list(docs.values())[0]
+            self.assertEqual(doc['index'], 'git_enrich')
+            self.assertEqual(doc['origin'], 'https://repo')
+
+
+class TestESCheckpointStoreServer(unittest.TestCase):
+    """Functional tests for ESCheckpointStore class, with the ElasticSearch of the tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.config = configparser.ConfigParser()
+        cls.config.read(CONFIG_FILE)
+        cls.es_con = dict(cls.config.items('ElasticSearch'))['url']
+        cls.index = 'test_checkpoints'
+
+    def tearDown(self):
+        requests.delete(self.es_con + "/" + self.index, verify=False)
+
+    def test_set_get_delete(self):
+        """Test whether the checkpoints are stored in the index of the version of ElasticSearch"""
+
+        store = ESCheckpointStore(self.es_con, self.index)
+        self.assertIsNone(store.get('git_enrich', 'https://repo'))
+
+        store.set('git_enrich', 'https://repo', '2019-01-01T10:00:00+00:00', 'a')
+        store.set('git_enrich', 'https://repo', '2019-01-02T10:00:00+00:00', 'b')
+        self.assertEqual(store.get('git_enrich', 'https://repo'), ('2019-01-02T10:00:00+00:00', 'b'))
+        self.assertIsNone(store.get('git_enrich', 'https://other'))
+
+        store.delete('git_enrich', 'https://repo')
+        store.delete('git_enrich', 'https://repo')
+        self.assertIsNone(store.get('git_enrich', 'https://repo'))
+
+
+class TestCheckpoint(unittest.TestCase):
+    """Unit tests for Checkpoint class"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='checkpoints_')
+        self.store = FileCheckpointStore(os.path.join(self.tmp_path, 'checkpoints.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_add(self):
+        """Test whether the checkpoint is advanced every interval items, after flushing"""
+
+        writer = MockBulkWriter()
+        checkpoint = Checkpoint(self.store, 'git_enrich', 'https://repo', interval=3)
+
+        for uuid in ['a', 'b']:
+            writer.add({}, uuid)
+        checkpoint.add([item('a'), item('b')], writer)
+        self.assertIsNone(checkpoint.get())
+        self.assertEqual(writer.flushes, 0)
+
+        for uuid in ['c', 'd']:
+            writer.add({}, uuid)
+        checkpoint.add([item('c'), item('d')], writer)
+        self.assertEqual(checkpoint.get(), ('2019-01-01T10:00:00+00:00', 'd'))
+        self.assertEqual(writer.flushes, 1)
+
+        writer.add({}, 'e')
+        checkpoint.add([item('e', '2019-01-02T10:00:00+00:00')], writer)
+        self.assertEqual(checkpoint.get(), ('2019-01-01T10:00:00+00:00', 'd'))
+
+        checkpoint.save(writer)
+        self.assertEqual(checkpoint.get(), ('2019-01-02T10:00:00+00:00', 'e'))
+
+        checkpoint.reset()
+        self.assertIsNone(checkpoint.get())
+
+    def test_not_inserted(self):
+        """Test whether the checkpoint is not advanced when some documents are not inserted"""
+
+        writer = MockBulkWriter()
+        checkpoint = Checkpoint(self.store, 'git_enrich', 'https://repo', interval=1)
+
+        writer.add({}, 'a')
+        checkpoint.add([item('a')], writer)
+        self.assertEqual(checkpoint.get(), ('2019-01-01T10:00:00+00:00', 'a'))
+
+        writer.fail = True
+        writer.add({}, 'b')
+        checkpoint.add([item('b')], writer)
+        self.assertEqual(checkpoint.get(), ('2019-01-01T10:00:00+00:00', 'a'))
+
+        writer.fail = False
+        writer.add({}, 'c')
+        checkpoint.add([item('c')], writer)
+        checkpoint.save(writer)
+        self.assertEqual(checkpoint.get(), ('2019-01-01T10:00:00+00:00', 'a'))
+
+
+class TestSupportsCheckpoints(unittest.TestCase):
+    """Unit tests for the enrichers advancing the checkpoints"""
+
+    def test_supports_checkpoints(self):
+        """Test whether the enrichers with their own enrich_items are detected"""
+
+        connectors = get_connectors()
+
+        for name in ['git', 'gerrit', 'jira', 'github', 'gitlab']:
+            self.assertTrue(connectors[name][2]().supports_checkpoints(), name)
+        for name in ['mbox', 'discourse', 'meetup', 'kitsune', 'mediawiki', 'dockerhub']:
+            self.assertFalse(connectors[name][2]().supports_checkpoints(), name)
+
+
+class TestModifiedIdentitiesFilter(unittest.TestCase):
+    """Unit tests of the filter of the identities modified since the last refresh"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='checkpoints_')
+        self.store = FileCheckpointStore(os.path.join(self.tmp_path, 'checkpoints.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_filter(self):
+        """Test whether the items of the ids and uuids modified since the checkpoint are filtered"""
+
+        enrich_backend = unittest.mock.Mock(spec=['sh_db', 'get_field_author', 'roles'])
+        enrich_backend.get_field_author.return_value = 'Author'
+        enrich_backend.roles = ['Author', 'Commit']
+
+        with unittest.mock.patch.object(SortingHat, 'get_modified_identities',
+                                        return_value=(['id2', 'id1'], ['uuid1'])) as modified:
+            fields, values = get_modified_identities_filter(enrich_backend, self.store, 'git_enrich')
+            self.assertIsNone(fields)
+            self.assertIsNone(values)
+            modified.assert_not_called()
+
+            self.store.set('git_enrich', REFRESH_IDENTITIES_ORIGIN, '2019-01-01T10:00:00+00:00', None)
+            fields, values = get_modified_identities_filter(enrich_backend, self.store, 'git_enrich')
+
+        self.assertListEqual(fields, ['Author_id', 'Author_uuid', 'author_id', 'author_uuid',
+                                      'Commit_id', 'Commit_uuid'])
+        self.assertListEqual(values, ['id1', 'id2', 'uuid1'])
+        after = modified.call_args[0][1]
+        self.assertEqual(after.isoformat(), '2019-01-01T10:00:00')
+
+
+if __name__ == "__main__":
+    unittest.main(warnings='ignore')
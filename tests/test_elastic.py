@@ -20,10 +20,13 @@
 #
 
 import configparser
+import gzip
 import json
 import os
 import random
+import shutil
 import string
+import tempfile
 import unittest
 import unittest.mock
 
@@ -31,8 +34,12 @@ import httpretty
 import requests
 
 from grimoire_elk.elastic import (ElasticSearch,
+                                  BulkWriter,
                                   ElasticError,
+                                  REFRESH_TRUE,
+                                  REFRESH_WAIT_FOR,
                                   logger)
+from grimoire_elk.enriched.utils import grimoire_con, get_compression_stats
 from grimoire_elk.raw.git import GitOcean
 from grimoire_elk.raw.kitsune import KitsuneOcean
 from grimoire_elk.elastic_mapping import Mapping
@@ -76,6 +83,9 @@ class TestElastic(unittest.TestCase):
         cls.es_con = dict(cls.config.items('ElasticSearch'))['url']
         cls.es_major = requests.get(cls.es_con, verify=False).json()['version']['number'].split('.')[0]
 
+        # Items are read back just after being written
+        ElasticSearch.refresh_policy = REFRESH_WAIT_FOR
+
     def tearDown(self):
         target_index_url = self.es_con + "/" + self.target_index
         requests.delete(target_index_url, verify=False)
@@ -483,6 +493,88 @@ class TestElastic(unittest.TestCase):
         new_items = elastic.bulk_upload(items, field_id="uuid")
         self.assertEqual(new_items, 11)
 
+    def test_bulk_upload_max_bytes(self):
+        """Test whether items are uploaded in packs limited by size"""
+
+        items = json.loads(read_file('data/git.json'))
+        elastic = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping)
+        elastic.max_bytes_bulk = 1
+
+        new_items = elastic.bulk_upload(items, field_id="uuid")
+        self.assertEqual(new_items, 11)
+
+    def test_bulk_writer(self):
+        """Test whether the bulk writer flushes the packs when the limits are reached"""
+
+        items = json.loads(read_file('data/git.json'))
+        elastic = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping)
+
+        writer = BulkWriter(elastic, max_items=5)
+        self.assertEqual(writer.url, elastic.get_bulk_url())
+        self.assertEqual(writer.max_bytes, elastic.max_bytes_bulk)
+
+        writer.add_items(items, "uuid")
+        self.assertEqual(writer.flushes, 2)
+        self.assertEqual(writer.current_items, 1)
+        self.assertEqual(writer.total, 10)
+
+        inserted = writer.flush()
+        self.assertEqual(inserted, 1)
+        self.assertEqual(writer.flushes, 3)
+        self.assertEqual(writer.current_items, 0)
+        self.assertEqual(writer.current_bytes, 0)
+        self.assertEqual(writer.total, 11)
+        self.assertEqual(writer.total_items, 11)
+        self.assertGreater(writer.total_bytes, 0)
+
+        # Nothing left to upload
+        self.assertEqual(writer.flush(), 0)
+        self.assertEqual(writer.flushes, 3)
+
+    def test_bulk_writer_max_bytes(self):
+        """Test whether a document larger than the byte budget is sent alone"""
+
+        items = json.loads(read_file('data/git.json'))
+        elastic = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping)
+
+        writer = BulkWriter(elastic, max_bytes=1)
+        writer.add_items(items, "uuid")
+        writer.flush()
+
+        self.assertEqual(writer.flushes, 11)
+        self.assertEqual(writer.total, 11)
+
+    def test_bulk_writer_workers(self):
+        """Test whether the packs are correctly uploaded by a pool of workers"""
+
+        items = json.loads(read_file('data/git.json'))
+        elastic = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping)
+
+        writer = BulkWriter(elastic, max_items=2, workers=3, max_in_flight=2)
+        self.assertEqual(writer.workers, 3)
+        self.assertEqual(writer.max_in_flight, 2)
+
+        writer.add_items(items, "uuid")
+        self.assertLessEqual(len(writer.in_flight), 2)
+
+        writer.flush()
+        self.assertEqual(len(writer.in_flight), 0)
+        self.assertIsNone(writer.executor)
+        self.assertEqual(writer.flushes, 6)
+        self.assertEqual(writer.total, 11)
+        self.assertEqual(writer.total_items, 11)
+
+    def test_bulk_upload_workers(self):
+        """Test whether items are correctly uploaded using concurrent bulk requests"""
+
+        items = json.loads(read_file('data/git.json'))
+        elastic = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping)
+        elastic.max_items_bulk = 2
+        elastic.bulk_workers = 4
+
+        new_items = elastic.bulk_upload(items, field_id="uuid")
+        self.assertEqual(new_items, 11)
+
     def test_bulk_upload_no_items(self):
         """Test whether items are correctly uploaded to an index"""
 
@@ -523,6 +615,117 @@ class TestElastic(unittest.TestCase):
 
         self.assertEqual(inserted_items, 0)
 
+    @httpretty.activate
+    def test_put_bulk_retry(self):
+        """Test whether only the items rejected by ES are sent again"""
+
+        bulk_json = '{"index" : {"_id" : "1" } }\n{"a": 1}\n'
+        bulk_json += '{"index" : {"_id" : "2" } }\n{"a": 2}\n'
+        bulk_json += '{"index" : {"_id" : "3" } }\n{"a": 3}\n'
+
+        rejected = {"status": 429, "error": {"type": "es_rejected_execution_exception"}}
+        first = {"errors": True, "items": [{"index": {"_id": "1", "status": 201}},
+                                           {"index": dict(rejected, _id="2")},
+                                           {"index": dict(rejected, _id="3")}]}
+        second = {"errors": False, "items": [{"index": {"_id": "2", "status": 201}}]}
+        third = {"errors": False, "items": [{"index": {"_id": "3", "status": 201}}]}
+
+        elastic = MockElasticSearch(self.es_con, self.target_index, major='7')
+        elastic.bulk_retry_backoff = 0
+        bulk_url = elastic.get_bulk_url()
+
+        httpretty.register_uri(httpretty.PUT,
+                               bulk_url,
+                               responses=[httpretty.Response(body=json.dumps(first)),
+                                          httpretty.Response(body=json.dumps(second)),
+                                          httpretty.Response(body=json.dumps(third))])
+
+        result = elastic.put_bulk(bulk_url, bulk_json)
+        self.assertEqual(result.inserted, 3)
+        self.assertEqual(result.retried, 2)
+        self.assertEqual(result.dead_lettered, 0)
+
+        # The rejected items are sent again in smaller packs
+        requests_bodies = [req.body for req in httpretty.latest_requests()]
+        self.assertIn(b'{"index" : {"_id" : "2" } }\n{"a": 2}\n', requests_bodies)
+        self.assertEqual(requests_bodies[-1], b'{"index" : {"_id" : "3" } }\n{"a": 3}\n')
+
+    @httpretty.activate
+    def test_put_bulk_dead_letter(self):
+        """Test whether the items not inserted are written to the dead-letter file"""
+
+        bulk_json = '{"index" : {"_id" : "1" } }\n{"a": 1}\n'
+        bulk_json += '{"index" : {"_id" : "2" } }\n{"a": 2}\n'
+
+        rejected = {"_id": "1", "status": 429, "error": {"type": "es_rejected_execution_exception"}}
+        invalid = {"_id": "2", "status": 400, "error": {"type": "mapper_parsing_exception"}}
+        body = json.dumps({"errors": True, "items": [{"index": rejected}, {"index": invalid}]})
+        retry_body = json.dumps({"errors": True, "items": [{"index": rejected}]})
+
+        tmp_path = tempfile.mkdtemp(prefix='grimoire_elk_')
+        dead_letter_file = os.path.join(tmp_path, 'dead_letters.json')
+
+        elastic = MockElasticSearch(self.es_con, self.target_index, major='7')
+        elastic.bulk_retry_backoff = 0
+        elastic.max_bulk_retries = 2
+        elastic.dead_letter_file = dead_letter_file
+        bulk_url = elastic.get_bulk_url()
+
+        httpretty.register_uri(httpretty.PUT,
+                               bulk_url,
+                               responses=[httpretty.Response(body=body),
+                                          httpretty.Response(body=retry_body),
+                                          httpretty.Response(body=retry_body)])
+
+        with self.assertLogs(logger, level='ERROR') as cm:
+            result = elastic.put_bulk(bulk_url, bulk_json)
+            self.assertRegex(cm.output[0], "ERROR:grimoire_elk.elastic:Max retries reached*")
+            self.assertRegex(cm.output[1], "ERROR:grimoire_elk.elastic:Failed to insert data to ES*")
+
+        self.assertEqual(result.inserted, 0)
+        self.assertEqual(result.retried, 1)
+        self.assertEqual(result.dead_lettered, 2)
+
+        with open(dead_letter_file) as fd:
+            lines = fd.read().splitlines()
+        shutil.rmtree(tmp_path)
+
+        self.assertEqual(len(lines), 4)
+        self.assertDictEqual(json.loads(lines[0]), {"index": {"_id": "2", "_index": self.target_index}})
+        self.assertDictEqual(json.loads(lines[1]), {"a": 2})
+        self.assertDictEqual(json.loads(lines[2]), {"index": {"_id": "1", "_index": self.target_index}})
+        self.assertDictEqual(json.loads(lines[3]), {"a": 1})
+
+    @httpretty.activate
+    def test_put_bulk_compression(self):
+        """Test whether the bulk requests are compressed"""
+
+        bulk_json = '{"index" : {"_id" : "1" } }\n{"a": 1}\n'
+        bulk_json += '{"index" : {"_id" : "2" } }\n{"a": 2}\n'
+        body = json.dumps({"errors": False, "items": [{"index": {"_id": "1", "status": 201}},
+                                                      {"index": {"_id": "2", "status": 201}}]})
+
+        elastic = MockElasticSearch(self.es_con, self.target_index, major='7')
+        elastic.requests = grimoire_con(compression_level=9)
+        bulk_url = elastic.get_bulk_url()
+
+        httpretty.register_uri(httpretty.PUT,
+                               bulk_url,
+                               body=body)
+
+        before = get_compression_stats()
+        inserted_items = elastic.safe_put_bulk(bulk_url, bulk_json)
+        after = get_compression_stats()
+
+        self.assertEqual(inserted_items, 2)
+
+        request = httpretty.last_request()
+        self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(request.body), bulk_json.encode('utf-8'))
+
+        self.assertEqual(after['sent_bytes'] - before['sent_bytes'], len(bulk_json))
+        self.assertEqual(after['sent_compressed_bytes'] - before['sent_compressed_bytes'], len(request.body))
+
     def test_get_bulk_url(self):
         """Test that the bulk_url is correctly formed"""
 
@@ -535,6 +738,144 @@ class TestElastic(unittest.TestCase):
         expected_url = elastic.url + '/' + elastic.index + '/items/_bulk'
         self.assertEqual(elastic.get_bulk_url(), expected_url)
 
+    def test_add_refresh_param(self):
+        """Test whether the refresh param is added according to the refresh policy"""
+
+        elastic = MockElasticSearch(self.es_con, self.target_index, major='7')
+        bulk_url = elastic.get_bulk_url()
+        by_query_url = elastic.index_url + "/_update_by_query"
+
+        elastic.refresh_policy = None
+        self.assertEqual(elastic.add_refresh_param(bulk_url), bulk_url)
+        self.assertEqual(elastic.add_refresh_param(by_query_url), by_query_url)
+
+        elastic.refresh_policy = REFRESH_WAIT_FOR
+        self.assertEqual(elastic.add_refresh_param(bulk_url), bulk_url + "?refresh=wait_for")
+        self.assertEqual(elastic.add_refresh_param(by_query_url), by_query_url + "?refresh=true")
+
+        elastic.refresh_policy = REFRESH_TRUE
+        self.assertEqual(elastic.add_refresh_param(bulk_url + "?timeout=1m"), bulk_url + "?timeout=1m&refresh=true")
+
+    def test_refresh_index(self):
+        """Test whether the items are visible to search once the index is refreshed"""
+
+        items = json.loads(read_file('data/git.json'))
+        elastic = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping)
+        elastic.refresh_policy = None
+
+        new_items = elastic.bulk_upload(items, field_id="uuid")
+        self.assertEqual(new_items, 11)
+
+        elastic.refresh_index()
+
+        url = self.es_con + '/' + self.target_index + '/_count'
+        count = elastic.requests.get(url).json()['count']
+        self.assertEqual(count, 11)
+
+    @httpretty.activate
+    def test_refresh_index_error(self):
+        """Test whether a warning is logged when the index can't be refreshed"""
+
+        es_con = "http://es1.com"
+        elastic = MockElasticSearch(es_con, self.target_index)
+
+        httpretty.register_uri(httpretty.POST,
+                               es_con + "/" + self.target_index + "/_refresh",
+                               body={},
+                               status=500)
+
+        with self.assertLogs(logger, level='WARNING') as cm:
+            elastic.refresh_index()
+            self.assertRegex(cm.output[0], 'WARNING:grimoire_elk.elastic:Something went wrong when refreshing*')
+
+    def test_bulk_load(self):
+        """Test whether the index is tuned for bulk loading and its settings restored"""
+
+        items = json.loads(read_file('data/git.json'))
+        elastic = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping)
+        elastic.update_index_settings({"refresh_interval": "5s"})
+        elastic.refresh_policy = None
+
+        with elastic.bulk_load(force_merge=True):
+            settings = elastic.get_index_settings()
+            self.assertEqual(settings['refresh_interval'], '-1')
+            self.assertEqual(settings['number_of_replicas'], '0')
+
+            new_items = elastic.bulk_upload(items, field_id="uuid")
+            self.assertEqual(new_items, 11)
+
+        settings = elastic.get_index_settings()
+        self.assertEqual(settings['refresh_interval'], '5s')
+        self.assertEqual(settings['number_of_replicas'], '1')
+
+        url = self.es_con + '/' + self.target_index + '/_count'
+        count = elastic.requests.get(url).json()['count']
+        self.assertEqual(count, 11)
+
+    def test_bulk_load_error(self):
+        """Test whether the settings are restored when the bulk load fails"""
+
+        elastic = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping)
+
+        with self.assertRaises(ValueError):
+            with elastic.bulk_load():
+                raise ValueError
+
+        settings = elastic.get_index_settings()
+        self.assertNotIn('refresh_interval', settings)
+        self.assertEqual(settings['number_of_replicas'], '1')
+
+    def test_bulk_load_disabled(self):
+        """Test whether the settings are not modified when the bulk load is disabled"""
+
+        elastic = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping)
+
+        with elastic.bulk_load(enabled=False):
+            settings = elastic.get_index_settings()
+            self.assertNotIn('refresh_interval', settings)
+            self.assertEqual(settings['number_of_replicas'], '1')
+
+    def test_rebuild(self):
+        """Test whether a rebuilt index replaces the current one once the aliases are swapped"""
+
+        items = json.loads(read_file('data/git.json'))
+
+        # the index to rebuild is a concrete index
+        elastic = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping)
+        new_items = elastic.bulk_upload(items[:5], field_id="uuid")
+        self.assertEqual(new_items, 5)
+
+        rebuilt = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping,
+                                aliases=['A'], rebuild=True)
+        self.assertTrue(rebuilt.index.startswith(self.target_index + '-v'))
+        self.assertEqual(rebuilt.alias, self.target_index)
+        self.assertListEqual(rebuilt.get_index_versions(), [rebuilt.index])
+
+        new_items = rebuilt.bulk_upload(items, field_id="uuid")
+        self.assertEqual(new_items, 11)
+
+        # the readers still see the current index
+        url = self.es_con + '/' + self.target_index + '/_count'
+        self.assertEqual(requests.get(url, verify=False).json()['count'], 5)
+
+        rebuilt.swap_aliases()
+        self.assertEqual(requests.get(url, verify=False).json()['count'], 11)
+        self.assertIn('A', rebuilt.list_aliases())
+        self.assertIn(self.target_index, rebuilt.list_aliases())
+
+        # a new rebuild moves the aliases and deletes the old version
+        rebuilt_new = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping,
+                                    aliases=['A'], rebuild=True)
+        new_items = rebuilt_new.bulk_upload(items[:3], field_id="uuid")
+        self.assertEqual(new_items, 3)
+
+        rebuilt_new.swap_aliases()
+        self.assertEqual(requests.get(url, verify=False).json()['count'], 3)
+        self.assertListEqual(rebuilt_new.get_index_versions(), [rebuilt_new.index])
+        self.assertIn('A', rebuilt_new.list_aliases())
+
+        requests.delete(rebuilt_new.index_url, verify=False)
+
     def test_get_mapping_url(self):
         """Test that the mapping_url is correctly formed"""
 
@@ -764,6 +1105,25 @@ class TestElastic(unittest.TestCase):
             elastic.delete_items(retention_time=1, time_field='timestamp')
             self.assertRegex(cm.output[0], 'ERROR:grimoire_elk.elastic:\\[items retention\\] Error deleted items*')
 
+    @httpretty.activate
+    def test_delete_items_refresh(self):
+        """Test whether the deletion of the items follows the refresh policy"""
+
+        elastic = MockElasticSearch(self.es_con, self.target_index, major='7')
+        delete_url = elastic.index_url + "/_delete_by_query"
+
+        httpretty.register_uri(httpretty.POST,
+                               delete_url,
+                               body=json.dumps({"deleted": 1}))
+
+        elastic.refresh_policy = None
+        elastic.delete_items(retention_time=1, time_field='timestamp')
+        self.assertDictEqual(httpretty.last_request().querystring, {})
+
+        elastic.refresh_policy = REFRESH_WAIT_FOR
+        elastic.delete_items(retention_time=1, time_field='timestamp')
+        self.assertDictEqual(httpretty.last_request().querystring, {'refresh': ['true']})
+
 
 if __name__ == '__main__':
     unittest.main()
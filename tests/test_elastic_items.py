@@ -24,12 +24,17 @@ import logging
 import json
 import os
 import unittest
+import unittest.mock
 
+import httpretty
 import requests
 
-from grimoire_elk.elastic import ElasticSearch
+from grimoire_elk.elastic import ElasticSearch, REFRESH_WAIT_FOR
 from grimoire_elk.elastic_items import (ElasticItems,
+                                        PAGINATION_SCROLL,
                                         logger)
+from grimoire_elk.enriched.utils import AdaptivePageSize
+from grimoire_elk.metrics import metrics
 from grimoirelab_toolkit.datetime import str_to_datetime
 from grimoire_elk.raw.kitsune import KitsuneOcean
 from grimoire_elk.raw.git import GitOcean
@@ -60,6 +65,9 @@ class TestElasticItems(unittest.TestCase):
         cls.config.read(CONFIG_FILE)
         cls.es_con = dict(cls.config.items('ElasticSearch'))['url']
 
+        # Items are read back just after being written
+        ElasticSearch.refresh_policy = REFRESH_WAIT_FOR
+
     def tearDown(self):
         target_index_url = self.es_con + "/" + self.target_index
         requests.delete(target_index_url, verify=False)
@@ -333,6 +341,344 @@ class TestElasticItems(unittest.TestCase):
         items = [ei for ei in eitems.fetch()]
         self.assertEqual(len(items), 9)
 
+    def test_fetch_scroll(self):
+        """Test whether the fetch method properly works with the scroll pagination"""
+
+        perceval_backend = Git('/tmp/perceval_mc84igfc/gittest', '/tmp/foo')
+        elastic = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping)
+
+        # Load items
+        items = json.loads(read_file('data/git.json'))
+        ocean = GitOcean(perceval_backend)
+        ocean.elastic = elastic
+        ocean.feed_items(items)
+
+        eitems = ElasticItems(perceval_backend)
+        eitems.pagination = PAGINATION_SCROLL
+        eitems.scroll_size = 2
+        eitems.elastic = elastic
+
+        items = [ei for ei in eitems.fetch()]
+        self.assertEqual(len(items), 9)
+
+        timestamps = [item['metadata__timestamp'] for item in items]
+        self.assertListEqual(timestamps, sorted(timestamps))
+
+    @httpretty.activate
+    def test_fetch_pit(self):
+        """Test whether the items are paginated with search_after on a point in time"""
+
+        es_url = 'http://localhost:9200'
+        index_url = es_url + '/' + self.target_index
+
+        def hit(uuid, timestamp):
+            return {"_source": {"uuid": uuid, "metadata__timestamp": timestamp},
+                    "sort": [timestamp, uuid]}
+
+        pages = [
+            {"pit_id": "pit-2", "hits": {"hits": [hit("a", 1), hit("b", 1)]}},
+            {"pit_id": "pit-3", "hits": {"hits": [hit("c", 2)]}}
+        ]
+
+        httpretty.register_uri(httpretty.POST,
+                               index_url + '/_pit',
+                               body=json.dumps({"id": "pit-1"}))
+        httpretty.register_uri(httpretty.POST,
+                               es_url + '/_search',
+                               responses=[httpretty.Response(body=json.dumps(page)) for page in pages])
+        httpretty.register_uri(httpretty.DELETE,
+                               es_url + '/_pit',
+                               body=json.dumps({"succeeded": True}))
+
+        eitems = ElasticItems(self.perceval_backend)
+        eitems.scroll_size = 2
+        eitems.elastic = unittest.mock.Mock(url=es_url, index_url=index_url)
+
+        items = [ei['uuid'] for ei in eitems.fetch()]
+        self.assertListEqual(items, ["a", "b", "c"])
+
+        searches = [json.loads(req.body) for req in httpretty.latest_requests() if req.path == '/_search']
+        self.assertEqual(searches[0]['pit']['id'], "pit-1")
+        self.assertNotIn('search_after', searches[0])
+        self.assertEqual(searches[-1]['pit']['id'], "pit-2")
+        self.assertListEqual(searches[-1]['search_after'], [1, "b"])
+        self.assertListEqual([list(field.keys())[0] for field in searches[-1]['sort']],
+                             ['metadata__timestamp', 'uuid'])
+
+        # The point in time is released
+        self.assertEqual(httpretty.last_request().method, 'DELETE')
+        self.assertDictEqual(json.loads(httpretty.last_request().body), {"id": "pit-3"})
+
+    @httpretty.activate
+    def test_fetch_search_after(self):
+        """Test whether the fetch is resumed just after an item"""
+
+        es_url = 'http://localhost:9200'
+        index_url = es_url + '/' + self.target_index
+
+        page = {"pit_id": "pit-2", "hits": {"hits": [{"_source": {"uuid": "c"}, "sort": [1, "c"]}]}}
+
+        httpretty.register_uri(httpretty.POST,
+                               index_url + '/_pit',
+                               body=json.dumps({"id": "pit-1"}))
+        httpretty.register_uri(httpretty.POST,
+                               es_url + '/_search',
+                               body=json.dumps(page))
+        httpretty.register_uri(httpretty.DELETE,
+                               es_url + '/_pit',
+                               body=json.dumps({"succeeded": True}))
+
+        eitems = ElasticItems(self.perceval_backend)
+        eitems.elastic = unittest.mock.Mock(url=es_url, index_url=index_url)
+        eitems.set_search_after("2019-01-01T10:00:00.250000+00:00", "b")
+
+        items = [ei['uuid'] for ei in eitems.fetch()]
+        self.assertListEqual(items, ["c"])
+
+        search = [json.loads(req.body) for req in httpretty.latest_requests() if req.path == '/_search'][0]
+        self.assertListEqual(search['search_after'], [1546336800250, "b"])
+        self.assertIn({"range": {"metadata__timestamp": {"gte": "2019-01-01T10:00:00.250000+00:00"}}},
+                      search['query']['bool']['filter'])
+
+        # The incremental fetch can be ignored
+        list(eitems.fetch(ignore_incremental=True))
+        search = [json.loads(req.body) for req in httpretty.latest_requests() if req.path == '/_search'][-1]
+        self.assertNotIn('search_after', search)
+
+    @httpretty.activate
+    def test_fetch_sliced(self):
+        """Test whether the slices of a point in time are read and merged"""
+
+        es_url = 'http://localhost:9200'
+        index_url = es_url + '/' + self.target_index
+
+        slices = {
+            0: [["a", "b"], ["c"]],
+            1: [["d"]]
+        }
+
+        def search_callback(request, uri, headers):
+            search = json.loads(request.body)
+            pages = slices[search['slice']['id']]
+            page = pages[1] if 'search_after' in search else pages[0]
+            hits = [{"_source": {"uuid": uuid}, "sort": [1, uuid]} for uuid in page]
+            return 200, headers, json.dumps({"pit_id": "pit-1", "hits": {"hits": hits}})
+
+        httpretty.register_uri(httpretty.POST,
+                               index_url + '/_pit',
+                               body=json.dumps({"id": "pit-1"}))
+        httpretty.register_uri(httpretty.POST,
+                               es_url + '/_search',
+                               body=search_callback)
+        httpretty.register_uri(httpretty.DELETE,
+                               es_url + '/_pit',
+                               body=json.dumps({"succeeded": True}))
+
+        eitems = ElasticItems(self.perceval_backend)
+        eitems.scroll_size = 2
+        eitems.read_slices = 2
+        eitems.elastic = unittest.mock.Mock(url=es_url, index_url=index_url)
+
+        items = [ei['uuid'] for ei in eitems.fetch()]
+        self.assertListEqual(sorted(items), ["a", "b", "c", "d"])
+
+        searches = [json.loads(req.body) for req in httpretty.latest_requests() if req.path == '/_search']
+        for search in searches:
+            self.assertEqual(search['slice']['max'], 2)
+            self.assertIn('filter', search['query']['bool'])
+
+        # The point in time is released
+        self.assertEqual(httpretty.last_request().method, 'DELETE')
+
+    @httpretty.activate
+    def test_fetch_sliced_no_pit(self):
+        """Test whether a warning is logged when the slices fall back to a single scroll"""
+
+        es_url = 'http://localhost:9200'
+        index_url = es_url + '/' + self.target_index
+
+        httpretty.register_uri(httpretty.POST,
+                               index_url + '/_pit',
+                               status=404,
+                               body=json.dumps({"error": "no such index"}))
+        httpretty.register_uri(httpretty.POST,
+                               index_url + '/_search',
+                               body=json.dumps({"_scroll_id": "scroll-1",
+                                                "hits": {"total": 1, "hits": [{"_source": {"uuid": "a"}}]}}))
+        httpretty.register_uri(httpretty.POST,
+                               es_url + '/_search/scroll',
+                               body=json.dumps({"_scroll_id": "scroll-1", "hits": {"total": 1, "hits": []}}))
+        httpretty.register_uri(httpretty.DELETE,
+                               es_url + '/_search/scroll',
+                               body=json.dumps({"succeeded": True}))
+
+        eitems = ElasticItems(self.perceval_backend)
+        eitems.read_slices = 2
+        eitems.elastic = unittest.mock.Mock(url=es_url, index_url=index_url)
+
+        with self.assertLogs(logger, level='WARNING') as cm:
+            items = [ei['uuid'] for ei in eitems.fetch()]
+            self.assertListEqual(items, ["a"])
+            self.assertRegex(cm.output[0], 'WARNING:grimoire_elk.elastic_items:Reading .* with a single scroll '
+                                           'instead of 2 slices.*point in time not available')
+
+    @httpretty.activate
+    def test_fetch_prefetch(self):
+        """Test whether the pages are read ahead and the point in time released when stopping"""
+
+        es_url = 'http://localhost:9200'
+        index_url = es_url + '/' + self.target_index
+
+        def search_callback(request, uri, headers):
+            search = json.loads(request.body)
+            start = search['search_after'][0] + 1 if 'search_after' in search else 0
+            hits = [{"_source": {"uuid": str(i)}, "sort": [i]} for i in range(start, min(start + 2, 10))]
+            return 200, headers, json.dumps({"hits": {"hits": hits}})
+
+        httpretty.register_uri(httpretty.POST,
+                               index_url + '/_pit',
+                               body=json.dumps({"id": "pit-1"}))
+        httpretty.register_uri(httpretty.POST,
+                               es_url + '/_search',
+                               body=search_callback)
+        httpretty.register_uri(httpretty.DELETE,
+                               es_url + '/_pit',
+                               body=json.dumps({"succeeded": True}))
+
+        eitems = ElasticItems(self.perceval_backend)
+        eitems.scroll_size = 2
+        eitems.prefetch_pages = 2
+        eitems.prefetch_max_bytes = 10
+        eitems.elastic = unittest.mock.Mock(url=es_url, index_url=index_url)
+
+        items = [ei['uuid'] for ei in eitems.fetch()]
+        self.assertListEqual(items, [str(i) for i in range(10)])
+        self.assertEqual(httpretty.last_request().method, 'DELETE')
+
+        # Stop consuming the items before the end
+        items = eitems.fetch()
+        self.assertEqual(next(items)['uuid'], '0')
+        items.close()
+
+        self.assertEqual(httpretty.last_request().method, 'DELETE')
+
+    def test_fetch_source_fields(self):
+        """Test whether only the fields requested are fetched"""
+
+        perceval_backend = Git('/tmp/perceval_mc84igfc/gittest', '/tmp/foo')
+        elastic = ElasticSearch(self.es_con, self.target_index, GitOcean.mapping)
+
+        # Load items
+        items = json.loads(read_file('data/git.json'))
+        ocean = GitOcean(perceval_backend)
+        ocean.elastic = elastic
+        ocean.feed_items(items)
+
+        for pagination in ['pit', PAGINATION_SCROLL]:
+            eitems = ElasticItems(perceval_backend)
+            eitems.pagination = pagination
+            eitems.elastic = elastic
+
+            items = [ei for ei in eitems.fetch(includes=["uuid", "data.commit"])]
+            self.assertEqual(len(items), 9)
+            for item in items:
+                self.assertListEqual(sorted(item.keys()), ["data", "uuid"])
+                self.assertListEqual(list(item['data'].keys()), ["commit"])
+
+            # Fields set for all the fetches
+            eitems.set_source_fields(excludes=["data"])
+            items = [ei for ei in eitems.fetch()]
+            self.assertEqual(len(items), 9)
+            for item in items:
+                self.assertNotIn("data", item)
+                self.assertIn("uuid", item)
+
+    def test_adaptive_page_size(self):
+        """Test whether the page size moves toward the target size and latency"""
+
+        page_size = AdaptivePageSize(100, min_size=20, max_size=150, target_bytes=1000, target_latency=None)
+
+        # Responses too big, the size is halved at most
+        self.assertEqual(page_size.update(100, 1, n_bytes=10000), 50)
+        self.assertEqual(page_size.update(50, 1, n_bytes=5000), 25)
+        self.assertEqual(page_size.update(25, 1, n_bytes=2500), 20)
+
+        # Responses too small, the size is doubled at most
+        self.assertEqual(page_size.update(20, 1, n_bytes=100), 40)
+        self.assertEqual(page_size.update(40, 1, n_bytes=400), 80)
+        self.assertEqual(page_size.update(80, 1, n_bytes=800), 100)
+        self.assertEqual(page_size.update(100, 1, n_bytes=100), 150)
+
+        # Empty pages don't change the size
+        self.assertEqual(page_size.update(0, 1, n_bytes=10), 150)
+
+        # The slowest target wins
+        page_size = AdaptivePageSize(100, target_bytes=1000, target_latency=2)
+        self.assertEqual(page_size.update(100, 4, n_bytes=1000), 50)
+        self.assertEqual(page_size.pages, 1)
+        self.assertEqual(page_size.items, 100)
+
+    def test_adaptive_page_size_metrics(self):
+        """Test whether the page sizes chosen are counted in the metrics"""
+
+        metrics.enabled = True
+        metrics.reset()
+        try:
+            page_size = AdaptivePageSize(100, target_bytes=1000, target_latency=None, name='test')
+            page_size.update(100, 1, n_bytes=10000)
+            page_size.update(50, 1, n_bytes=500)
+            page_size.update(100, 1, n_bytes=1000)
+
+            counters = metrics.pop()['counters']
+        finally:
+            metrics.enabled = False
+            metrics.reset()
+
+        self.assertDictEqual(counters, {'test.page_size.pages': 3,
+                                        'test.page_size.items': 250,
+                                        'test.page_size.changes': 2})
+
+    @httpretty.activate
+    def test_fetch_adaptive_page_size(self):
+        """Test whether the size of the pages read with search_after is adapted"""
+
+        es_url = 'http://localhost:9200'
+        index_url = es_url + '/' + self.target_index
+
+        def search_callback(request, uri, headers):
+            search = json.loads(request.body)
+            start = search['search_after'][0] + 1 if 'search_after' in search else 0
+            hits = [{"_source": {"uuid": str(i), "data": "x" * 100}, "sort": [i]}
+                    for i in range(start, min(start + search['size'], 100))]
+            return 200, headers, json.dumps({"hits": {"hits": hits}})
+
+        httpretty.register_uri(httpretty.POST,
+                               index_url + '/_pit',
+                               body=json.dumps({"id": "pit-1"}))
+        httpretty.register_uri(httpretty.POST,
+                               es_url + '/_search',
+                               body=search_callback)
+        httpretty.register_uri(httpretty.DELETE,
+                               es_url + '/_pit',
+                               body=json.dumps({"succeeded": True}))
+
+        eitems = ElasticItems(self.perceval_backend)
+        eitems.scroll_size = 40
+        eitems.adaptive_page_size = True
+        eitems.elastic = unittest.mock.Mock(url=es_url, index_url=index_url)
+        page_size = eitems.get_page_size()
+        page_size.min_size = 5
+        page_size.target_bytes = 1000
+        page_size.target_latency = None
+
+        items = [ei['uuid'] for ei in eitems.fetch()]
+        self.assertListEqual(items, [str(i) for i in range(100)])
+
+        sizes = [json.loads(req.body)['size'] for req in httpretty.latest_requests() if req.path == '/_search']
+        self.assertEqual(sizes[0], 40)
+        self.assertLess(sizes[-1], 40)
+        self.assertEqual(page_size.size, sizes[-1])
+
     def test_fetch_from_date(self):
         """Test whether the fetch method with from_date properly works"""
 
@@ -401,7 +747,7 @@ class TestElasticItems(unittest.TestCase):
             items = [ei for ei in eitems.fetch()]
             self.assertEqual(len(items), 0)
             self.assertRegex(cm.output[-2], 'DEBUG:grimoire_elk.elastic_items:No results found.*')
-            self.assertRegex(cm.output[-1], 'DEBUG:grimoire_elk.elastic_items:Releasing scroll_id=*')
+            self.assertRegex(cm.output[-1], 'DEBUG:grimoire_elk.elastic_items:Releasing (scroll_id|pit_id)=*')
 
     def test_fetch_empty(self):
         """Test whether the fetch method returns an empty list when the index is empty"""
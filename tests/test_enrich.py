@@ -20,16 +20,21 @@
 #
 
 import configparser
+import datetime
 import requests
 import sys
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
+from grimoirelab_toolkit.datetime import str_to_datetime
 from grimoire_elk.elastic import logger
 from grimoire_elk.enriched.enrich import (Enrich,
                                           DEMOGRAPHICS_ALIAS,
                                           HEADER_JSON,
                                           anonymize_url)
+from grimoire_elk.enriched.identities_cache import identities_cache
+from grimoire_elk.enriched.sortinghat_gelk import IdentitiesSnapshot
+from sortinghat import utils as sh_utils
 from sortinghat.db.model import UniqueIdentity, Profile
 from grimoire_elk.utils import get_connectors, get_elastic
 
@@ -42,6 +47,7 @@ CONFIG_FILE = 'tests.conf'
 class TestEnrich(unittest.TestCase):
 
     def setUp(self):
+        identities_cache.invalidate()
         self._enrich = Enrich()
 
         self.empty_item = {
@@ -617,6 +623,147 @@ class TestEnrich(unittest.TestCase):
         self.assertEqual(eitem_sh['author_bot'], self.empty_item['author_bot'])
         self.assertEqual(eitem_sh['author_multi_org_names'], self.empty_item['author_multi_org_names'])
 
+    def test_identities_snapshot(self):
+        """Test whether the identities are resolved from the snapshot"""
+
+        identity = {
+            "email": "pepe@host.com",
+            "name": "pepe",
+            "username": None
+        }
+        sh_id = sh_utils.uuid('git', email=identity['email'], name=identity['name'], username=None)
+
+        identities = [(sh_id, 'aaaaa'), ('11111', 'bbbbb')]
+        profiles = [('aaaaa', 'Pepe', 'pepe@host.com', 'male', 100, True)]
+        enrollments = [
+            ('aaaaa', 'Bitergia', datetime.datetime(2010, 1, 1), datetime.datetime(2015, 1, 1)),
+            ('aaaaa', 'Example', datetime.datetime(2015, 1, 1), datetime.datetime(2100, 1, 1))
+        ]
+        self._enrich.sh_snapshot = IdentitiesSnapshot(identities, profiles, enrollments)
+
+        self.assertDictEqual(self._enrich.get_sh_ids(identity, 'git'), {"id": sh_id, "uuid": 'aaaaa'})
+        self.assertEqual(self._enrich.get_uuid_from_id('11111'), 'bbbbb')
+
+        profile = self._enrich.get_profile_sh('aaaaa')
+        self.assertDictEqual(profile, {'name': 'Pepe', 'email': 'pepe@host.com',
+                                       'gender': 'male', 'gender_acc': 100})
+        self.assertTrue(self._enrich.is_bot('aaaaa'))
+        self.assertDictEqual(self._enrich.get_profile_sh('bbbbb'), {})
+        self.assertFalse(self._enrich.is_bot('bbbbb'))
+
+        self.assertEqual(self._enrich.get_enrollment('aaaaa', datetime.datetime(2012, 1, 1)), 'Bitergia')
+        self.assertEqual(self._enrich.get_enrollment('aaaaa', None), 'Bitergia')
+        self.assertListEqual(self._enrich.get_multi_enrollment('aaaaa', datetime.datetime(2015, 1, 1)),
+                             ['Bitergia', 'Example'])
+        self.assertEqual(self._enrich.get_enrollment('bbbbb', datetime.datetime(2012, 1, 1)), 'Unknown')
+
+        # The organizations are shared by the enrollments
+        enrollments.append(('bbbbb', 'Bitergia', datetime.datetime(2010, 1, 1), datetime.datetime(2100, 1, 1)))
+        snapshot = IdentitiesSnapshot(identities, profiles, enrollments)
+        self.assertIs(snapshot.get_enrollments('aaaaa')[0].organization,
+                      snapshot.get_enrollments('bbbbb')[0].organization)
+        self.assertIsNone(snapshot.get_enrollments('ccccc'))
+
+    def test_identities_snapshot_miss(self):
+        """Test whether the identities not found in the snapshot are queried to SortingHat"""
+
+        self._enrich.sh_snapshot = IdentitiesSnapshot([('11111', 'aaaaa')])
+
+        with patch('grimoire_elk.enriched.enrich.SortingHat.get_uuid_from_id', return_value='ccccc') as query:
+            self.assertEqual(self._enrich.get_uuid_from_id('22222'), 'ccccc')
+            self.assertEqual(self._enrich.get_uuid_from_id('11111'), 'aaaaa')
+            query.assert_called_once_with(self._enrich.sh_db, '22222')
+
+        # Without fallback the identities are not found
+        enrich = Enrich()
+        enrich.identities_snapshot_fallback = False
+        enrich.sh_snapshot = IdentitiesSnapshot([('11111', 'aaaaa')])
+
+        identity = {"email": "pepe@host.com", "name": "pepe", "username": None}
+        self.assertDictEqual(enrich.get_sh_ids(identity, 'git'), {"id": None, "uuid": None})
+        self.assertIsNone(enrich.get_uuid_from_id('22222'))
+        self.assertIsNone(enrich.get_unique_identity('ccccc').profile)
+        self.assertListEqual(enrich.get_enrollments('ccccc'), [])
+        self.assertListEqual(enrich.get_enrollments('aaaaa'), [])
+
+    def test_enrollments_index(self):
+        """Test whether the organizations are found by date with overlapping enrollments"""
+
+        enrollments = [
+            ('aaaaa', 'Bitergia', datetime.datetime(2010, 1, 1), datetime.datetime(2015, 1, 1)),
+            ('aaaaa', 'Example', datetime.datetime(2012, 1, 1), datetime.datetime(2013, 1, 1)),
+            ('aaaaa', 'Example', datetime.datetime(2014, 1, 1), datetime.datetime(2100, 1, 1))
+        ]
+        self._enrich.sh_snapshot = IdentitiesSnapshot([('11111', 'aaaaa'), ('22222', 'bbbbb')],
+                                                      enrollments=enrollments)
+
+        expected = [
+            (datetime.datetime(2009, 12, 31), []),
+            (datetime.datetime(2010, 1, 1), ['Bitergia']),
+            (datetime.datetime(2012, 1, 1), ['Bitergia', 'Example']),
+            (datetime.datetime(2012, 6, 1), ['Bitergia', 'Example']),
+            (datetime.datetime(2013, 6, 1), ['Bitergia']),
+            (datetime.datetime(2015, 1, 1), ['Bitergia', 'Example']),
+            (datetime.datetime(2015, 1, 1, 0, 0, 1), ['Example']),
+            (datetime.datetime(2100, 1, 1), ['Example']),
+            (datetime.datetime(2100, 1, 2), []),
+            (None, ['Bitergia', 'Example', 'Example'])
+        ]
+        for date, organizations in expected:
+            self.assertListEqual(self._enrich.get_multi_enrollment('aaaaa', date), organizations)
+            enrollment = organizations[0] if organizations else 'Unknown'
+            self.assertEqual(self._enrich.get_enrollment('aaaaa', date), enrollment)
+
+        # The dates with time zone are converted to UTC
+        date = str_to_datetime('2015-01-01T01:00:00+01:00')
+        self.assertListEqual(self._enrich.get_multi_enrollment('aaaaa', date), ['Bitergia', 'Example'])
+        date = str_to_datetime('2015-01-01T00:00:00-01:00')
+        self.assertListEqual(self._enrich.get_multi_enrollment('aaaaa', date), ['Example'])
+
+        # Identities without enrollments are unaffiliated
+        self.assertEqual(self._enrich.get_enrollment('bbbbb', None), 'Unknown')
+        self.assertListEqual(self._enrich.get_multi_enrollment('bbbbb', datetime.datetime(2012, 1, 1)),
+                             ['Unknown'])
+
+    def test_identities_cache(self):
+        """Test whether the identities resolved are shared by the enrichers"""
+
+        identities_cache.pop_stats()
+        with patch('grimoire_elk.enriched.enrich.SortingHat.get_uuid_from_id', return_value='aaaaa') as query:
+            self.assertEqual(self._enrich.get_uuid_from_id('11111'), 'aaaaa')
+            self.assertEqual(Enrich().get_uuid_from_id('11111'), 'aaaaa')
+            query.assert_called_once_with(self._enrich.sh_db, '11111')
+
+            # The identity is queried again once invalidated
+            identities_cache.invalidate(['11111'])
+            self.assertEqual(self._enrich.get_uuid_from_id('11111'), 'aaaaa')
+            self.assertEqual(query.call_count, 2)
+
+        stats = identities_cache.pop_stats()
+        self.assertDictEqual(stats['uuids'], {'hits': 1, 'misses': 2, 'evictions': 0, 'expired': 0})
+
+    def test_sync_identities_cache(self):
+        """Test whether only the identities modified in SortingHat since the last sync are invalidated"""
+
+        self._enrich.sortinghat = True
+        identities_cache.synced = None
+        identities_cache.put('uuids', '11111', 'aaaaa')
+        identities_cache.put('uuids', '22222', 'bbbbb')
+
+        with patch('grimoire_elk.enriched.enrich.SortingHat.get_modified_identities',
+                   return_value=(['11111'], [])) as query:
+            # Nothing to invalidate in the first sync of the process
+            self._enrich.sync_identities_cache()
+            query.assert_not_called()
+            synced = identities_cache.synced
+            self.assertIsNotNone(synced)
+
+            self._enrich.sync_identities_cache()
+            query.assert_called_once_with(self._enrich.sh_db, synced)
+
+        self.assertDictEqual(identities_cache.get_many('uuids', ['11111', '22222']), {'22222': 'bbbbb'})
+        identities_cache.synced = None
+
     def test_has_identities(self):
         """Test whether has_identities works"""
 
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from grimoire_elk.elastic import BulkWriter
+from grimoire_elk.files import ElasticSearchFile, get_item_field, read_items
+from grimoire_elk.utils import get_connectors
+
+
+def read_file(path):
+    with open(os.path.join("data", path)) as f:
+        return json.load(f)
+
+
+def read_bulk_file(path):
+    """Read the documents of a file in bulk API format, as (id, document) pairs"""
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as fd:
+        lines = [json.loads(line) for line in fd]
+
+    return [(action['index']['_id'], doc) for action, doc in zip(lines[::2], lines[1::2])]
+
+
+class TestReadItems(unittest.TestCase):
+    """Unit tests for read_items"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='files_')
+        self.items = read_file('git.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_ndjson(self):
+        """Test whether the items are read from a NDJSON file"""
+
+        path = os.path.join(self.tmp_path, 'items.json')
+        with open(path, 'w') as fd:
+            for item in self.items:
+                fd.write(json.dumps(item) + "\n")
+
+        self.assertListEqual(list(read_items(path)), self.items)
+
+    def test_perceval_dump(self):
+        """Test whether the items are read from a Perceval dump, even if they span several blocks"""
+
+        path = os.path.join(self.tmp_path, 'items.json')
+        with open(path, 'w') as fd:
+            for item in self.items:
+                fd.write(json.dumps(item, indent=4, sort_keys=True) + "\n")
+
+        self.assertListEqual(list(read_items(path)), self.items)
+
+        with unittest.mock.patch('grimoire_elk.files.READ_BLOCK_SIZE', 100):
+            self.assertListEqual(list(read_items(path)), self.items)
+
+    def test_list(self):
+        """Test whether the items are read from a JSON list"""
+
+        path = os.path.join(self.tmp_path, 'items.json')
+        with open(path, 'w') as fd:
+            json.dump(self.items, fd, indent=4)
+
+        self.assertListEqual(list(read_items(path)), self.items)
+
+    def test_gzip(self):
+        """Test whether the items are read from a gzipped file"""
+
+        path = os.path.join(self.tmp_path, 'items.json.gz')
+        with gzip.open(path, 'wt') as fd:
+            for item in self.items:
+                fd.write(json.dumps(item) + "\n")
+
+        self.assertListEqual(list(read_items(path)), self.items)
+
+    def test_empty(self):
+        """Test whether no items are read from an empty file"""
+
+        path = os.path.join(self.tmp_path, 'items.json')
+        with open(path, 'w') as fd:
+            fd.write("\n")
+
+        self.assertListEqual(list(read_items(path)), [])
+
+    def test_invalid(self):
+        """Test whether an exception is thrown when an item is not valid JSON"""
+
+        path = os.path.join(self.tmp_path, 'items.json')
+        with open(path, 'w') as fd:
+            fd.write('{"uuid": "a"}\n{"uuid": \n')
+
+        with self.assertRaises(ValueError):
+            _ = list(read_items(path))
+
+    def test_get_item_field(self):
+        """Test whether the nested fields of the items are found"""
+
+        item = self.items[0]
+
+        self.assertEqual(get_item_field(item, 'origin'), item['origin'])
+        self.assertEqual(get_item_field(item, 'data.commit'), item['data']['commit'])
+        self.assertIsNone(get_item_field(item, 'data.unknown'))
+        self.assertIsNone(get_item_field(item, 'origin.unknown'))
+
+
+class TestElasticSearchFile(unittest.TestCase):
+    """Unit tests for ElasticSearchFile class"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='files_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_bulk_upload(self):
+        """Test whether the documents are written to the file in bulk format"""
+
+        items = [{"uuid": str(i), "value": "line\n" * i} for i in range(25)]
+
+        for name in ['enriched.json', 'enriched.json.gz']:
+            path = os.path.join(self.tmp_path, name)
+            elastic = ElasticSearchFile(path, 'Git_Enriched')
+            self.assertEqual(elastic.index, 'git_enriched')
+
+            writer = BulkWriter(elastic, max_items=10, workers=2)
+            writer.add_items(items, 'uuid')
+            writer.flush()
+            elastic.close()
+            elastic.close()
+
+            self.assertEqual(writer.total, 25)
+            self.assertEqual(writer.total_items, 25)
+            self.assertEqual(elastic.total, 25)
+
+            docs = read_bulk_file(path)
+            self.assertListEqual(docs, [(item['uuid'], item) for item in items])
+
+            elastic = ElasticSearchFile(path, 'git_enriched')
+            self.assertEqual(elastic.bulk_upload(items[:5], 'uuid'), 5)
+            elastic.close()
+
+            self.assertEqual(len(read_bulk_file(path)), 5)
+
+
+class TestFetchFile(unittest.TestCase):
+    """Unit tests for the raw items read from a file"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='files_')
+        self.connector = get_connectors()['git']
+        self.items = read_file('git.json')
+
+        self.path = os.path.join(self.tmp_path, 'git.json')
+        with open(self.path, 'w') as fd:
+            for item in self.items:
+                fd.write(json.dumps(item, indent=4) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_fetch(self):
+        """Test whether the items dumped by Perceval are prepared as in the raw index"""
+
+        ocean_backend = self.connector[1](None)
+        ocean_backend.set_raw_file(self.path)
+
+        items = [item for item in ocean_backend.fetch()]
+        self.assertEqual(len(items), len(self.items))
+        for item in items:
+            self.assertIn('metadata__updated_on', item)
+            self.assertIn('metadata__timestamp', item)
+
+        # Items already prepared are read as they are
+        path = os.path.join(self.tmp_path, 'git_raw.json')
+        with open(path, 'w') as fd:
+            for item in items:
+                fd.write(json.dumps(item) + "\n")
+
+        ocean_backend.set_raw_file(path)
+        self.assertListEqual([item for item in ocean_backend.fetch()], items)
+
+    def test_fetch_filters(self):
+        """Test whether the items are filtered as in the raw index"""
+
+        commit = self.items[0]['data']['commit']
+
+        ocean_backend = self.connector[1](None)
+        ocean_backend.set_raw_file(self.path)
+
+        items = [item for item in ocean_backend.fetch(_filter={"name": "data.commit", "value": [commit]})]
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0]['data']['commit'], commit)
+
+        ocean_backend.set_filter_raw("data.commit:" + commit)
+        items = [item for item in ocean_backend.fetch()]
+        self.assertEqual(len(items), 1)
+
+        ocean_backend = self.connector[1](None, from_date=datetime.datetime(2100, 1, 1))
+        ocean_backend.set_raw_file(self.path)
+        self.assertListEqual([item for item in ocean_backend.fetch()], [])
+        self.assertEqual(len([item for item in ocean_backend.fetch(ignore_incremental=True)]), len(self.items))
+
+    def test_enrich(self):
+        """Test whether the raw items of a file are enriched to a file"""
+
+        ocean_backend = self.connector[1](None)
+        ocean_backend.set_raw_file(self.path)
+
+        path = os.path.join(self.tmp_path, 'git_enriched.json.gz')
+        enrich_backend = self.connector[2]()
+        enrich_backend.set_elastic(ElasticSearchFile(path, 'git_enriched'))
+
+        enrich_count = enrich_backend.enrich_items(ocean_backend)
+        enrich_backend.elastic.close()
+
+        docs = read_bulk_file(path)
+        self.assertEqual(enrich_count, len(self.items))
+        self.assertEqual(len(docs), len(self.items))
+        self.assertSetEqual({doc['hash'] for _, doc in docs},
+                            {item['data']['commit'] for item in self.items})
+
+
+if __name__ == "__main__":
+    unittest.main(warnings='ignore')
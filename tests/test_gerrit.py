@@ -24,7 +24,8 @@ import time
 import unittest
 
 from base import TestBaseBackend, DB_SORTINGHAT
-from grimoire_elk.enriched.enrich import (logger,
+from grimoire_elk.enriched.enrich import (Enrich,
+                                          logger,
                                           DEMOGRAPHICS_ALIAS,
                                           anonymize_url)
 from grimoire_elk.enriched.utils import REPO_LABELS
@@ -205,6 +206,18 @@ class TestGerrit(TestBaseBackend):
         epatchsets = enrich_backend.get_rich_item_patchsets(patchsets, eitem)
         self.assertEqual(len(epatchsets), 2)
 
+    def test_raw_to_enrich_workers(self):
+        """Test whether the raw index is properly enriched by a pool of processes"""
+
+        Enrich.enrich_workers = 2
+        try:
+            result = self._test_raw_to_enrich()
+        finally:
+            Enrich.enrich_workers = 1
+
+        self.assertEqual(result['raw'], 6)
+        self.assertEqual(result['enrich'], 240)
+
     def test_demography_study(self):
         """ Test that the demography study works correctly """
 
@@ -24,9 +24,10 @@ import requests
 import time
 import unittest
 
-from base import TestBaseBackend
+from base import TestBaseBackend, FILE_PROJECTS
 from grimoire_elk.raw.git import GitOcean
-from grimoire_elk.enriched.enrich import (logger,
+from grimoire_elk.enriched.enrich import (Enrich,
+                                          logger,
                                           DEMOGRAPHICS_ALIAS,
                                           anonymize_url)
 from grimoire_elk.enriched.utils import REPO_LABELS
@@ -165,6 +166,18 @@ class TestGit(TestBaseBackend):
             self.assertIn('is_git_commit_signed_off', source)
             self.assertIn('git_uuid', source)
 
+    def test_raw_to_enrich_workers(self):
+        """Test whether the raw index is properly enriched by a pool of processes"""
+
+        Enrich.enrich_workers = 2
+        try:
+            result = self._test_raw_to_enrich(pair_programming=True)
+        finally:
+            Enrich.enrich_workers = 1
+
+        self.assertEqual(result['raw'], 11)
+        self.assertEqual(result['enrich'], 13)
+
     def test_enrich_repo_labels(self):
         """Test whether the field REPO_LABELS is present in the enriched items"""
 
@@ -234,6 +247,20 @@ class TestGit(TestBaseBackend):
                 self.assertNotIn('username:password', source['origin'])
                 self.assertNotIn('username:password', source['tag'])
 
+    def test_get_rich_items_batch(self):
+        """Test whether a page of items is enriched as when enriching each item"""
+
+        enrich_backend = self.connectors[self.connector][2](json_projects_map=FILE_PROJECTS)
+
+        eitems = enrich_backend.get_rich_items_batch(self.items)
+        self.assertEqual(len(eitems), len(self.items))
+
+        for item, eitem in zip(self.items, eitems):
+            expected = enrich_backend.get_rich_item(item)
+            expected.pop('metadata__enriched_on')
+            eitem.pop('metadata__enriched_on')
+            self.assertDictEqual(eitem, expected)
+
     def test_refresh_identities(self):
         """Test refresh identities"""
 
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from grimoire_elk.enriched.identities_cache import IdentitiesCache
+from grimoire_elk.enriched.sortinghat_gelk import (EnrollmentsIndex,
+                                                   IdentitiesCacheStore,
+                                                   SnapshotEnrollment,
+                                                   SnapshotOrganization,
+                                                   SnapshotProfile,
+                                                   SnapshotUniqueIdentity)
+from grimoire_elk.metrics import Metrics, metrics
+
+
+class TestIdentitiesCache(unittest.TestCase):
+    """Unit tests for IdentitiesCache class"""
+
+    def test_get(self):
+        """Test whether the values are loaded once"""
+
+        cache = IdentitiesCache()
+        load = MagicMock(return_value='aaaaa')
+
+        self.assertEqual(cache.get('uuids', '11111', load), 'aaaaa')
+        self.assertEqual(cache.get('uuids', '11111', load), 'aaaaa')
+        load.assert_called_once_with()
+
+        # The values not found are cached too
+        load = MagicMock(return_value=None)
+        self.assertIsNone(cache.get('uuids', '22222', load))
+        self.assertIsNone(cache.get('uuids', '22222', load))
+        load.assert_called_once_with()
+
+        # The regions are independent
+        self.assertEqual(cache.get('enrollments', '11111', lambda: []), [])
+
+        stats = cache.pop_stats()
+        self.assertDictEqual(stats['uuids'], {'hits': 2, 'misses': 2, 'evictions': 0, 'expired': 0})
+        self.assertDictEqual(stats['enrollments'], {'hits': 0, 'misses': 1, 'evictions': 0, 'expired': 0})
+        self.assertDictEqual(cache.stats, {})
+        self.assertEqual(len(cache), 3)
+
+    def test_get_many(self):
+        """Test whether the values of several keys are cached"""
+
+        cache = IdentitiesCache()
+        cache.put_many('uuids', {'11111': 'aaaaa', '22222': None})
+
+        self.assertDictEqual(cache.get_many('uuids', ['11111', '22222', '33333']),
+                             {'11111': 'aaaaa', '22222': None})
+        self.assertDictEqual(cache.pop_stats()['uuids'], {'hits': 2, 'misses': 1, 'evictions': 0, 'expired': 0})
+
+    def test_eviction(self):
+        """Test whether the least recently used entries are evicted"""
+
+        cache = IdentitiesCache()
+        cache.max_size = 2
+
+        cache.put('uuids', '11111', 'aaaaa')
+        cache.put('uuids', '22222', 'bbbbb')
+        cache.get('uuids', '11111', None)
+        cache.put('uuids', '33333', 'ccccc')
+
+        self.assertDictEqual(cache.get_many('uuids', ['11111', '22222', '33333']),
+                             {'11111': 'aaaaa', '33333': 'ccccc'})
+        self.assertEqual(cache.pop_stats()['uuids']['evictions'], 1)
+
+    def test_ttl(self):
+        """Test whether the entries expire"""
+
+        cache = IdentitiesCache()
+        cache.ttl = 60
+
+        with patch('grimoire_elk.enriched.identities_cache.time.monotonic', return_value=1000):
+            cache.put('uuids', '11111', 'aaaaa')
+        with patch('grimoire_elk.enriched.identities_cache.time.monotonic', return_value=1059):
+            self.assertEqual(cache.get('uuids', '11111', lambda: 'bbbbb'), 'aaaaa')
+        with patch('grimoire_elk.enriched.identities_cache.time.monotonic', return_value=1060):
+            self.assertEqual(cache.get('uuids', '11111', lambda: 'bbbbb'), 'bbbbb')
+
+        self.assertDictEqual(cache.pop_stats()['uuids'], {'hits': 1, 'misses': 1, 'evictions': 0, 'expired': 1})
+
+        # The identities not found expire before
+        cache.ttl = 3600
+        cache.miss_ttl = 10
+        with patch('grimoire_elk.enriched.identities_cache.time.monotonic', return_value=1000):
+            cache.put('sh_ids', ('unknown', 'git'), {"id": None, "uuid": None})
+            cache.put('uuids', '22222', 'bbbbb')
+        with patch('grimoire_elk.enriched.identities_cache.time.monotonic', return_value=1010):
+            self.assertDictEqual(cache.get_many('sh_ids', [('unknown', 'git')]), {})
+            self.assertDictEqual(cache.get_many('uuids', ['22222']), {'22222': 'bbbbb'})
+
+    def test_invalidate(self):
+        """Test whether the entries of some identities, or all of them, are removed"""
+
+        cache = IdentitiesCache()
+        cache.put('uuids', '11111', 'aaaaa')
+        cache.put('uuids', '22222', 'bbbbb')
+        cache.put('enrollments', 'aaaaa', [])
+        cache.put('enrollments', 'bbbbb', [])
+
+        cache.invalidate(['11111', 'aaaaa'])
+        self.assertDictEqual(cache.get_many('uuids', ['11111', '22222']), {'22222': 'bbbbb'})
+        self.assertDictEqual(cache.get_many('enrollments', ['aaaaa', 'bbbbb']), {'bbbbb': []})
+        self.assertEqual(cache.generation, 1)
+
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.generation, 2)
+
+    def test_invalidate_refs(self):
+        """Test whether the entries referring to the ids invalidated are removed"""
+
+        identity = (('email', 'pepe@host.com'), ('name', 'Pepe'), ('username', None))
+        unknown = (('email', 'juan@host.com'), ('name', 'Juan'), ('username', None))
+
+        cache = IdentitiesCache()
+        cache.put('sh_ids', (identity, 'git'), {"id": '11111', "uuid": 'aaaaa'})
+        cache.put('uuids', '11111', 'aaaaa')
+        cache.put('enrollments_index', 'aaaaa', None)
+        cache.put('enrollments_index', 'bbbbb', None)
+
+        # The identities not found are cached until any invalidation
+        cache.put('sh_ids', (unknown, 'git'), {"id": None, "uuid": None})
+        self.assertDictEqual(cache.get_many('sh_ids', [(unknown, 'git')]),
+                             {(unknown, 'git'): {"id": None, "uuid": None}})
+
+        # The unique identity is merged into other one
+        cache.invalidate(['aaaaa'])
+        self.assertDictEqual(cache.get_many('sh_ids', [(identity, 'git')]), {})
+        self.assertDictEqual(cache.get_many('sh_ids', [(unknown, 'git')]), {})
+        self.assertDictEqual(cache.get_many('uuids', ['11111']), {})
+        self.assertDictEqual(cache.get_many('enrollments_index', ['aaaaa', 'bbbbb']), {'bbbbb': None})
+        self.assertEqual(len(cache), 1)
+        self.assertListEqual(list(cache.refs.keys()), ['bbbbb'])
+
+        # The references of the entries evicted are removed
+        cache.max_size = 1
+        cache.put('enrollments_index', 'ccccc', None)
+        self.assertListEqual(list(cache.refs.keys()), ['ccccc'])
+
+    def test_pop_added(self):
+        """Test whether the entries added are returned to other process"""
+
+        cache = IdentitiesCache()
+        cache.put('uuids', '00000', 'zzzzz')
+        self.assertDictEqual(cache.pop_added(), {})
+
+        cache.track_added()
+        cache.put_many('uuids', {'11111': 'aaaaa', '22222': 'bbbbb'})
+        cache.put('enrollments_index', 'aaaaa', None)
+        cache.invalidate(['22222'])
+
+        self.assertDictEqual(cache.pop_added(['uuids']), {'uuids': {'11111': 'aaaaa'}})
+        self.assertDictEqual(cache.pop_added(), {})
+
+    def test_end_run(self):
+        """Test whether the stats of the workers are merged and reported"""
+
+        cache = IdentitiesCache()
+        cache.get('uuids', '11111', lambda: 'aaaaa')
+
+        worker = IdentitiesCache()
+        worker.get('uuids', '11111', lambda: 'aaaaa')
+        worker.get('uuids', '11111', lambda: 'aaaaa')
+        worker.get('uidentities', 'aaaaa', lambda: None)
+        cache.merge_stats(worker.pop_stats())
+
+        Metrics.enabled = True
+        metrics.reset()
+        try:
+            with self.assertLogs('grimoire_elk.enriched.identities_cache', level='INFO') as logs:
+                stats = cache.end_run('enrich', 'git')
+            counters = metrics.summary()['counters']
+        finally:
+            Metrics.enabled = False
+            metrics.reset()
+
+        self.assertDictEqual(stats['uuids'], {'hits': 1, 'misses': 2, 'evictions': 0, 'expired': 0})
+        self.assertEqual(counters['identities_cache.uuids.hits'], 1)
+        self.assertEqual(counters['identities_cache.uidentities.misses'], 1)
+        self.assertIn("[git] enrich identities cache uuids: 1 hits, 2 misses, 0 evictions, 0 expired, "
+                      "33.33% hit rate, 1 entries", logs.output[1])
+        self.assertDictEqual(cache.stats, {})
+
+
+class TestIdentitiesCacheStore(unittest.TestCase):
+    """Unit tests for IdentitiesCacheStore class"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='identities_cache_')
+        self.path = os.path.join(self.tmp_path, 'identities.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def __save(self):
+        identity = (('email', 'pepe@host.com'), ('name', 'Pepe'), ('username', None))
+        enrollment = SnapshotEnrollment(datetime.datetime(2010, 1, 1), datetime.datetime(2100, 1, 1, 12, 30),
+                                        SnapshotOrganization('Bitergia'))
+
+        cache = IdentitiesCache()
+        cache.put_many('uuids', {'11111': 'aaaaa', '22222': None, '33333': 'bbbbb'})
+        cache.put('sh_ids', (identity, 'git'), {"id": '11111', "uuid": 'aaaaa'})
+        cache.put('uidentities', 'aaaaa',
+                  SnapshotUniqueIdentity('aaaaa', SnapshotProfile('Pepe', 'pepe@host.com', 'male', 100, False)))
+        cache.put('uidentities', 'bbbbb', SnapshotUniqueIdentity('bbbbb', None))
+        cache.put_many('enrollments', {'aaaaa': [enrollment], 'bbbbb': []})
+        # The derived lookups are not saved
+        cache.put('enrollments_index', 'aaaaa', None)
+
+        store = IdentitiesCacheStore(self.path)
+        self.assertEqual(store.load(cache, None), 0)
+        self.assertEqual(store.save(cache), 8)
+        store.close()
+
+        return identity, enrollment
+
+    def test_load(self):
+        """Test whether the lookups saved are loaded in the next run"""
+
+        identity, enrollment = self.__save()
+
+        cache = IdentitiesCache()
+        store = IdentitiesCacheStore(self.path)
+        with patch('grimoire_elk.enriched.sortinghat_gelk.SortingHat.get_modified_identities',
+                   return_value=([], [])) as query:
+            self.assertEqual(store.load(cache, None), 7)
+        store.close()
+
+        after = query.call_args[0][1]
+        self.assertIsNone(after.tzinfo)
+        self.assertLess(after, datetime.datetime.utcnow() - IdentitiesCacheStore.sync_margin)
+
+        # The identities not found are queried again
+        self.assertDictEqual(cache.get_many('uuids', ['11111', '22222', '33333']),
+                             {'11111': 'aaaaa', '33333': 'bbbbb'})
+        self.assertDictEqual(cache.get_many('sh_ids', [(identity, 'git')]),
+                             {(identity, 'git'): {"id": '11111', "uuid": 'aaaaa'}})
+        uidentity = cache.get_many('uidentities', ['aaaaa'])['aaaaa']
+        self.assertEqual(uidentity.profile.gender_acc, 100)
+        self.assertFalse(uidentity.profile.is_bot)
+        self.assertListEqual(cache.get_many('enrollments', ['aaaaa'])['aaaaa'], [enrollment])
+        self.assertEqual(len(cache), 7)
+
+    def test_load_modified(self):
+        """Test whether the lookups of the identities modified in SortingHat are removed"""
+
+        identity, _ = self.__save()
+
+        cache = IdentitiesCache()
+        store = IdentitiesCacheStore(self.path)
+        with patch('grimoire_elk.enriched.sortinghat_gelk.SortingHat.get_modified_identities',
+                   return_value=(['11111'], ['bbbbb'])):
+            self.assertEqual(store.load(cache, None), 2)
+        store.close()
+
+        self.assertListEqual(list(cache.get_many('uidentities', ['aaaaa', 'bbbbb'])), ['aaaaa'])
+        self.assertListEqual(list(cache.get_many('enrollments', ['aaaaa', 'bbbbb'])), ['aaaaa'])
+        self.assertDictEqual(cache.get_many('uuids', ['11111', '33333']), {})
+        self.assertDictEqual(cache.get_many('sh_ids', [(identity, 'git')]), {})
+
+    def test_encode_entries(self):
+        """Test whether the entries sent to other process are encoded and decoded"""
+
+        identity = (('email', 'pepe@host.com'), ('name', 'Pepe'), ('username', None))
+        enrollment = SnapshotEnrollment(datetime.datetime(2010, 1, 1), datetime.datetime(2100, 1, 1),
+                                        SnapshotOrganization('Bitergia'))
+        uidentity = SnapshotUniqueIdentity('aaaaa', SnapshotProfile('Pepe', 'pepe@host.com', None, None, True))
+        entries = {
+            'sh_ids': {(identity, 'git'): {"id": '11111', "uuid": 'aaaaa'}},
+            'uuids': {'11111': 'aaaaa'},
+            'uidentities': {'aaaaa': uidentity},
+            'enrollments': {'aaaaa': [enrollment]},
+            'enrollments_index': {'aaaaa': None}
+        }
+
+        data = IdentitiesCacheStore.encode_entries(entries)
+        # The entries cross the process boundary pickled
+        data = pickle.loads(pickle.dumps(data))
+
+        del entries['enrollments_index']
+        self.assertDictEqual(IdentitiesCacheStore.decode_entries(data), entries)
+
+    def test_enrollments_index(self):
+        """Test whether the organizations are found by date and the days with changes are detected"""
+
+        enrollments = [
+            SnapshotEnrollment(datetime.datetime(2010, 1, 1), datetime.datetime(2100, 1, 1),
+                               SnapshotOrganization('Bitergia')),
+            SnapshotEnrollment(datetime.datetime(2015, 6, 1, 12), datetime.datetime(2016, 1, 1),
+                               SnapshotOrganization('Example'))
+        ]
+        index = EnrollmentsIndex(enrollments)
+
+        self.assertTupleEqual(index.organizations_at(datetime.datetime(2015, 6, 1, 10)), ('Bitergia',))
+        self.assertTupleEqual(index.organizations_at(datetime.datetime(2015, 6, 1, 13)), ('Bitergia', 'Example'))
+        self.assertTupleEqual(index.organizations_at(datetime.datetime(2000, 1, 1)), ())
+
+        self.assertTrue(index.is_constant_on(datetime.datetime(2015, 5, 31, 23)))
+        self.assertFalse(index.is_constant_on(datetime.datetime(2015, 6, 1, 10)))
+        self.assertFalse(index.is_constant_on(datetime.datetime(2016, 1, 1, 10)))
+        self.assertTrue(index.is_constant_on(datetime.datetime(2016, 1, 2)))
+
+    def test_version(self):
+        """Test whether the lookups of other versions are removed"""
+
+        self.__save()
+
+        conn = sqlite3.connect(self.path)
+        with conn:
+            conn.execute("UPDATE meta SET value = '0' WHERE name = 'version'")
+        conn.close()
+
+        cache = IdentitiesCache()
+        store = IdentitiesCacheStore(self.path)
+        self.assertEqual(store.load(cache, None), 0)
+        store.close()
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main(warnings='ignore')
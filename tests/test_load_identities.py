@@ -21,7 +21,9 @@
 
 import configparser
 import datetime
+import json
 import logging
+import os
 import random
 import string
 import sys
@@ -30,6 +32,7 @@ import unittest
 if '..' not in sys.path:
     sys.path.insert(0, '..')
 
+from grimoire_elk.elk import load_identities
 from grimoire_elk.utils import get_connectors
 from grimoire_elk.enriched.sortinghat_gelk import SortingHat
 
@@ -122,6 +125,24 @@ class TestLoadIdentities(unittest.TestCase):
 
         self._test_load_identities()
 
+    def test_load_known_identities(self):
+        """Test whether the identities already in SortingHat are not added again"""
+
+        with open(os.path.join("data", "github.json")) as f:
+            items = json.load(f)
+
+        load_identities(items, self.enrich_backend)
+
+        connector_name = self.enrich_backend.get_connector_name()
+        sh_ids = SortingHat.get_identities_ids(self.enrich_backend.sh_db, connector_name)
+        for item in items:
+            for identity in self.enrich_backend.get_identities(item):
+                sh_id = SortingHat.get_identity_id(identity, connector_name)
+                if sh_id:
+                    self.assertIn(sh_id, sh_ids)
+
+        self.assertEqual(load_identities(items, self.enrich_backend), 0)
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
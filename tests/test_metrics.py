@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2015-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from grimoire_elk.enriched.enrich import Enrich
+from grimoire_elk.files import ElasticSearchFile
+from grimoire_elk.metrics import Metrics, NULL_TIMER, metrics
+from grimoire_elk.utils import get_connectors
+
+
+class TestMetrics(unittest.TestCase):
+    """Unit tests for Metrics class"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='metrics_')
+        Metrics.enabled = True
+
+    def tearDown(self):
+        Metrics.enabled = False
+        shutil.rmtree(self.tmp_path)
+
+    def test_disabled(self):
+        """Test whether nothing is collected when the metrics are disabled"""
+
+        Metrics.enabled = False
+        stats = Metrics()
+
+        self.assertIs(stats.timer('stage'), NULL_TIMER)
+        with stats.timer('stage') as timer:
+            timer.add_bytes(10)
+        stats.observe('stage', 1)
+        stats.incr('counter')
+
+        items = [1, 2, 3]
+        self.assertIs(stats.timed_iter('stage', items), items)
+
+        self.assertDictEqual(stats.stages, {})
+        self.assertDictEqual(stats.counters, {})
+        self.assertIsNone(stats.pop())
+        self.assertIsNone(stats.end_run('enrich', 'git'))
+
+    def test_summary(self):
+        """Test whether the summary of the stages and counters is computed"""
+
+        stats = Metrics()
+        for value in range(1, 101):
+            stats.observe('es.put_bulk', value / 100, n_bytes=10)
+        with stats.timer('enrich.pack') as timer:
+            timer.add_bytes(5)
+        self.assertListEqual(list(stats.timed_iter('fetch.page_wait', ['a', 'b'])), ['a', 'b'])
+        stats.incr('enrich.raw_items', 7)
+        stats.incr('enrich.raw_items')
+
+        summary = stats.summary('enrich', 'git')
+        self.assertEqual(summary['run'], 'enrich')
+        self.assertEqual(summary['backend'], 'git')
+        self.assertListEqual(list(summary['stages'].keys()), ['enrich.pack', 'es.put_bulk', 'fetch.page_wait'])
+        self.assertDictEqual(summary['counters'], {'enrich.raw_items': 8})
+
+        bulk = summary['stages']['es.put_bulk']
+        self.assertEqual(bulk['count'], 100)
+        self.assertEqual(bulk['total_seconds'], 50.5)
+        self.assertEqual(bulk['p50_seconds'], 0.5)
+        self.assertEqual(bulk['p95_seconds'], 0.95)
+        self.assertEqual(bulk['max_seconds'], 1)
+        self.assertEqual(bulk['bytes'], 1000)
+
+        self.assertEqual(summary['stages']['enrich.pack']['count'], 1)
+        self.assertEqual(summary['stages']['enrich.pack']['bytes'], 5)
+        self.assertEqual(summary['stages']['fetch.page_wait']['count'], 2)
+
+    def test_max_samples(self):
+        """Test whether the samples of the percentiles are bounded"""
+
+        stats = Metrics()
+        stats.max_samples = 10
+        for value in range(1000):
+            stats.observe('stage', value)
+
+        stage = stats.stages['stage']
+        self.assertEqual(stage.count, 1000)
+        self.assertEqual(len(stage.samples), 10)
+        self.assertEqual(stage.max, 999)
+
+    def test_pop_merge(self):
+        """Test whether the metrics of other process are merged"""
+
+        worker = Metrics()
+        worker.observe('enrich.get_rich_item', 0.5)
+        worker.incr('sortinghat.batch_identities', 3)
+
+        data = worker.pop()
+        self.assertDictEqual(worker.stages, {})
+        self.assertDictEqual(worker.counters, {})
+
+        # The data is sent between processes
+        data = json.loads(json.dumps(data))
+
+        stats = Metrics()
+        stats.observe('enrich.get_rich_item', 1.5)
+        stats.merge(data)
+        stats.merge(data)
+
+        stage = stats.stages['enrich.get_rich_item']
+        self.assertEqual(stage.count, 3)
+        self.assertEqual(stage.total, 2.5)
+        self.assertListEqual(sorted(stage.samples), [0.5, 0.5, 1.5])
+        self.assertDictEqual(stats.counters, {'sortinghat.batch_identities': 6})
+
+    def test_end_run(self):
+        """Test whether the reports are written at the end of a run"""
+
+        report_file = os.path.join(self.tmp_path, 'metrics.json')
+        prometheus_file = os.path.join(self.tmp_path, 'metrics.prom')
+
+        stats = Metrics()
+        stats.report_file = report_file
+        stats.prometheus_file = prometheus_file
+
+        stats.observe('es.put_bulk', 0.25, n_bytes=100)
+        stats.incr('bulk.inserted', 10)
+        stats.end_run('feed', 'git')
+
+        self.assertDictEqual(stats.stages, {})
+
+        stats.observe('es.put_bulk', 0.5)
+        summary = stats.end_run('enrich', 'git')
+
+        with open(report_file) as fd:
+            reports = [json.loads(line) for line in fd]
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(reports[0]['run'], 'feed')
+        self.assertEqual(reports[0]['counters']['bulk.inserted'], 10)
+        self.assertDictEqual(reports[1], summary)
+
+        with open(prometheus_file) as fd:
+            lines = fd.read().splitlines()
+        labels = 'run="enrich",backend="git",stage="es.put_bulk"'
+        self.assertIn('grimoirelab_elk_stage_seconds{' + labels + ',quantile="0.5"} 0.5', lines)
+        self.assertIn('grimoirelab_elk_stage_seconds_count{' + labels + '} 1', lines)
+        self.assertIn('grimoirelab_elk_stage_bytes_total{' + labels + '} 0', lines)
+        self.assertNotIn('bulk_inserted', "\n".join(lines))
+        self.assertFalse(os.path.exists(prometheus_file + '.tmp'))
+
+    def test_format_prometheus(self):
+        """Test whether the counters are formatted as Prometheus metrics"""
+
+        stats = Metrics()
+        stats.incr('feed.items-added', 2)
+
+        text = Metrics.format_prometheus(stats.summary('feed', 'git'))
+        self.assertIn('# TYPE grimoirelab_elk_feed_items_added_total counter', text)
+        self.assertIn('grimoirelab_elk_feed_items_added_total{run="feed",backend="git"} 2', text)
+
+
+class TestEnrichMetrics(unittest.TestCase):
+    """Functional tests of the metrics collected while enriching"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='metrics_')
+        Metrics.enabled = True
+        metrics.reset()
+
+    def tearDown(self):
+        Metrics.enabled = False
+        Enrich.enrich_workers = 1
+        metrics.reset()
+        shutil.rmtree(self.tmp_path)
+
+    def __enrich(self):
+        connector = get_connectors()['git']
+
+        with open(os.path.join("data", "git.json")) as f:
+            items = json.load(f)
+        path = os.path.join(self.tmp_path, 'git.json')
+        with open(path, 'w') as fd:
+            for item in items:
+                fd.write(json.dumps(item) + "\n")
+
+        ocean_backend = connector[1](None)
+        ocean_backend.set_raw_file(path)
+
+        enrich_backend = connector[2]()
+        enrich_backend.set_elastic(ElasticSearchFile(os.path.join(self.tmp_path, 'git_enriched.json'),
+                                                     'git_enriched'))
+        enrich_backend.enrich_items(ocean_backend)
+        enrich_backend.elastic.close()
+
+        return len(items), metrics.summary('enrich', 'git')
+
+    def test_enrich(self):
+        """Test whether the stages of the enrichment are timed"""
+
+        n_items, summary = self.__enrich()
+
+        self.assertEqual(summary['counters']['enrich.raw_items'], n_items)
+        self.assertEqual(summary['counters']['bulk.inserted'], n_items)
+        self.assertEqual(summary['stages']['enrich.get_rich_item']['count'], n_items)
+        self.assertEqual(summary['stages']['bulk.encode']['count'], n_items)
+        self.assertEqual(summary['stages']['enrich.pack']['count'], 1)
+        self.assertEqual(summary['stages']['bulk.put']['count'], 1)
+
+    def test_enrich_workers(self):
+        """Test whether the metrics of the pool of processes are merged"""
+
+        Enrich.enrich_workers = 2
+        n_items, summary = self.__enrich()
+
+        self.assertEqual(summary['counters']['enrich.raw_items'], n_items)
+        self.assertEqual(summary['stages']['enrich.get_rich_item']['count'], n_items)
+        self.assertEqual(summary['stages']['enrich.pack']['count'], 1)
+        self.assertEqual(summary['stages']['enrich.pack_wait']['count'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main(warnings='ignore')
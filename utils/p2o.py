@@ -27,6 +27,11 @@ from os import sys
 from grimoire_elk.elk import feed_backend, enrich_backend
 from grimoire_elk.elastic import ElasticSearch
 from grimoire_elk.elastic_items import ElasticItems
+from grimoire_elk.enriched.ceres_base import ESConnector
+from grimoire_elk.enriched.enrich import Enrich
+from grimoire_elk.enriched.identities_cache import IdentitiesCache
+from grimoire_elk.enriched.utils import log_compression_stats
+from grimoire_elk.metrics import Metrics
 from grimoire_elk.utils import get_params, config_logging
 
 
@@ -50,10 +55,56 @@ if __name__ == '__main__':
             # Configure elastic bulk size and scrolling
             if args.bulk_size:
                 ElasticSearch.max_items_bulk = args.bulk_size
+            if args.bulk_workers:
+                ElasticSearch.bulk_workers = args.bulk_workers
+            if args.bulk_in_flight:
+                ElasticSearch.max_bulk_in_flight = args.bulk_in_flight
+            if args.bulk_refresh:
+                ElasticSearch.refresh_policy = args.bulk_refresh
+            if args.bulk_load_force_merge:
+                ElasticSearch.force_merge_on_bulk_load = True
+            if args.bulk_retries is not None:
+                ElasticSearch.max_bulk_retries = args.bulk_retries
+            if args.bulk_dead_letter_file:
+                ElasticSearch.dead_letter_file = args.bulk_dead_letter_file
+            if args.http_compression:
+                ElasticSearch.compression_level = args.http_compression
+                ElasticItems.compression_level = args.http_compression
             if args.scroll_size:
                 ElasticItems.scroll_size = args.scroll_size
             if args.scroll_wait:
                 ElasticItems.scroll_wait = args.scroll_wait
+            if args.pagination:
+                ElasticItems.pagination = args.pagination
+            if args.read_slices:
+                ElasticItems.read_slices = args.read_slices
+            if args.prefetch_pages:
+                ElasticItems.prefetch_pages = args.prefetch_pages
+            if args.adaptive_page_size:
+                ElasticItems.adaptive_page_size = True
+                ESConnector.adaptive_page_size = True
+            if args.enrich_workers:
+                Enrich.enrich_workers = args.enrich_workers
+            if args.checkpoint_file:
+                Enrich.checkpoint_file = args.checkpoint_file
+            if args.checkpoint_index:
+                Enrich.checkpoint_index = args.checkpoint_index
+            if args.checkpoint_interval:
+                Enrich.checkpoint_interval = args.checkpoint_interval
+            if args.identities_snapshot:
+                Enrich.identities_snapshot = True
+            if args.identities_snapshot_no_fallback:
+                Enrich.identities_snapshot_fallback = False
+            if args.identities_cache_size:
+                IdentitiesCache.max_size = args.identities_cache_size
+            if args.identities_cache_ttl:
+                IdentitiesCache.ttl = args.identities_cache_ttl
+            if args.identities_cache_file:
+                Enrich.identities_cache_file = args.identities_cache_file
+            if args.metrics_file or args.metrics_prometheus_file:
+                Metrics.enabled = True
+                Metrics.report_file = args.metrics_file
+                Metrics.prometheus_file = args.metrics_prometheus_file
             if not args.enrich_only:
                 feed_backend(url, clean, args.fetch_cache,
                              args.backend, args.backend_args,
@@ -86,7 +137,11 @@ if __name__ == '__main__':
                                args.author_id, args.author_uuid,
                                args.filter_raw,
                                args.jenkins_rename_file, unaffiliated_group,
-                               args.pair_programming, studies_args)
+                               args.pair_programming, studies_args,
+                               rebuild=args.rebuild_enrich,
+                               raw_file=args.raw_file,
+                               enrich_out_file=args.enrich_out_file,
+                               refresh_modified_identities=args.refresh_modified_identities)
                 logging.info("Enrich backend completed")
             elif args.events_enrich:
                 logging.info("Enrich option is needed for events_enrich")
@@ -97,6 +152,8 @@ if __name__ == '__main__':
         logging.info("\n\nReceived Ctrl-C or other break signal. Exiting.\n")
         sys.exit(0)
 
+    log_compression_stats()
+
     total_time_min = (datetime.now() - app_init).total_seconds() / 60
 
     logging.info("Finished in %.2f min" % (total_time_min))